@@ -1,10 +1,53 @@
 from django.contrib import admin
-from core.models import GHLAuthCredentials, HCPToGHLMapping, ContactMapping, OpportunityMapping, Webhook
+from core.cache import invalidate_company_mapping, invalidate_credentials
+from core.deadletter import requeue_dead_letters
+from core.models import GHLAuthCredentials, HCPToGHLMapping, ContactMapping, OpportunityMapping, Webhook, GHLOutboxMessage, GHLDeadLetter, GHLContactIndex
+
+
+@admin.register(GHLAuthCredentials)
+class GHLAuthCredentialsAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_credentials(obj)
+
+
+@admin.register(HCPToGHLMapping)
+class HCPToGHLMappingAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_company_mapping(obj.hcp_company_id)
+        if form.initial.get('hcp_company_id'):
+            invalidate_company_mapping(form.initial['hcp_company_id'])
+
+    def delete_model(self, request, obj):
+        invalidate_company_mapping(obj.hcp_company_id)
+        super().delete_model(request, obj)
+
 
-admin.site.register(GHLAuthCredentials)
-admin.site.register(HCPToGHLMapping)
 admin.site.register(ContactMapping)
 admin.site.register(OpportunityMapping)
 admin.site.register(Webhook)
+admin.site.register(GHLOutboxMessage)
+
+
+@admin.register(GHLContactIndex)
+class GHLContactIndexAdmin(admin.ModelAdmin):
+    list_display = ('ghl_location_id', 'key', 'ghl_contact_id', 'updated_at')
+    list_filter = ('ghl_location_id',)
+    search_fields = ('key', 'ghl_contact_id')
+
+
+@admin.register(GHLDeadLetter)
+class GHLDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('id', 'method', 'url', 'event_type', 'error_class', 'status_code', 'attempts', 'status',
+                    'next_attempt_at', 'created_at')
+    list_filter = ('status', 'method', 'error_class', 'location_id')
+    search_fields = ('url', 'error_message')
+    actions = ['requeue']
+
+    @admin.action(description='Requeue selected dead letters')
+    def requeue(self, request, queryset):
+        count = requeue_dead_letters(queryset)
+        self.message_user(request, f"Requeued {count} dead letters")
 
 # Register your models here.
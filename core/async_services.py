@@ -0,0 +1,282 @@
+"""asyncio variant of GoHighLevelService.
+
+AsyncGoHighLevelService has the same methods as GoHighLevelService, as
+coroutines, including dead-letter recording for failed updates/deletes, so a single process can keep hundreds of GHL requests in flight.
+It can be awaited from async Django views (hcp2ghl_sync.asgi) or from a batch
+worker:
+
+    service = AsyncGoHighLevelService(credentials.access_token, 'job.updated', credentials=credentials)
+    results = await asyncio.gather(*(service.update_opportunity(opp_id, job) for opp_id, job in work))
+
+All instances on an event loop share one httpx connection pool
+(GHL_ASYNC_MAX_CONNECTIONS) and at most GHL_ASYNC_PER_LOCATION_CONCURRENCY
+requests per GHL location are in flight at once, on top of the shared
+rate limiter.
+"""
+import asyncio
+import logging
+import weakref
+from typing import Any, Dict, Optional
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .metrics import GHL_RATE_LIMITED, GHL_REQUEST_SECONDS, endpoint_template, timed
+from .models import GHLAuthCredentials
+from .deadletter import record_dead_letter, supersede_dead_letters
+from .ratelimit import observe_rate_limit_headers, rate_limiter, retry_delay
+from .services import (
+    GoHighLevelService,
+    build_contact_payload,
+    build_opportunity_create_payload,
+    build_opportunity_update_payload,
+    refresh_ghl_credentials_once,
+)
+
+logger = logging.getLogger(__name__)
+
+# httpx clients and semaphores belong to the loop they were created on
+_clients = weakref.WeakKeyDictionary()
+_location_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_async_ghl_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.GHL_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.GHL_ASYNC_MAX_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(settings.GHL_HTTP_READ_TIMEOUT, connect=settings.GHL_HTTP_CONNECT_TIMEOUT),
+        )
+        _clients[loop] = client
+    return client
+
+
+def _location_semaphore(location_id: str) -> asyncio.Semaphore:
+    semaphores = _location_semaphores.setdefault(asyncio.get_running_loop(), {})
+    semaphore = semaphores.get(location_id)
+    if semaphore is None:
+        semaphore = semaphores[location_id] = asyncio.Semaphore(settings.GHL_ASYNC_PER_LOCATION_CONCURRENCY)
+    return semaphore
+
+
+async def close_async_ghl_client():
+    """Close the client of the running loop, call before the loop shuts down"""
+    loop = asyncio.get_running_loop()
+    client = _clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+    _location_semaphores.pop(loop, None)
+
+
+class AsyncGoHighLevelService:
+    BASE_URL = GoHighLevelService.BASE_URL
+    PIPELINE_STAGES = GoHighLevelService.PIPELINE_STAGES
+    PIPELINE_ID = GoHighLevelService.PIPELINE_ID
+
+    def __init__(self, access_token: str, event_type: str, client: Optional[httpx.AsyncClient] = None,
+                 credentials: Optional[GHLAuthCredentials] = None, location_id: Optional[str] = None,
+                 dead_letters: bool = True):
+        self.access_token = access_token
+        self.headers = {
+            'Accept': 'application/json',
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json',
+            'Version': '2021-07-28'
+        }
+        self.event_type = event_type
+        self.client = client
+        self.credentials = credentials
+        self.location_id = location_id or (credentials.location_id if credentials else None)
+        self.dead_letters = dead_letters
+        self._refresh_lock = asyncio.Lock()
+
+    async def _timed_request(self, client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+        with timed(GHL_REQUEST_SECONDS, method=method, endpoint=endpoint_template(url), status_code='error') as span:
+            response = await client.request(method, url, headers=self.headers, **kwargs)
+            span['status_code'] = str(response.status_code)
+        return response
+
+    async def _send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Same contract as GoHighLevelService._send: 429s over GHL_BACKOFF_MAX are returned, not slept out"""
+        client = self.client or get_async_ghl_client()
+        max_retries = settings.GHL_RATE_LIMIT_MAX_RETRIES
+        for attempt in range(max_retries + 1):
+            if self.location_id:
+                await rate_limiter.acquire_async(self.location_id)
+                async with _location_semaphore(self.location_id):
+                    response = await self._timed_request(client, method, url, **kwargs)
+                observe_rate_limit_headers(self.location_id, response)
+            else:
+                response = await self._timed_request(client, method, url, **kwargs)
+            if response.status_code != 429 or attempt == max_retries:
+                return response
+
+            delay = retry_delay(response, attempt)
+            GHL_RATE_LIMITED.labels(location_id=self.location_id or '').inc()
+            if delay > settings.GHL_BACKOFF_MAX:
+                logger.warning(f"GHL rate limited {method} {url} for {delay:.1f}s, over GHL_BACKOFF_MAX, not waiting")
+                return response
+            logger.warning(f"GHL rate limited {method} {url}, retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        return response
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Same contract as GoHighLevelService._request: one token refresh and replay on 401"""
+        token = self.access_token
+        response = await self._send(method, url, **kwargs)
+        if response.status_code != 401 or self.credentials is None:
+            return response
+
+        # Requests of this instance that failed together share one refresh
+        async with self._refresh_lock:
+            if self.access_token == token:
+                credentials = await sync_to_async(refresh_ghl_credentials_once)(self.credentials.id, token)
+                if credentials is None:
+                    return response
+                self.credentials = credentials
+                self.access_token = credentials.access_token
+                self.headers['Authorization'] = f'Bearer {credentials.access_token}'
+        return await self._send(method, url, **kwargs)
+
+    async def _write(self, method: str, url: str, payload: Optional[Dict[str, Any]] = None) -> bool:
+        """PUT/DELETE that dead-letters the request on failure, see core/deadletter.py"""
+        kwargs = {'json': payload} if payload is not None else {}
+        try:
+            response = await self._request(method, url, **kwargs)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            if self.dead_letters:
+                await sync_to_async(record_dead_letter)(
+                    method, url, payload, e, location_id=self.location_id,
+                    credentials=self.credentials, event_type=self.event_type,
+                )
+            raise
+        if self.dead_letters:
+            await sync_to_async(supersede_dead_letters)(method, url, payload)
+        return True
+
+    def get_pipeline_stage_id(self, event_type: str) -> str:
+        """Get GHL pipeline stage ID for HCP event type"""
+        return self.PIPELINE_STAGES.get(event_type, "")
+
+    async def create_contact(self, location_id: str, contact_data: Dict[str, Any]) -> Optional[str]:
+        """Create a contact in GoHighLevel with housecallpro tag"""
+        payload = {"locationId": location_id, **build_contact_payload(contact_data)}
+        try:
+            response = await self._request('POST', f"{self.BASE_URL}/contacts/", json=payload)
+            response.raise_for_status()
+            return response.json().get('contact', {}).get('id')
+        except httpx.HTTPError as e:
+            logger.error(f"Error creating contact in GHL: {e}")
+            return None
+
+    async def upsert_contact(self, location_id: str, contact_data: Dict[str, Any]) -> Optional[str]:
+        """Create a contact, or update the one GHL matches by email/phone, and return its ID"""
+        payload = {"locationId": location_id, **build_contact_payload(contact_data)}
+        try:
+            response = await self._request('POST', f"{self.BASE_URL}/contacts/upsert", json=payload)
+            response.raise_for_status()
+            return response.json().get('contact', {}).get('id')
+        except httpx.HTTPError as e:
+            logger.error(f"Error upserting contact in GHL: {e}")
+            return None
+
+    async def search_duplicate_contact(self, location_id: str, email: Optional[str] = None,
+                                       phone: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """The existing contact GHL's duplicate rules match to this email/phone, if any"""
+        params = {"locationId": location_id}
+        if email:
+            params["email"] = email
+        if phone:
+            params["number"] = phone
+        try:
+            response = await self._request('GET', f"{self.BASE_URL}/contacts/search/duplicate", params=params)
+            response.raise_for_status()
+            return response.json().get('contact') or None
+        except httpx.HTTPError as e:
+            logger.error(f"Error searching duplicate contacts in GHL: {e}")
+            return None
+
+    async def list_contacts(self, location_id: str, limit: int = 100, start_after_id: Optional[str] = None,
+                            start_after: Optional[int] = None) -> Dict[str, Any]:
+        """One page of a location's contacts ({'contacts': [...], 'meta': {...}}), raises on errors"""
+        params = {"locationId": location_id, "limit": limit}
+        if start_after_id:
+            params["startAfterId"] = start_after_id
+            params["startAfter"] = start_after
+        response = await self._request('GET', f"{self.BASE_URL}/contacts/", params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def update_contact(self, contact_id: str, contact_data: Dict[str, Any]) -> bool:
+        """Update a contact in GoHighLevel"""
+        try:
+            return await self._write('PUT', f"{self.BASE_URL}/contacts/{contact_id}", build_contact_payload(contact_data))
+        except httpx.HTTPError as e:
+            logger.error(f"Error updating contact in GHL: {e}")
+            return False
+
+    async def delete_contact(self, contact_id: str) -> bool:
+        """Delete a contact in GoHighLevel"""
+        try:
+            return await self._write('DELETE', f"{self.BASE_URL}/contacts/{contact_id}")
+        except httpx.HTTPError as e:
+            logger.error(f"Error deleting contact in GHL: {e}")
+            return False
+
+    async def create_opportunity(self, location_id: str, contact_id: str, opportunity_data: Dict[str, Any],
+                                 status: Optional[str] = None) -> Optional[str]:
+        """Create an opportunity in GoHighLevel, open unless status says otherwise"""
+        stage_id = self.get_pipeline_stage_id(self.event_type)
+        payload = build_opportunity_create_payload(location_id, contact_id, opportunity_data, self.PIPELINE_ID, stage_id, status)
+        try:
+            response = await self._request('POST', f"{self.BASE_URL}/opportunities/", json=payload)
+            response.raise_for_status()
+            return response.json().get('opportunity', {}).get('id')
+        except httpx.HTTPError as e:
+            logger.error(f"Error creating opportunity in GHL: {e}")
+            return None
+
+    async def search_opportunity(self, location_id: str, contact_id: str, name: str) -> Optional[str]:
+        """ID of the contact's opportunity in our pipeline with exactly this name, if any"""
+        params = {
+            "location_id": location_id,
+            "contact_id": contact_id,
+            "pipeline_id": self.PIPELINE_ID,
+            "q": name,
+        }
+        try:
+            response = await self._request('GET', f"{self.BASE_URL}/opportunities/search", params=params)
+            response.raise_for_status()
+            for opportunity in response.json().get('opportunities', []):
+                if opportunity.get('name') == name:
+                    return opportunity.get('id')
+            return None
+        except httpx.HTTPError as e:
+            logger.error(f"Error searching opportunities in GHL: {e}")
+            return None
+
+    async def update_opportunity(self, opportunity_id: str, opportunity_data: Dict[str, Any], option_data: Dict[str, Any] = None,
+                                 status: Optional[str] = None) -> bool:
+        """Update an opportunity in GoHighLevel, optionally closing it as won/lost in the same request"""
+        stage_id = self.get_pipeline_stage_id(self.event_type)
+        payload = build_opportunity_update_payload(opportunity_data, option_data, stage_id, status)
+        if not payload:
+            return True  # Nothing to update
+        try:
+            return await self._write('PUT', f"{self.BASE_URL}/opportunities/{opportunity_id}", payload)
+        except httpx.HTTPError as e:
+            logger.error(f"Error updating opportunity in GHL: {e}")
+            return False
+
+    async def close_opportunity(self, opportunity_id: str, won: bool = True) -> bool:
+        """Close an opportunity as won or lost"""
+        payload = {"status": "won" if won else "lost"}
+        try:
+            return await self._write('PUT', f"{self.BASE_URL}/opportunities/{opportunity_id}", payload)
+        except httpx.HTTPError as e:
+            logger.error(f"Error closing opportunity in GHL: {e}")
+            return False
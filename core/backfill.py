@@ -0,0 +1,441 @@
+"""Historical backfill of HCP customers, estimates and jobs into GHL.
+
+Records are read from an HCP export (JSON/JSONL dump or the HCP API), GHL
+contacts and opportunities are created with the same payloads the webhook
+handlers use (customers are matched to existing GHL contacts the same way,
+see core/contact_index.py), and the resulting ContactMapping/OpportunityMapping rows are
+written with bulk_create once per batch. Progress is checkpointed after every
+batch so an interrupted run resumes where it stopped, and anything that is
+already mapped is skipped, so re-running is safe. The checkpoint also lists the
+records that failed, and a resumed run tries them again.
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import requests
+from django.conf import settings
+from django.db import connection
+from .contact_index import (
+    customer_keys, find_indexed_contact, index_contact, index_ghl_contacts, mapped_to_other_customer,
+    search_ghl_duplicate,
+)
+from .models import ContactMapping, HCPToGHLMapping, OpportunityMapping
+from .services import CLOSING_EVENT_STATUS, GoHighLevelService, build_contact_payload, contact_payload_digest
+from .utils import get_ghl_session, get_ghl_timeout
+
+logger = logging.getLogger(__name__)
+
+HCP_API_URL = "https://api.housecallpro.com"
+RECORD_TYPES = ('customer', 'estimate', 'job')
+# Characters read at a time from JSON array dumps
+DUMP_CHUNK_SIZE = 1024 * 1024
+
+# HCP job work_status -> event whose pipeline stage the opportunity gets
+JOB_STATUS_EVENTS = {
+    'needs scheduling': 'job.created',
+    'unscheduled': 'job.created',
+    'scheduled': 'job.scheduled',
+    'in progress': 'job.started',
+    'complete unrated': 'job.completed',
+    'complete rated': 'job.completed',
+    'user canceled': 'job.canceled',
+    'pro canceled': 'job.canceled',
+}
+
+
+def iter_dump_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield {'customer'|'estimate'|'job': {...}} records from a JSONL or JSON dump.
+
+    JSONL lines and JSON list items can be webhook-shaped payloads or HCP API
+    pages ({"customers": [...]}, {"estimates": [...]}, {"jobs": [...]}).
+    Both are read one item at a time, a dump never has to fit in memory.
+    """
+    with open(path, encoding='utf-8') as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == '[':
+            items = _iter_json_array(f)
+        else:
+            items = (json.loads(line) for line in f if line.strip())
+        for item in items:
+            yield from _records_from_item(item)
+
+
+def _iter_json_array(f, chunk_size: int = None) -> Iterator[Any]:
+    """Items of the top-level JSON array in f, decoded one by one from chunk_size reads"""
+    chunk_size = chunk_size or DUMP_CHUNK_SIZE
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    pos = buffer.index('[') + 1
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buffer):
+            buffer, pos = f.read(chunk_size), 0
+            if not buffer:
+                raise ValueError(f"Unterminated JSON array in {f.name}")
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The item continues in the next chunk, unless the file ends here
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield item
+        pos = end
+
+
+def _records_from_item(item: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    for record_type in RECORD_TYPES:
+        if isinstance(item.get(f"{record_type}s"), list):
+            for entity in item[f"{record_type}s"]:
+                yield {record_type: entity}
+            return
+        if isinstance(item.get(record_type), dict):
+            yield {record_type: item[record_type]}
+            return
+
+
+def iter_hcp_api_records(api_key: str, page_size: int = 100) -> Iterator[Dict[str, Any]]:
+    """Page through customers, then estimates, then jobs from the HCP API"""
+    session = get_ghl_session()
+    headers = {'Accept': 'application/json', 'Authorization': f'Token {api_key}'}
+    for record_type in RECORD_TYPES:
+        page = 1
+        while True:
+            response = session.get(
+                f"{HCP_API_URL}/{record_type}s",
+                headers=headers,
+                params={'page': page, 'page_size': page_size},
+                timeout=get_ghl_timeout(),
+            )
+            response.raise_for_status()
+            data = response.json()
+            for entity in data.get(f"{record_type}s", []):
+                yield {record_type: entity}
+            if page >= (data.get('total_pages') or 1):
+                break
+            page += 1
+
+
+class BackfillCheckpoint:
+    """Number of source records already handled and the indexes of those that failed, stored as JSON next to the run.
+
+    Its size grows with the failures only, never with the dump.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.offset = 0
+        self.stats = {}
+        self.failed = []
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.offset = data.get('offset', 0)
+            self.stats = data.get('stats', {})
+            self.failed = data.get('failed', [])
+
+    def save(self, offset: int, stats: Dict[str, int], failed: Iterable[int] = ()):
+        self.offset = offset
+        self.stats = stats
+        self.failed = sorted(failed)
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'offset': offset, 'stats': stats, 'failed': self.failed}, f)
+        os.replace(tmp_path, self.path)
+
+
+class HCPBackfill:
+    def __init__(self, mapping: HCPToGHLMapping, concurrency: int = 8, batch_size: int = 200,
+                 checkpoint: Optional[BackfillCheckpoint] = None, session: Optional[requests.Session] = None):
+        self.mapping = mapping
+        self.credentials = mapping.ghl_credentials
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint or BackfillCheckpoint(None)
+        self.session = session
+        self.stats = {
+            'records': 0, 'contacts_created': 0, 'opportunities_created': 0,
+            'opportunities_converted': 0, 'skipped': 0, 'failed': 0,
+            **self.checkpoint.stats,
+        }
+        # Source indexes of records that failed, tried again when a run passes them
+        self.failed_records = set(self.checkpoint.failed)
+        self.stats['failed'] = len(self.failed_records)
+        # (record type, id) of the entities that failed in the current batch
+        self._failed_keys = set()
+        company_id = mapping.hcp_company_id
+        self.contacts = dict(
+            # Placeholders are left to the webhook outbox
+            ContactMapping.objects.filter(hcp_company_id=company_id).exclude(ghl_contact_id='')
+            .values_list('hcp_customer_id', 'ghl_contact_id')
+        )
+        self.job_opportunities = set(
+            OpportunityMapping.objects.filter(hcp_company_id=company_id, hcp_job_id__isnull=False)
+            .values_list('hcp_job_id', flat=True)
+        )
+        self.estimate_opportunities = {
+            estimate_id: (opp_id, job_id)
+            for estimate_id, opp_id, job_id in OpportunityMapping.objects.filter(
+                hcp_company_id=company_id, hcp_estimate_id__isnull=False
+            ).values_list('hcp_estimate_id', 'ghl_opportunity_id', 'hcp_job_id')
+        }
+
+    def _service(self, event_type: str) -> GoHighLevelService:
+        return GoHighLevelService(
+            self.credentials.access_token, event_type, session=self.session,
+            credentials=self.credentials, location_id=self.mapping.ghl_location_id,
+        )
+
+    def run(self, records: Iterable[Dict[str, Any]], progress=None) -> Dict[str, int]:
+        """Backfill records from the checkpoint on, together with the records that failed before it.
+
+        stats['failed'] is the number of records still failing.
+        """
+        offset = self.checkpoint.offset
+        started = time.monotonic()
+        processed_this_run = 0
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for index, record in enumerate(records):
+                if index < offset and index not in self.failed_records:
+                    continue
+                batch.append((index, record))
+                if len(batch) >= self.batch_size:
+                    offset = max(offset, batch[-1][0] + 1)
+                    self._run_batch(pool, batch)
+                    processed_this_run += len(batch)
+                    self._checkpoint(offset, processed_this_run, started, progress)
+                    batch = []
+            if batch:
+                offset = max(offset, batch[-1][0] + 1)
+                self._run_batch(pool, batch)
+                processed_this_run += len(batch)
+                self._checkpoint(offset, processed_this_run, started, progress)
+
+        elapsed = time.monotonic() - started
+        self.stats['records_per_second'] = round(processed_this_run / elapsed, 1) if elapsed else 0
+        return self.stats
+
+    def _checkpoint(self, offset: int, processed: int, started: float, progress):
+        self.stats['records'] = offset
+        self.stats['failed'] = len(self.failed_records)
+        self.checkpoint.save(
+            offset, {k: v for k, v in self.stats.items() if k != 'records_per_second'}, self.failed_records
+        )
+        if progress:
+            elapsed = time.monotonic() - started
+            progress(offset, processed / elapsed if elapsed else 0, self.stats)
+
+    def _run_batch(self, pool: ThreadPoolExecutor, batch: List[Tuple[int, Dict[str, Any]]]):
+        """Contacts first, then estimates, then jobs, each stage fanned out over the pool"""
+        customers = {}
+        estimates, jobs = [], []
+        self._failed_keys = set()
+        for _, record in batch:
+            if 'customer' in record:
+                entity, customer = None, record['customer']
+            else:
+                entity = record.get('estimate') or record.get('job') or {}
+                customer = entity.get('customer') or {}
+                (estimates if 'estimate' in record else jobs).append(entity)
+            if customer.get('id') and customer['id'] not in self.contacts:
+                customers[customer['id']] = customer
+            elif 'customer' in record:
+                self.stats['skipped'] += 1
+
+        self._create_contacts(pool, list(customers.values()))
+        self._create_opportunities(pool, estimates, 'estimate')
+        self._create_opportunities(pool, jobs, 'job')
+
+        for index, record in batch:
+            record_type = next((key for key in RECORD_TYPES if key in record), None)
+            entity = record.get(record_type) or {}
+            if (record_type, entity.get('id')) in self._failed_keys:
+                self.failed_records.add(index)
+            else:
+                self.failed_records.discard(index)
+
+    def _create_contacts(self, pool: ThreadPoolExecutor, customers: List[Dict[str, Any]]):
+        if not customers:
+            return
+        service = self._service('customer.created')
+        matches = self._match_contacts(pool, service, customers)
+        results = pool.map(lambda customer: self._create_contact(service, customer, *matches[customer['id']]), customers)
+
+        new_mappings = []
+        for customer, ghl_contact_id in zip(customers, results):
+            if not ghl_contact_id:
+                self._failed_keys.add(('customer', customer['id']))
+                continue
+            if ghl_contact_id != matches[customer['id']][0]:
+                index_contact(self.mapping.ghl_location_id, ghl_contact_id, customer_keys(customer))
+            self.contacts[customer['id']] = ghl_contact_id
+            new_mappings.append(ContactMapping(
+                hcp_customer_id=customer['id'],
+                ghl_contact_id=ghl_contact_id,
+                hcp_company_id=self.mapping.hcp_company_id,
+                ghl_location_id=self.mapping.ghl_location_id,
+                last_pushed_digest=contact_payload_digest(build_contact_payload(customer)),
+            ))
+        ContactMapping.objects.bulk_create(new_mappings, ignore_conflicts=True)
+        self.stats['contacts_created'] += len(new_mappings)
+
+    def _create_opportunities(self, pool: ThreadPoolExecutor, entities: List[Dict[str, Any]], kind: str):
+        todo = []
+        claimed = set()
+        for entity in entities:
+            contact_id = self.contacts.get((entity.get('customer') or {}).get('id'))
+            if not entity.get('id'):
+                # Nothing to map it by, trying it again won't help
+                self.stats['skipped'] += 1
+                continue
+            if not contact_id:
+                self._failed_keys.add((kind, entity['id']))
+                continue
+            if kind == 'estimate' and entity['id'] in self.estimate_opportunities:
+                self.stats['skipped'] += 1
+                continue
+            if kind == 'job' and entity['id'] in self.job_opportunities:
+                self.stats['skipped'] += 1
+                continue
+            # A job takes over the opportunity of its estimate, once
+            convert = None
+            if kind == 'job':
+                estimate_id = entity.get('original_estimate_id')
+                existing = self.estimate_opportunities.get(estimate_id)
+                # A placeholder (no GHL id yet) is still being created by the outbox
+                if existing and existing[0] and not existing[1] and estimate_id not in claimed:
+                    claimed.add(estimate_id)
+                    convert = (estimate_id, existing[0])
+            todo.append((entity, contact_id, convert))
+        if not todo:
+            return
+
+        results = list(pool.map(lambda item: self._sync_opportunity(kind, *item), todo))
+
+        new_mappings, converted = [], []
+        for (entity, _, _), (ghl_opp_id, converted_from) in zip(todo, results):
+            if not ghl_opp_id:
+                self._failed_keys.add((kind, entity['id']))
+                continue
+            if kind == 'estimate':
+                self.estimate_opportunities[entity['id']] = (ghl_opp_id, None)
+                new_mappings.append(OpportunityMapping(
+                    hcp_estimate_id=entity['id'], ghl_opportunity_id=ghl_opp_id,
+                    hcp_customer_id=(entity.get('customer') or {}).get('id'),
+                    hcp_company_id=self.mapping.hcp_company_id, ghl_location_id=self.mapping.ghl_location_id,
+                ))
+            elif converted_from:
+                self.job_opportunities.add(entity['id'])
+                converted.append((converted_from, entity))
+            else:
+                self.job_opportunities.add(entity['id'])
+                estimate_id = entity.get('original_estimate_id')
+                # Unless the estimate keeps its own mapping, which would drop this row as a conflict
+                claims_estimate = bool(estimate_id) and estimate_id not in self.estimate_opportunities
+                if claims_estimate:
+                    # An estimate later in the dump is then skipped like a converted one, instead of
+                    # creating an opportunity whose mapping would conflict with this one
+                    self.estimate_opportunities[estimate_id] = (ghl_opp_id, entity['id'])
+                new_mappings.append(OpportunityMapping(
+                    hcp_job_id=entity['id'], ghl_opportunity_id=ghl_opp_id,
+                    hcp_estimate_id=estimate_id if claims_estimate else None,
+                    hcp_customer_id=(entity.get('customer') or {}).get('id'),
+                    hcp_company_id=self.mapping.hcp_company_id, ghl_location_id=self.mapping.ghl_location_id,
+                ))
+
+        OpportunityMapping.objects.bulk_create(new_mappings, ignore_conflicts=True)
+        self.stats['opportunities_created'] += len(new_mappings)
+        for estimate_id, job in converted:
+            opp_id, _ = self.estimate_opportunities[estimate_id]
+            self.estimate_opportunities[estimate_id] = (opp_id, job['id'])
+            OpportunityMapping.objects.filter(
+                hcp_estimate_id=estimate_id, hcp_company_id=self.mapping.hcp_company_id
+            ).update(hcp_job_id=job['id'], hcp_customer_id=(job.get('customer') or {}).get('id'))
+        self.stats['opportunities_converted'] += len(converted)
+
+    def _sync_opportunity(self, kind: str, entity: Dict[str, Any], contact_id: str, convert):
+        """Runs on a pool thread, GHL calls only. Returns (ghl_opportunity_id, converted estimate id)"""
+        try:
+            if kind == 'estimate':
+                return self._service('estimate.created').create_opportunity(
+                    self.mapping.ghl_location_id, contact_id, entity
+                ), None
+
+            event_type = JOB_STATUS_EVENTS.get(entity.get('work_status'), 'job.created')
+            service = self._service(event_type)
+            status = CLOSING_EVENT_STATUS.get(event_type)
+            if convert:
+                # Same conversion as _create_or_update_job_opportunity
+                estimate_id, estimate_opp_id = convert
+                if service.update_opportunity(estimate_opp_id, entity, status=status):
+                    return estimate_opp_id, estimate_id
+                return None, None
+            return service.create_opportunity(self.mapping.ghl_location_id, contact_id, entity, status=status), None
+        finally:
+            # The token refresh path may have opened a connection on this thread
+            connection.close()
+
+    def _match_contacts(self, pool: ThreadPoolExecutor, service: GoHighLevelService,
+                        customers: List[Dict[str, Any]]) -> Dict[str, Tuple[Optional[str], bool]]:
+        """(contact to adopt, whether a match was skipped) per customer id, as find_existing_contact decides.
+
+        Index and mapping queries run here, only GHL's duplicate search goes to the pool.
+        """
+        location_id = self.mapping.ghl_location_id
+        keys = {customer['id']: customer_keys(customer) for customer in customers}
+        found = {customer_id: find_indexed_contact(location_id, customer_keys_) for customer_id, customer_keys_ in keys.items()}
+        if settings.GHL_CONTACT_DEDUP_SEARCH:
+            unmatched = [customer_id for customer_id, contact_id in found.items() if not contact_id and keys[customer_id]]
+            duplicates = pool.map(lambda customer_id: self._search_duplicate(service, keys[customer_id]), unmatched)
+            for customer_id, contact in zip(unmatched, duplicates):
+                if contact:
+                    index_ghl_contacts(location_id, [contact])
+                    found[customer_id] = contact['id']
+
+        matches = {}
+        for customer_id, contact_id in found.items():
+            if contact_id and mapped_to_other_customer(self.mapping, contact_id, customer_id):
+                logger.info(f"GHL contact {contact_id} matching HCP customer {customer_id} "
+                            f"belongs to another customer, not adopting it")
+                matches[customer_id] = (None, True)
+            else:
+                matches[customer_id] = (contact_id, False)
+        return matches
+
+    def _search_duplicate(self, service: GoHighLevelService, keys: List[str]) -> Optional[Dict[str, Any]]:
+        try:
+            return search_ghl_duplicate(service, self.mapping.ghl_location_id, keys)
+        finally:
+            connection.close()
+
+    def _create_contact(self, service: GoHighLevelService, customer: Dict[str, Any],
+                        existing_contact_id: Optional[str], skipped_match: bool) -> Optional[str]:
+        """Runs on a pool thread, GHL calls only. Adopts, creates or upserts as _match_contacts decided"""
+        try:
+            if existing_contact_id:
+                logger.info(f"HCP customer {customer['id']} matches GHL contact {existing_contact_id}, not creating another")
+                # The mapping records this payload as pushed, a failed update is dead-lettered
+                service.update_contact(existing_contact_id, customer)
+                return existing_contact_id
+            if skipped_match:
+                # An upsert would land on the other customer's contact
+                return service.create_contact(self.mapping.ghl_location_id, customer)
+            # Upsert, a placeholder's outbox message may be creating the same contact
+            return service.upsert_contact(self.mapping.ghl_location_id, customer)
+        finally:
+            connection.close()
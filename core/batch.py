@@ -0,0 +1,179 @@
+"""Batch ingestion of HCP webhooks.
+
+HousecallProWebhookBatchView accepts many events in one POST, either as a JSON
+array or as NDJSON (one JSON object per line):
+
+    [{"event": "customer.created", ...}, {"event": "job.created", ...}]
+
+NDJSON is read one line at a time, see core/ingest.py. Every event is checked
+like a single delivery (parsed, deduplicated), then all of them are stored
+with one bulk_create and the company mappings of the batch are loaded into
+the mapping cache with one query. With HCP_WEBHOOK_ASYNC each
+stored row goes to the lane of its customer/job as usual. Otherwise the batch
+is processed right away on HCP_WEBHOOK_BATCH_CONCURRENCY in-process lanes,
+grouped by (company, entity) so events of one customer/job keep their order,
+and the outcomes are written back with one bulk_update.
+
+The response has one result per item, in request order:
+
+    {"index": 0, "status": "processed", "webhook_id": 12, "result": {...}}
+
+status is one of accepted, processed, failed, duplicate, ignored or invalid.
+"""
+import logging
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .cache import warm_company_mappings
+from .dedup import forget_webhook, is_duplicate_webhook
+from .dispatch import PartitionedDispatcher, dispatch_webhook, partition_key
+from .ingest import envelope, iter_body_lines, loads
+from .metrics import HCP_WEBHOOK_VIEW_SECONDS, timed
+from .models import Webhook
+from .services import HousecallProWebhookService
+
+logger = logging.getLogger(__name__)
+
+# (payload, raw JSON bytes if kept, parse error) per item of a batch body
+BatchItem = Tuple[Optional[Dict[str, Any]], Optional[bytes], Optional[str]]
+
+
+class BatchTooLarge(ValueError):
+    pass
+
+
+def _item(value: Any, raw: Optional[bytes] = None) -> BatchItem:
+    if isinstance(value, dict):
+        return value, raw, None
+    return None, None, "Item is not a JSON object"
+
+
+def parse_batch(request, max_items: int = None) -> List[BatchItem]:
+    """Read a JSON array or NDJSON body into items.
+
+    NDJSON is read and parsed one line at a time and each item keeps its line
+    as raw bytes. A malformed array fails the whole batch with ValueError, a
+    malformed NDJSON line only fails its own item. Raises BatchTooLarge above
+    max_items and BodyTooLarge above the byte limits.
+    """
+    max_items = max_items or settings.HCP_WEBHOOK_BATCH_MAX_ITEMS
+    items = []
+    for number, line in enumerate(iter_body_lines(request)):
+        if number == 0 and line.lstrip().startswith(b'['):
+            values = loads(line)
+            if len(values) > max_items:
+                raise BatchTooLarge(f"Batch has {len(values)} items, the limit is {max_items}")
+            return [_item(value) for value in values]
+        if len(items) >= max_items:
+            raise BatchTooLarge(f"Batch has more than {max_items} items")
+        try:
+            items.append(_item(loads(line), line.strip()))
+        except ValueError as e:
+            items.append((None, None, f"Invalid JSON: {e}"))
+    return items
+
+
+def _process_stored(webhook: Webhook, webhook_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one stored webhook and set its outcome on the instance, saved later in bulk"""
+    try:
+        result = HousecallProWebhookService().process_webhook(webhook_data)
+    except Exception as e:
+        logger.exception(f"Batch webhook {webhook.id} raised")
+        result = {"error": str(e)}
+    webhook.status = Webhook.STATUS_FAILED if result.get('error') else Webhook.STATUS_PROCESSED
+    webhook.result = result
+    webhook.processed_at = timezone.now()
+    return result
+
+
+def ingest_batch(items: List[BatchItem]) -> Dict[str, Any]:
+    """Store, then dispatch or process, the items of a batch, returns the per-item results"""
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    accepted = []
+    with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='dedup'):
+        for index, (webhook_data, raw, error) in enumerate(items):
+            if error:
+                results[index] = {"index": index, "status": "invalid", "error": error}
+            elif "foo" in webhook_data:
+                # HCP's test delivery, acknowledged like the single-event endpoint does
+                results[index] = {"index": index, "status": "ignored"}
+            elif is_duplicate_webhook(webhook_data):
+                results[index] = {"index": index, "status": "duplicate"}
+            else:
+                accepted.append((index, webhook_data, raw))
+
+    try:
+        _store_accepted(accepted, results)
+    except Exception:
+        # Nothing of the batch is acknowledged, release the claims so HCP's retry goes through
+        for _, webhook_data, _ in accepted:
+            forget_webhook(webhook_data)
+        raise
+
+    counts = Counter(result['status'] for result in results)
+    logger.info(f"Webhook batch of {len(items)}: {dict(counts)}")
+    return {"received": len(items), "counts": dict(counts), "results": results}
+
+
+def _store_accepted(accepted: List[Tuple[int, Dict[str, Any], Optional[bytes]]], results: List[Optional[Dict[str, Any]]]):
+    """Store the accepted items, then dispatch or process them, filling in their results"""
+    if accepted:
+        with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='store'):
+            webhooks = Webhook.objects.bulk_create([
+                # NDJSON lines are stored as received, array items have no bytes of their own
+                Webhook(event=webhook_data.get('event'), company_id=webhook_data.get('company_id'),
+                        payload=None if raw else webhook_data, raw_payload=raw)
+                for _, webhook_data, raw in accepted
+            ])
+        warm_company_mappings({webhook_data.get('company_id') for _, webhook_data, _ in accepted})
+        if settings.HCP_WEBHOOK_ASYNC:
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='dispatch'):
+                _dispatch_all(webhooks, [envelope(webhook_data) for _, webhook_data, _ in accepted])
+            for (index, _, _), webhook in zip(accepted, webhooks):
+                results[index] = {"index": index, "status": "accepted", "webhook_id": webhook.id}
+        else:
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='process'):
+                outcomes = _process_all(webhooks, [webhook_data for _, webhook_data, _ in accepted])
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='store'):
+                Webhook.objects.bulk_update(webhooks, ['status', 'result', 'processed_at'])
+            for (index, webhook_data, _), webhook, result in zip(accepted, webhooks, outcomes):
+                results[index] = {"index": index, "status": webhook.status, "webhook_id": webhook.id, "result": result}
+                if webhook.status == Webhook.STATUS_FAILED:
+                    forget_webhook(webhook_data)
+
+
+def _dispatch_all(webhooks: List[Webhook], payloads: List[Dict[str, Any]]):
+    """Enqueue every stored webhook on its lane once the rows are committed, in arrival order.
+
+    The rows are stored and acknowledged by then, so a webhook that can't be
+    enqueued is logged and stays pending for replay_webhooks --status pending
+    instead of failing the batch.
+    """
+    def dispatch():
+        undispatched = []
+        for webhook, webhook_data in zip(webhooks, payloads):
+            try:
+                dispatch_webhook(webhook.id, webhook_data)
+            except Exception:
+                logger.exception(f"Could not dispatch batch webhook {webhook.id}")
+                undispatched.append(webhook.id)
+        if undispatched:
+            logger.error(f"{len(undispatched)} batch webhooks left pending, not dispatched: {undispatched}")
+
+    transaction.on_commit(dispatch)
+
+
+def _process_all(webhooks: List[Webhook], payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Process stored webhooks, each (company, entity) group in order and groups in parallel"""
+    groups = len({partition_key(webhook_data) for webhook_data in payloads})
+    lanes = min(settings.HCP_WEBHOOK_BATCH_CONCURRENCY, groups)
+    if lanes <= 1:
+        return [_process_stored(webhook, webhook_data) for webhook, webhook_data in zip(webhooks, payloads)]
+    with PartitionedDispatcher(lanes=lanes) as dispatcher:
+        futures = [
+            dispatcher.submit_webhook(webhook_data, _process_stored, webhook, webhook_data)
+            for webhook, webhook_data in zip(webhooks, payloads)
+        ]
+    return [future.result() for future in futures]
@@ -0,0 +1,49 @@
+"""Realistic HCP webhook streams for load tests.
+
+A customer's lifecycle follows the order HCP sends events in:
+
+    customer.created -> estimate.created -> estimate.option.created -> estimate.sent
+    -> estimate.option.approval_status_changed -> estimate.copy_to_job -> job.created
+    -> job.scheduled -> job.on_my_way -> job.started -> job.completed -> job.paid
+
+Some customers get extra customer.updated/job.updated events, some jobs are
+canceled instead of completed, and some customers never accept the estimate.
+Lifecycles are returned separately so a runner can play different customers
+in parallel while keeping each customer's events in order.
+"""
+import random
+from typing import Any, Dict, List
+from .payloads import sample_webhook
+
+ESTIMATE_EVENTS = ['estimate.created', 'estimate.option.created', 'estimate.sent']
+ACCEPT_EVENTS = ['estimate.option.approval_status_changed', 'estimate.copy_to_job', 'job.created']
+JOB_PROGRESS_EVENTS = ['job.scheduled', 'job.on_my_way', 'job.started']
+
+
+def customer_lifecycle(company_id: str, index: int, rng: random.Random, update_rate: float = 0.3,
+                       decline_rate: float = 0.2, cancel_rate: float = 0.1) -> List[Dict[str, Any]]:
+    """Webhooks of one customer, in the order HCP would send them"""
+    ids = {
+        'customer_id': f'{company_id}-cus{index}',
+        'estimate_id': f'{company_id}-est{index}',
+        'job_id': f'{company_id}-job{index}',
+    }
+    events = ['customer.created']
+    if rng.random() < update_rate:
+        events.append('customer.updated')
+    events += ESTIMATE_EVENTS
+    if rng.random() >= decline_rate:
+        events += ACCEPT_EVENTS + JOB_PROGRESS_EVENTS
+        if rng.random() < update_rate:
+            events.insert(len(events) - 1, 'job.updated')
+        events += ['job.canceled'] if rng.random() < cancel_rate else ['job.completed', 'job.paid']
+    return [sample_webhook(event, company_id, from_estimate=True, **ids) for event in events]
+
+
+def event_mix(company_ids: List[str], customers: int, seed: int = None, **rates) -> List[List[Dict[str, Any]]]:
+    """Lifecycles of customers spread round-robin over company_ids, rates go to customer_lifecycle"""
+    rng = random.Random(seed)
+    return [
+        customer_lifecycle(company_ids[index % len(company_ids)], index, rng, **rates)
+        for index in range(customers)
+    ]
@@ -0,0 +1,177 @@
+"""Local stand-in for the GoHighLevel endpoints used by GoHighLevelService.
+
+Latency, jitter and failure injection are set per server. Failures are drawn
+per request, in this order: 429 (rate_limit_rate), 401 (unauthorized_rate),
+503 (error_rate). Every request is recorded as a StubRequest.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# body is only kept when the server records bodies
+StubRequest = namedtuple('StubRequest', ['method', 'path', 'status', 'body'])
+
+
+class _GHLStubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep the connection alive between calls
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        ('POST', re.compile(r'^/contacts/?$'), 'contact'),
+        ('POST', re.compile(r'^/contacts/upsert$'), 'contact'),
+        ('GET', re.compile(r'^/contacts/search/duplicate$'), 'duplicate'),
+        ('GET', re.compile(r'^/contacts/?$'), 'contacts'),
+        ('PUT', re.compile(r'^/contacts/[^/]+$'), 'contact'),
+        ('DELETE', re.compile(r'^/contacts/[^/]+$'), None),
+        ('POST', re.compile(r'^/opportunities/?$'), 'opportunity'),
+        ('GET', re.compile(r'^/opportunities/search$'), 'opportunities'),
+        ('PUT', re.compile(r'^/opportunities/[^/]+$'), 'opportunity'),
+        ('POST', re.compile(r'^/oauth/token$'), 'token'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        delay = server.latency + (server.rng_uniform(0, server.jitter) if server.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        path = self.path.split('?', 1)[0]
+        status, payload, headers = self._respond(path, body)
+        server.record(self.command, self.path, status, body)
+        return self._send(status, payload, headers)
+
+    def _respond(self, path, body):
+        server = self.server
+        fault = server.draw_fault() if path != '/oauth/token' else None
+        if fault == 429:
+            return 429, {'message': 'Too many requests'}, {'Retry-After': str(server.retry_after)}
+        if fault == 401:
+            return 401, {'message': 'Invalid JWT'}, {}
+        if fault == 503:
+            return 503, {'message': 'Service unavailable'}, {}
+
+        for method, pattern, entity in self.ROUTES:
+            if method == self.command and pattern.match(path):
+                payload = {'succeded': True}
+                if entity == 'token':
+                    payload = {
+                        'access_token': uuid.uuid4().hex, 'refresh_token': uuid.uuid4().hex,
+                        'expires_in': 86399, 'token_type': 'Bearer',
+                    }
+                elif entity == 'opportunities':
+                    payload[entity] = []
+                elif entity == 'duplicate':
+                    # Every customer is new to the stub
+                    payload['contact'] = None
+                elif entity == 'contacts':
+                    payload.update(contacts=[], meta={'total': 0, 'startAfterId': None, 'startAfter': None})
+                elif entity:
+                    payload[entity] = {'id': uuid.uuid4().hex[:20]}
+                return 200, payload, {}
+        return 404, {'message': f'No stub for {self.command} {path}'}, {}
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class GHLStubServer(ThreadingHTTPServer):
+    """Threaded stub server, use as a context manager to run it in the background.
+
+        with GHLStubServer(latency=0.02, rate_limit_rate=0.01) as stub:
+            GoHighLevelService.BASE_URL = stub.url
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, handshake: float = 0.0,
+                 jitter: float = 0.0, rate_limit_rate: float = 0.0, unauthorized_rate: float = 0.0,
+                 error_rate: float = 0.0, retry_after: float = 0, record_bodies: bool = False, seed: int = None):
+        super().__init__((host, port), _GHLStubHandler)
+        self.latency = latency
+        # Extra latency drawn uniformly from [0, jitter] per request
+        self.jitter = jitter
+        # Delay before the first response on a new connection, stands in for TCP+TLS setup
+        self.handshake = handshake
+        self.rate_limit_rate = rate_limit_rate
+        self.unauthorized_rate = unauthorized_rate
+        self.error_rate = error_rate
+        # Retry-After seconds sent with injected 429s
+        self.retry_after = retry_after
+        self.record_bodies = record_bodies
+        self.requests = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def token_url(self) -> str:
+        return f'{self.url}/oauth/token'
+
+    def rng_uniform(self, low: float, high: float) -> float:
+        with self._lock:
+            return self._rng.uniform(low, high)
+
+    def draw_fault(self):
+        """Status of the failure to inject for one request, None to answer normally"""
+        with self._lock:
+            roll = self._rng.random()
+        for status, rate in ((429, self.rate_limit_rate), (401, self.unauthorized_rate), (503, self.error_rate)):
+            if roll < rate:
+                return status
+            roll -= rate
+        return None
+
+    def record(self, method: str, path: str, status: int = 200, body: bytes = b''):
+        request = StubRequest(method, path, status, body if self.record_bodies else None)
+        with self._lock:
+            self.requests.append(request)
+
+    def status_counts(self) -> Counter:
+        with self._lock:
+            return Counter(request.status for request in self.requests)
+
+    def process_request_thread(self, request, client_address):
+        if self.handshake:
+            time.sleep(self.handshake)
+        super().process_request_thread(request, client_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,73 @@
+"""Sample HCP webhook payloads for every event HousecallProWebhookService handles"""
+import zlib
+from typing import Any, Dict, List
+
+CUSTOMER_EVENTS = ['customer.created', 'customer.updated', 'customer.deleted']
+ESTIMATE_EVENTS = [
+    'estimate.created', 'estimate.updated', 'estimate.scheduled', 'estimate.on_my_way', 'estimate.completed',
+    'estimate.sent', 'estimate.copy_to_job', 'estimate.option.created', 'estimate.option.approval_status_changed',
+]
+JOB_EVENTS = [
+    'job.created', 'job.updated', 'job.scheduled', 'job.on_my_way', 'job.started', 'job.completed',
+    'job.canceled', 'job.deleted', 'job.paid',
+]
+APPOINTMENT_EVENTS = [
+    'job.appointment.scheduled', 'job.appointment.rescheduled', 'job.appointment.appointment_discarded',
+    'job.appointment.appointment_pros_assigned', 'job.appointment.appointment_pros_unassigned',
+]
+EVENT_TYPES: List[str] = CUSTOMER_EVENTS + ESTIMATE_EVENTS + JOB_EVENTS + APPOINTMENT_EVENTS
+
+
+def sample_customer(customer_id: str = 'cus_sample') -> Dict[str, Any]:
+    return {
+        'id': customer_id,
+        'first_name': 'Jane',
+        'last_name': 'Sample',
+        'email': f'{customer_id}@example.com',
+        # Distinct per customer, a shared number would match every customer to one GHL contact
+        'mobile_number': f"555{zlib.crc32(customer_id.encode()) % 10 ** 7:07d}",
+        'home_number': '5557654321',
+        'company': 'Sample Co',
+        'lead_source': 'HousecallPro',
+        'tags': ['residential'],
+    }
+
+
+def sample_estimate(estimate_id: str = 'est_sample', customer_id: str = 'cus_sample') -> Dict[str, Any]:
+    return {
+        'id': estimate_id,
+        'estimate_number': '1001',
+        'customer': sample_customer(customer_id),
+        'options': [{'id': f'{estimate_id}_opt', 'total_amount': 45000, 'approval_status': 'approved'}],
+        'total_amount': 45000,
+    }
+
+
+def sample_job(job_id: str = 'job_sample', customer_id: str = 'cus_sample', estimate_id: str = None) -> Dict[str, Any]:
+    return {
+        'id': job_id,
+        'invoice_number': '2001',
+        'customer': sample_customer(customer_id),
+        'total_amount': 52000,
+        'work_status': 'scheduled',
+        'original_estimate_id': estimate_id,
+    }
+
+
+def sample_webhook(event_type: str, company_id: str, customer_id: str = 'cus_sample',
+                   estimate_id: str = 'est_sample', job_id: str = 'job_sample',
+                   from_estimate: bool = False) -> Dict[str, Any]:
+    """Webhook body HCP would send for event_type, entities use the given ids.
+
+    from_estimate makes job payloads point at estimate_id, as for jobs copied from an estimate.
+    """
+    webhook = {'event': event_type, 'company_id': company_id}
+    if event_type.startswith('customer.'):
+        webhook['customer'] = sample_customer(customer_id)
+    elif event_type.startswith('estimate.'):
+        webhook['estimate'] = sample_estimate(estimate_id, customer_id)
+    elif event_type.startswith('job.appointment.'):
+        webhook['appointment'] = {'id': f'{job_id}_appt', 'job_id': job_id, 'start_time': '2025-01-01T15:00:00Z'}
+    else:
+        webhook['job'] = sample_job(job_id, customer_id, estimate_id if from_estimate else None)
+    return webhook
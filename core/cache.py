@@ -0,0 +1,137 @@
+"""Two-tier cache for HCP company -> GHL mapping lookups.
+
+The in-process tier keeps the mapping (with its credentials already loaded)
+for HCP_MAPPING_CACHE_TTL seconds, the shared tier is the Django cache (Redis)
+and keeps it for HCP_MAPPING_SHARED_CACHE_TTL. Anything that changes a mapping
+or its credentials must call invalidate_company_mapping/invalidate_credentials.
+The local tier of other processes is only cleared by its (short) TTL.
+
+When the shared tier is unreachable lookups fall through to the database, the
+same way dedup, coalescing and the rate limiter carry on without Redis.
+"""
+import logging
+import threading
+import time
+from typing import Any, Hashable, Iterable, Optional
+from django.conf import settings
+from django.core.cache import cache
+from .metrics import HCP_MAPPING_LOOKUP_SECONDS, timed
+from .models import GHLAuthCredentials, HCPToGHLMapping
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Small thread-safe in-process cache with per-entry expiry"""
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            with self._lock:
+                self._data.pop(key, None)
+            return None
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                # Drop expired entries first, then the oldest one
+                now = time.monotonic()
+                for stale in [k for k, (_, exp) in self._data.items() if exp < now]:
+                    del self._data[stale]
+                if len(self._data) >= self.maxsize:
+                    del self._data[next(iter(self._data))]
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_mapping_cache = TTLCache(ttl=settings.HCP_MAPPING_CACHE_TTL)
+
+
+def _shared_key(hcp_company_id: str) -> str:
+    return f"hcp:mapping:{hcp_company_id}"
+
+
+def _shared(operation: str, *args, default=None):
+    """Call a method of the shared cache, default when the cache is down"""
+    try:
+        return getattr(cache, operation)(*args)
+    except Exception as e:
+        logger.warning(f"Mapping cache unavailable for {operation}, using the database: {e}")
+        return default
+
+
+def get_company_mapping(hcp_company_id: str) -> HCPToGHLMapping:
+    """Return the mapping for an HCP company with ghl_credentials loaded.
+
+    Raises HCPToGHLMapping.DoesNotExist like a plain .get() would.
+    """
+    with timed(HCP_MAPPING_LOOKUP_SECONDS, tier='local') as span:
+        mapping = _mapping_cache.get(hcp_company_id)
+        if mapping is not None:
+            return mapping
+
+        span['tier'] = 'shared'
+        mapping = _shared('get', _shared_key(hcp_company_id))
+        if mapping is None:
+            span['tier'] = 'db'
+            mapping = HCPToGHLMapping.objects.select_related('ghl_credentials').get(hcp_company_id=hcp_company_id)
+            _shared('set', _shared_key(hcp_company_id), mapping, settings.HCP_MAPPING_SHARED_CACHE_TTL)
+
+        _mapping_cache.set(hcp_company_id, mapping)
+        return mapping
+
+
+def invalidate_company_mapping(hcp_company_id: str):
+    _mapping_cache.delete(hcp_company_id)
+    _shared('delete', _shared_key(hcp_company_id))
+
+
+def invalidate_credentials(credentials: GHLAuthCredentials):
+    """Drop every cached mapping that points at these credentials"""
+    company_ids = HCPToGHLMapping.objects.filter(ghl_credentials=credentials).values_list('hcp_company_id', flat=True)
+    for hcp_company_id in company_ids:
+        invalidate_company_mapping(hcp_company_id)
+
+
+def warm_company_mappings(hcp_company_ids: Iterable[str]) -> int:
+    """Load the mappings of several companies into both tiers at once, returns how many were loaded.
+
+    One get_many on the shared tier and one query for what it doesn't have,
+    instead of one lookup per company. Unknown companies are skipped, their
+    webhooks fail in get_company_mapping as usual.
+    """
+    missing = {company_id for company_id in hcp_company_ids if company_id and _mapping_cache.get(company_id) is None}
+    if not missing:
+        return 0
+    loaded = 0
+    for mapping in _shared('get_many', [_shared_key(company_id) for company_id in missing], default={}).values():
+        _mapping_cache.set(mapping.hcp_company_id, mapping)
+        missing.discard(mapping.hcp_company_id)
+        loaded += 1
+    if missing:
+        mappings = list(HCPToGHLMapping.objects.select_related('ghl_credentials').filter(hcp_company_id__in=missing))
+        _shared(
+            'set_many',
+            {_shared_key(mapping.hcp_company_id): mapping for mapping in mappings}, settings.HCP_MAPPING_SHARED_CACHE_TTL,
+        )
+        for mapping in mappings:
+            _mapping_cache.set(mapping.hcp_company_id, mapping)
+        loaded += len(mappings)
+    return loaded
@@ -0,0 +1,155 @@
+"""Coalescing of bursty job progress and appointment webhooks.
+
+A job visit sends job.scheduled, job.appointment.scheduled,
+job.appointment.appointment_pros_assigned, job.on_my_way and job.started
+within seconds. Instead of running a handler for each, the lane worker buffers
+them per (company_id, job_id) for HCP_COALESCE_WINDOW_SECONDS and then applies
+the net result once: the pipeline stage of the last event together with the
+latest job payload (amounts, name).
+
+Events that create or settle a job are never buffered. Settling events
+(completed, paid, canceled, deleted) drop the pending buffer of their job so a
+late flush can't move a closed opportunity back to an earlier stage.
+
+Only the Celery path buffers. Job and appointment events of a job run in the
+lane of its customer (see core/dispatch.py), one at a time, so buffer reads
+and writes for a job never race. Buffers hold
+webhook ids only, the payloads stay on the Webhook rows.
+"""
+import logging
+import time
+import uuid
+from typing import Any, Dict, Optional
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .models import Webhook
+from .services import CLOSING_EVENT_STATUS, HousecallProWebhookService
+
+logger = logging.getLogger(__name__)
+
+COALESCED_EVENTS = {
+    'job.updated',
+    'job.scheduled',
+    'job.on_my_way',
+    'job.started',
+    'job.appointment.scheduled',
+    'job.appointment.rescheduled',
+    'job.appointment.appointment_discarded',
+    'job.appointment.appointment_pros_assigned',
+    'job.appointment.appointment_pros_unassigned',
+}
+
+
+def _job_id(webhook_data: Dict[str, Any]) -> Optional[str]:
+    return (webhook_data.get('job') or {}).get('id') or (webhook_data.get('appointment') or {}).get('job_id')
+
+
+def _buffer_key(company_id: str, job_id: str) -> str:
+    return f"hcp:coalesce:{company_id}:{job_id}"
+
+
+def buffer_webhook(webhook: Webhook) -> Optional[Dict[str, Any]]:
+    """Add a stored webhook to the pending buffer of its job.
+
+    Returns None if the webhook has to be processed right away, otherwise the
+    buffer, whose 'token' must be passed to flush_buffer when a new buffer was
+    started ('new' is True).
+    """
+    window = settings.HCP_COALESCE_WINDOW_SECONDS
+    payload = webhook.get_payload()
+    job_id = _job_id(payload)
+    if window <= 0 or payload.get('event') not in COALESCED_EVENTS or not job_id:
+        return None
+
+    key = _buffer_key(webhook.company_id, job_id)
+    try:
+        buffer = cache.get(key)
+        new = buffer is None
+        if new:
+            buffer = {'job_id': job_id, 'webhook_ids': [], 'job_webhook_id': None}
+        elif time.time() > buffer['flush_at'] + window:
+            # The scheduled flush never applied it (lost task, failed retries), schedule another
+            new = True
+        if new:
+            buffer['token'] = uuid.uuid4().hex
+            buffer['flush_at'] = time.time() + window
+        buffer['webhook_ids'].append(webhook.id)
+        buffer['last_webhook_id'] = webhook.id
+        if payload.get('job'):
+            buffer['job_webhook_id'] = webhook.id
+        # Outlives the window by a wide margin so a slow flush still finds it
+        cache.set(key, buffer, timeout=window * 10 + 300)
+    except Exception as e:
+        logger.warning(f"Coalescing cache unavailable, processing webhook {webhook.id} now: {e}")
+        return None
+
+    webhook.status = Webhook.STATUS_COALESCED
+    webhook.result = {"message": "Buffered for coalescing", "job_id": job_id}
+    webhook.save(update_fields=['status', 'result'])
+    return dict(buffer, new=new)
+
+
+def discard_buffer(webhook: Webhook):
+    """Drop the pending buffer of a job that is being settled by this webhook"""
+    payload = webhook.get_payload()
+    job_id = _job_id(payload)
+    if payload.get('event') not in CLOSING_EVENT_STATUS or not job_id:
+        return
+
+    key = _buffer_key(webhook.company_id, job_id)
+    try:
+        buffer = cache.get(key)
+        if buffer is None:
+            return
+        cache.delete(key)
+    except Exception as e:
+        logger.warning(f"Coalescing cache unavailable, could not drop buffer of job {job_id}: {e}")
+        return
+
+    Webhook.objects.filter(id__in=buffer['webhook_ids']).update(
+        status=Webhook.STATUS_COALESCED, result={"coalesced_into": webhook.id}, processed_at=timezone.now()
+    )
+    logger.info(f"Dropped {len(buffer['webhook_ids'])} buffered events of job {job_id}, superseded by {webhook.event}")
+
+
+def flush_buffer(company_id: str, job_id: str, token: str) -> Optional[Dict[str, Any]]:
+    """Apply the net state of a job's buffered events with one handler run.
+
+    Returns None if the buffer was already flushed, dropped or replaced by a
+    newer one. The buffer is only removed once the handler returned, so a
+    retried flush after an exception sees it again.
+    """
+    key = _buffer_key(company_id, job_id)
+    buffer = cache.get(key)
+    if buffer is None or buffer['token'] != token:
+        return None
+
+    webhooks = Webhook.objects.in_bulk(buffer['webhook_ids'])
+    last = webhooks.get(buffer['last_webhook_id'])
+    if last is None:
+        cache.delete(key)
+        return None
+    # Latest job payload for amounts and name, stage of the latest event
+    base = webhooks.get(buffer['job_webhook_id']) or last
+
+    try:
+        result = HousecallProWebhookService().process_webhook(base.get_payload(), stage_event=last.event)
+    except Exception as e:
+        last.status = Webhook.STATUS_FAILED
+        last.result = {"error": str(e), "coalesced": len(webhooks)}
+        last.processed_at = timezone.now()
+        last.save(update_fields=['status', 'result', 'processed_at'])
+        raise
+    cache.delete(key)
+
+    now = timezone.now()
+    Webhook.objects.filter(id__in=[webhook_id for webhook_id in webhooks if webhook_id != last.id]).update(
+        status=Webhook.STATUS_COALESCED, result={"coalesced_into": last.id}, processed_at=now
+    )
+    last.status = Webhook.STATUS_FAILED if result.get('error') else Webhook.STATUS_PROCESSED
+    last.result = dict(result, coalesced=len(webhooks))
+    last.processed_at = now
+    last.save(update_fields=['status', 'result', 'processed_at'])
+    logger.info(f"Applied {len(webhooks)} coalesced events of job {job_id} as {last.event}")
+    return last.result
@@ -0,0 +1,189 @@
+"""Local index of GHL contacts by normalized email and phone, per location.
+
+Tenants often have their customers in GHL already (forms, imports, other
+integrations), and creating a contact for every new HCP customer duplicates
+them. Before a contact is created, the customer's email and mobile number (the
+fields GHL matches duplicates on) are looked up here with one indexed query:
+
+    email:jane@example.com    -> GHL contact id
+    phone:+15551234567        -> GHL contact id
+
+An email match wins over a phone match. On a miss, GHL's duplicate search is
+asked as well (GHL_CONTACT_DEDUP_SEARCH) and its answer is indexed. A match
+that another HCP customer is already mapped to is skipped, and the customer
+gets a contact of its own (created, not upserted, so GHL doesn't merge them). Contacts
+are indexed when the outbox creates them, when they are updated and by the
+sync_ghl_contacts command, which pages through a location's GHL contacts.
+Phone numbers without a country code get GHL_PHONE_DEFAULT_COUNTRY_CODE.
+"""
+import logging
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from django.conf import settings
+from django.utils import timezone
+from .models import ContactMapping, GHLContactIndex
+
+logger = logging.getLogger(__name__)
+
+EMAIL_PREFIX = 'email:'
+PHONE_PREFIX = 'phone:'
+
+_NON_DIGITS = re.compile(r'\D')
+
+
+def normalize_email(value: Any) -> Optional[str]:
+    if not isinstance(value, str):
+        return None
+    email = value.strip().lower()
+    return email if '@' in email else None
+
+
+def normalize_phone(value: Any, country_code: str = None) -> Optional[str]:
+    """E.164 form of a phone number, None when it can't be one"""
+    if not isinstance(value, str):
+        return None
+    country_code = country_code or settings.GHL_PHONE_DEFAULT_COUNTRY_CODE
+    raw = value.strip()
+    digits = _NON_DIGITS.sub('', raw)
+    if raw.startswith('+'):
+        pass
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    elif len(digits) > 10 and digits.startswith(country_code):
+        # Country code without the +, e.g. 15551234567
+        pass
+    else:
+        # National number, dropping the trunk prefix used outside NANP
+        digits = country_code + digits.lstrip('0')
+    if not 8 <= len(digits) <= 15:
+        return None
+    return f"+{digits}"
+
+
+def contact_keys(email: Any = None, phone: Any = None) -> List[str]:
+    """Index keys in match order, email first"""
+    keys = []
+    email = normalize_email(email)
+    if email:
+        keys.append(EMAIL_PREFIX + email)
+    phone = normalize_phone(phone)
+    if phone:
+        keys.append(PHONE_PREFIX + phone)
+    return keys
+
+
+def customer_keys(customer_data: Dict[str, Any]) -> List[str]:
+    """Keys of an HCP customer, from the fields build_contact_payload sends as email and phone"""
+    return contact_keys(customer_data.get('email'), customer_data.get('mobile_number'))
+
+
+def _upsert(rows: List[GHLContactIndex]):
+    if rows:
+        GHLContactIndex.objects.bulk_create(
+            rows, update_conflicts=True, unique_fields=['ghl_location_id', 'key'],
+            update_fields=['ghl_contact_id', 'updated_at'],
+        )
+
+
+def index_contact(location_id: str, contact_id: str, keys: Iterable[str]):
+    """Point keys at a contact, one upsert query"""
+    _upsert([GHLContactIndex(ghl_location_id=location_id, key=key, ghl_contact_id=contact_id) for key in keys])
+
+
+def index_ghl_contacts(location_id: str, contacts: Iterable[Dict[str, Any]]) -> int:
+    """Index contacts as GHL returns them, returns how many keys were written"""
+    rows = {}
+    for contact in contacts:
+        if not contact.get('id'):
+            continue
+        for key in contact_keys(contact.get('email'), contact.get('phone')):
+            rows[key] = GHLContactIndex(ghl_location_id=location_id, key=key, ghl_contact_id=contact['id'])
+    _upsert(list(rows.values()))
+    return len(rows)
+
+
+def unindex_contact(location_id: str, contact_id: str):
+    GHLContactIndex.objects.filter(ghl_location_id=location_id, ghl_contact_id=contact_id).delete()
+
+
+def find_indexed_contact(location_id: str, keys: List[str]) -> Optional[str]:
+    """GHL contact id of the first key that is indexed"""
+    if not keys:
+        return None
+    found = dict(GHLContactIndex.objects.filter(ghl_location_id=location_id, key__in=keys).values_list('key', 'ghl_contact_id'))
+    for key in keys:
+        if key in found:
+            return found[key]
+    return None
+
+
+def mapped_to_other_customer(mapping, contact_id: str, hcp_customer_id: str) -> bool:
+    return ContactMapping.objects.filter(
+        ghl_location_id=mapping.ghl_location_id, ghl_contact_id=contact_id
+    ).exclude(hcp_company_id=mapping.hcp_company_id, hcp_customer_id=hcp_customer_id).exists()
+
+
+def search_ghl_duplicate(ghl_service, location_id: str, keys: List[str]) -> Optional[Dict[str, Any]]:
+    """GHL's duplicate search for the email and phone among keys, GHL calls only"""
+    email = next((key[len(EMAIL_PREFIX):] for key in keys if key.startswith(EMAIL_PREFIX)), None)
+    phone = next((key[len(PHONE_PREFIX):] for key in keys if key.startswith(PHONE_PREFIX)), None)
+    contact = ghl_service.search_duplicate_contact(location_id, email=email, phone=phone)
+    if contact and contact.get('id'):
+        logger.info(f"GHL duplicate search matched contact {contact['id']} in location {location_id}")
+        return contact
+    return None
+
+
+def find_existing_contact(ghl_service, mapping, customer_data: Dict[str, Any]) -> Tuple[Optional[str], bool]:
+    """A GHL contact that already has the customer's email or phone, from the index or GHL.
+
+    Returns (contact id to adopt, whether a match was skipped). A contact that
+    another HCP customer is mapped to is never adopted, the customer gets a
+    contact of its own instead of overwriting or deleting the other one's.
+    """
+    location_id = mapping.ghl_location_id
+    keys = customer_keys(customer_data)
+    if not keys:
+        return None, False
+    contact_id = find_indexed_contact(location_id, keys)
+    if not contact_id and settings.GHL_CONTACT_DEDUP_SEARCH:
+        contact = search_ghl_duplicate(ghl_service, location_id, keys)
+        if contact:
+            index_ghl_contacts(location_id, [contact])
+            contact_id = contact['id']
+    if not contact_id:
+        return None, False
+    if mapped_to_other_customer(mapping, contact_id, customer_data.get('id')):
+        logger.info(f"GHL contact {contact_id} matching HCP customer {customer_data.get('id')} "
+                    f"belongs to another customer, not adopting it")
+        return None, True
+    return contact_id, False
+
+
+def sync_location_contacts(mapping, page_size: int = 100, prune: bool = False) -> Dict[str, int]:
+    """Index every GHL contact of a company mapping's location, page by page.
+
+    With prune, keys not seen (or written by a webhook) during the sync are
+    dropped afterwards. Raises requests exceptions when a page can't be read.
+    """
+    from .services import GoHighLevelService
+
+    credentials = mapping.ghl_credentials
+    location_id = mapping.ghl_location_id
+    service = GoHighLevelService(credentials.access_token, '', credentials=credentials, location_id=location_id)
+    started = timezone.now()
+    stats = {'contacts': 0, 'keys': 0, 'pruned': 0}
+    start_after_id = start_after = None
+    while True:
+        page = service.list_contacts(location_id, limit=page_size, start_after_id=start_after_id, start_after=start_after)
+        contacts = page.get('contacts') or []
+        stats['contacts'] += len(contacts)
+        stats['keys'] += index_ghl_contacts(location_id, contacts)
+        meta = page.get('meta') or {}
+        if len(contacts) < page_size or not meta.get('startAfterId'):
+            break
+        start_after_id, start_after = meta['startAfterId'], meta.get('startAfter')
+    if prune:
+        stats['pruned'], _ = GHLContactIndex.objects.filter(ghl_location_id=location_id, updated_at__lt=started).delete()
+    logger.info(f"Synced contact index of location {location_id}: {stats}")
+    return stats
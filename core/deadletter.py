@@ -0,0 +1,198 @@
+"""Dead-letter store for GHL updates and deletes that failed.
+
+GoHighLevelService records every failed PUT/DELETE as a GHLDeadLetter with the
+raw request (method, url, JSON body), the error class and the HTTP status.
+Creates are not recorded here, they already retry through core/outbox.py.
+
+Network errors, timeouts, 408, 429 and 5xx are retried by the
+retry_ghl_dead_letters beat task with exponential backoff. Other 4xx responses
+won't succeed on a retry and are stored as failed right away, they can be
+requeued from the admin or the dead_letters command once the cause is fixed.
+
+A drain sends at most GHL_DEAD_LETTER_BATCH_SIZE requests, oldest first, and
+stops at the first network or 5xx failure, so a GHL that is still down gets
+one probe per drain instead of the whole backlog.
+
+Retries never regress newer data. When a later PUT/DELETE to the same URL
+succeeds, the fields it sent are dropped from the pending dead letters of
+that URL, and dead letters with nothing left are marked superseded. This
+includes dead letters a drain has claimed, and a retry re-reads the status
+and body of its dead letter right before sending.
+"""
+import logging
+from datetime import timedelta
+from typing import Any, Dict, Optional
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import GHLAuthCredentials, GHLDeadLetter
+from .ratelimit import retry_after
+
+logger = logging.getLogger(__name__)
+
+DEAD_LETTER_METHODS = ('PUT', 'DELETE')
+
+
+def is_retryable(status_code: Optional[int]) -> bool:
+    return status_code is None or status_code >= 500 or status_code in (408, 429)
+
+
+def _retry_delay(attempts: int, response: Optional[requests.Response] = None) -> timedelta:
+    delay = min(settings.GHL_DEAD_LETTER_RETRY_MAX, settings.GHL_DEAD_LETTER_RETRY_BASE * (2 ** (attempts - 1)))
+    # Not before GHL's Retry-After, which the client doesn't wait out when it is long
+    wait = retry_after(response) if response is not None else None
+    return timedelta(seconds=max(delay, wait or 0))
+
+
+def record_dead_letter(method: str, url: str, body: Optional[Dict[str, Any]], error: Exception, location_id: str = '',
+                       credentials: Optional[GHLAuthCredentials] = None, event_type: str = '') -> Optional[GHLDeadLetter]:
+    """Store a failed GHL request, never raises so callers keep their return-on-error behaviour"""
+    response = getattr(error, 'response', None)
+    status_code = response.status_code if response is not None else None
+    try:
+        dead_letter = GHLDeadLetter.objects.create(
+            method=method, url=url, body=body, location_id=location_id or '',
+            credentials=credentials, event_type=event_type or '',
+            error_class=type(error).__name__, error_message=str(error)[:2000], status_code=status_code,
+            status=GHLDeadLetter.STATUS_PENDING if is_retryable(status_code) else GHLDeadLetter.STATUS_FAILED,
+            next_attempt_at=timezone.now() + _retry_delay(1, response),
+        )
+    except Exception as e:
+        logger.error(f"Could not dead-letter failed GHL request {method} {url}: {e}")
+        return None
+    logger.warning(f"Dead-lettered GHL request {method} {url} ({dead_letter.error_class}, status {status_code})")
+    return dead_letter
+
+
+def supersede_dead_letters(method: str, url: str, body: Optional[Dict[str, Any]]):
+    """Drop what a successful request to url just wrote from the pending and failed dead letters of that url.
+
+    Claimed dead letters too, retry_dead_letter reads what is left before sending.
+    Failed ones so a later requeue can't replay stale fields.
+    """
+    now = timezone.now()
+    open_statuses = (GHLDeadLetter.STATUS_PENDING, GHLDeadLetter.STATUS_FAILED)
+    candidates = GHLDeadLetter.objects.filter(url=url, status__in=open_statuses)
+    for dead_letter in candidates:
+        if method == 'DELETE':
+            remaining = {}
+        elif dead_letter.method == 'DELETE':
+            # An update doesn't make a failed delete obsolete
+            continue
+        else:
+            remaining = {key: value for key, value in (dead_letter.body or {}).items() if key not in (body or {})}
+        if remaining:
+            if remaining != dead_letter.body:
+                GHLDeadLetter.objects.filter(id=dead_letter.id, status__in=open_statuses).update(body=remaining)
+        else:
+            GHLDeadLetter.objects.filter(id=dead_letter.id, status__in=open_statuses).update(
+                status=GHLDeadLetter.STATUS_SUPERSEDED, resolved_at=now
+            )
+
+
+def _claim(batch_size: int):
+    now = timezone.now()
+    with transaction.atomic():
+        dead_letters = list(
+            GHLDeadLetter.objects.select_for_update(skip_locked=True).filter(
+                Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+                status=GHLDeadLetter.STATUS_PENDING, next_attempt_at__lte=now,
+            ).order_by('id')[:batch_size]
+        )
+        GHLDeadLetter.objects.filter(id__in=[dead_letter.id for dead_letter in dead_letters]).update(
+            locked_until=now + timedelta(minutes=5)
+        )
+    return dead_letters
+
+
+def _credentials_for(dead_letter: GHLDeadLetter) -> Optional[GHLAuthCredentials]:
+    if dead_letter.credentials_id:
+        credentials = GHLAuthCredentials.objects.filter(id=dead_letter.credentials_id).first()
+        if credentials:
+            return credentials
+    return GHLAuthCredentials.objects.filter(location_id=dead_letter.location_id).first()
+
+
+def retry_dead_letter(dead_letter: GHLDeadLetter) -> bool:
+    """Replay one dead letter's request and record the outcome, returns False if it failed.
+
+    A dead letter superseded since it was claimed isn't sent.
+    """
+    from .services import GoHighLevelService
+
+    # A newer successful write may have trimmed or superseded it after the claim
+    dead_letter.refresh_from_db(fields=['status', 'body'])
+    if dead_letter.status != GHLDeadLetter.STATUS_PENDING:
+        logger.info(f"Dead letter {dead_letter.id} ({dead_letter.method} {dead_letter.url}) is {dead_letter.status}, not sending it")
+        return True
+
+    credentials = _credentials_for(dead_letter)
+    now = timezone.now()
+    attempts = dead_letter.attempts + 1
+    response = None
+    if credentials is None:
+        status_code, error = None, f"No GHL credentials for location {dead_letter.location_id}"
+    else:
+        service = GoHighLevelService(
+            credentials.access_token, dead_letter.event_type, credentials=credentials,
+            location_id=dead_letter.location_id or credentials.location_id, dead_letters=False,
+        )
+        try:
+            kwargs = {'json': dead_letter.body} if dead_letter.body is not None else {}
+            response = service._request(dead_letter.method, dead_letter.url, **kwargs)
+            response.raise_for_status()
+            status_code, error = response.status_code, None
+        except requests.exceptions.RequestException as e:
+            response = getattr(e, 'response', None)
+            status_code, error = (response.status_code if response is not None else None), f"{type(e).__name__}: {e}"
+
+    if error is None:
+        # Leaves it superseded if a newer write overtook the retry
+        GHLDeadLetter.objects.filter(id=dead_letter.id, status=GHLDeadLetter.STATUS_PENDING).update(
+            status=GHLDeadLetter.STATUS_SUCCEEDED, attempts=attempts, status_code=status_code,
+            last_attempt_at=now, resolved_at=now, locked_until=None,
+        )
+        logger.info(f"Dead letter {dead_letter.id} ({dead_letter.method} {dead_letter.url}) succeeded on attempt {attempts}")
+        return True
+
+    give_up = not is_retryable(status_code) or attempts >= settings.GHL_DEAD_LETTER_MAX_ATTEMPTS
+    GHLDeadLetter.objects.filter(id=dead_letter.id, status=GHLDeadLetter.STATUS_PENDING).update(
+        status=GHLDeadLetter.STATUS_FAILED if give_up else GHLDeadLetter.STATUS_PENDING,
+        attempts=attempts, status_code=status_code, error_message=error[:2000],
+        last_attempt_at=now, next_attempt_at=now + _retry_delay(attempts, response), locked_until=None,
+    )
+    logger.warning(f"Dead letter {dead_letter.id} attempt {attempts} failed{', giving up' if give_up else ''}: {error}")
+    return False
+
+
+def retry_dead_letters(batch_size: int = None) -> Dict[str, int]:
+    """One drain of due dead letters, oldest first, stopping early while GHL still fails"""
+    batch_size = batch_size or settings.GHL_DEAD_LETTER_BATCH_SIZE
+    stats = {'succeeded': 0, 'failed': 0, 'deferred': 0}
+    dead_letters = _claim(batch_size)
+    for index, dead_letter in enumerate(dead_letters):
+        if retry_dead_letter(dead_letter):
+            stats['succeeded'] += 1
+            continue
+        stats['failed'] += 1
+        dead_letter.refresh_from_db(fields=['status_code'])
+        if is_retryable(dead_letter.status_code):
+            # GHL (or the network) is still down, release the rest for the next drain
+            rest = [remaining.id for remaining in dead_letters[index + 1:]]
+            GHLDeadLetter.objects.filter(id__in=rest).update(locked_until=None)
+            stats['deferred'] = len(rest)
+            break
+    return stats
+
+
+def requeue_dead_letters(queryset) -> int:
+    """Make dead letters due now with a fresh attempt budget, returns how many were requeued.
+
+    Succeeded and superseded ones are resolved and stay that way.
+    """
+    return queryset.exclude(status__in=(GHLDeadLetter.STATUS_SUCCEEDED, GHLDeadLetter.STATUS_SUPERSEDED)).update(
+        status=GHLDeadLetter.STATUS_PENDING, attempts=0, next_attempt_at=timezone.now(),
+        locked_until=None, resolved_at=None,
+    )
@@ -0,0 +1,64 @@
+"""Drop HCP webhook redeliveries before they reach process_webhook.
+
+A delivery is claimed with an atomic cache add before it is stored, so two
+concurrent copies can't both get through. When storing or processing it then
+fails, forget_webhook releases the claim and HCP's retry is let in.
+"""
+import hashlib
+import json
+import logging
+from typing import Any, Dict
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+ENTITY_KEYS = ('job', 'estimate', 'customer', 'appointment')
+
+
+def webhook_fingerprint(webhook_data: Dict[str, Any]) -> str:
+    """Identify a delivery by event, company, entity id and updated_at.
+
+    Payloads without an entity id or updated_at fall back to a hash of the
+    whole payload.
+    """
+    event = webhook_data.get('event') or ''
+    company_id = webhook_data.get('company_id') or ''
+    for key in ENTITY_KEYS:
+        entity = webhook_data.get(key)
+        if isinstance(entity, dict) and entity.get('id') and entity.get('updated_at'):
+            identity = f"{event}|{company_id}|{key}:{entity['id']}|{entity['updated_at']}"
+            return hashlib.sha256(identity.encode()).hexdigest()
+
+    content = json.dumps(webhook_data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def is_duplicate_webhook(webhook_data: Dict[str, Any]) -> bool:
+    """True if the same delivery was seen within HCP_WEBHOOK_DEDUP_WINDOW seconds.
+
+    One atomic cache add per call. If the cache is down every delivery is
+    treated as new.
+    """
+    window = settings.HCP_WEBHOOK_DEDUP_WINDOW
+    if not window:
+        return False
+    try:
+        return not cache.add(_seen_key(webhook_data), 1, timeout=window)
+    except Exception as e:
+        logger.warning(f"Webhook dedup cache unavailable, processing delivery: {e}")
+        return False
+
+
+def forget_webhook(webhook_data: Dict[str, Any]):
+    """Release the claim of is_duplicate_webhook, for a delivery that wasn't stored or processed"""
+    if not settings.HCP_WEBHOOK_DEDUP_WINDOW:
+        return
+    try:
+        cache.delete(_seen_key(webhook_data))
+    except Exception as e:
+        logger.warning(f"Webhook dedup cache unavailable, a retry of the delivery may be dropped: {e}")
+
+
+def _seen_key(webhook_data: Dict[str, Any]) -> str:
+    return f"hcp:webhook-seen:{webhook_fingerprint(webhook_data)}"
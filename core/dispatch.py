@@ -0,0 +1,210 @@
+"""Ordered lanes for webhook processing.
+
+Events are routed by (company_id, entity) to one of HCP_WEBHOOK_LANES lanes.
+Everything in a lane runs in arrival order, different lanes run in parallel.
+Customer, estimate and job events are keyed by the HCP customer so contact and
+opportunity mappings for one customer are never written concurrently.
+Appointment events only carry a job_id, so the lane of every job we route is
+remembered in the cache and appointments follow their job. When the cache has
+forgotten the job, the customer is read from the job's OpportunityMapping, and
+only a job never seen before is routed by its own id.
+
+In Celery each lane is its own queue, declared in CELERY_TASK_QUEUES, and
+route_lane_task sends lane tasks that were queued without a queue to theirs.
+Run every lane queue on exactly one worker process with -c 1. With 8 lanes
+and 4 workers, `manage.py lane_worker --index I --workers 4` for I in 0..3
+runs
+
+    celery -A hcp2ghl_sync worker -c 1 -Q hcp_webhooks.0,hcp_webhooks.4
+    celery -A hcp2ghl_sync worker -c 1 -Q hcp_webhooks.1,hcp_webhooks.5
+    ...
+
+and the other tasks need a worker on the default queue:
+
+    celery -A hcp2ghl_sync worker -Q celery
+
+Throughput scales with the number of workers up to the number of lanes.
+"""
+import logging
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Tuple
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+JOB_LANE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def partition_key(webhook_data: Dict[str, Any]) -> Tuple[str, str]:
+    """Return the (company_id, entity) ordering key for a webhook payload"""
+    company_id = webhook_data.get('company_id') or ''
+    job = webhook_data.get('job') or {}
+    estimate = webhook_data.get('estimate') or {}
+    customer = webhook_data.get('customer') or job.get('customer') or estimate.get('customer') or {}
+
+    if customer.get('id'):
+        return company_id, f"customer:{customer['id']}"
+    if job.get('id'):
+        return company_id, f"job:{job['id']}"
+    if estimate.get('id'):
+        return company_id, f"estimate:{estimate['id']}"
+    return company_id, ''
+
+
+def lane_for(key: Tuple[str, str], lanes: int = None) -> int:
+    """Stable lane number for a partition key (same key, same lane, in every process)"""
+    lanes = lanes or settings.HCP_WEBHOOK_LANES
+    return zlib.crc32('|'.join(key).encode()) % lanes
+
+
+def lane_queue(lane: int) -> str:
+    return f"{settings.HCP_WEBHOOK_QUEUE_PREFIX}.{lane}"
+
+
+def _job_lane_cache_key(company_id: str, job_id: str) -> str:
+    return f"hcp:job-lane:{company_id}:{job_id}"
+
+
+def job_partition_key(company_id: str, job_id: str) -> Tuple[str, str]:
+    """Partition key of a job known only by id, the key of its customer when the job is mapped"""
+    from core.models import OpportunityMapping
+
+    customer_id = OpportunityMapping.objects.filter(
+        hcp_company_id=company_id, hcp_job_id=job_id
+    ).values_list('hcp_customer_id', flat=True).first()
+    if customer_id:
+        return company_id, f"customer:{customer_id}"
+    logger.warning(f"Customer of job {job_id} unknown, routing its appointment event by job")
+    return company_id, f"job:{job_id}"
+
+
+def lane_for_webhook(webhook_data: Dict[str, Any]) -> int:
+    """Lane for a payload, keeping appointment events in the lane of their job"""
+    company_id = webhook_data.get('company_id') or ''
+    job_id = (webhook_data.get('job') or {}).get('id')
+    appointment_job_id = (webhook_data.get('appointment') or {}).get('job_id')
+
+    if appointment_job_id and not job_id:
+        lane = cache.get(_job_lane_cache_key(company_id, appointment_job_id))
+        if lane is None:
+            lane = lane_for(job_partition_key(company_id, appointment_job_id))
+            cache.set(_job_lane_cache_key(company_id, appointment_job_id), lane, JOB_LANE_CACHE_TIMEOUT)
+        return lane
+
+    lane = lane_for(partition_key(webhook_data))
+    if job_id:
+        cache.set(_job_lane_cache_key(company_id, job_id), lane, JOB_LANE_CACHE_TIMEOUT)
+    return lane
+
+
+def lane_queues(index: int = 0, workers: int = 1) -> list:
+    """Lane queues served by worker index of workers, every lane belongs to exactly one worker"""
+    return [lane_queue(lane) for lane in range(settings.HCP_WEBHOOK_LANES) if lane % workers == index]
+
+
+def route_lane_task(name, args, kwargs, options, task=None, **kw):
+    """CELERY_TASK_ROUTES router: lane tasks sent without a queue (e.g. .delay()) go to their webhook's lane"""
+    if options.get('queue') or name not in ('core.tasks.handle_webhook_event', 'core.tasks.flush_coalesced_job'):
+        return None
+    from core.models import Webhook
+
+    if name == 'core.tasks.handle_webhook_event':
+        webhook_id = args[0] if args else kwargs['webhook_id']
+        webhook = Webhook.objects.filter(id=webhook_id).first()
+        webhook_data = (webhook.get_payload() if webhook else None) or {}
+    else:
+        # Routed like an appointment event, by the lane remembered for the job
+        company_id, job_id = args[:2] if args else (kwargs['company_id'], kwargs['job_id'])
+        webhook_data = {'company_id': company_id, 'appointment': {'job_id': job_id}}
+    return {'queue': lane_queue(lane_for_webhook(webhook_data))}
+
+
+def dispatch_webhook(webhook_id: int, webhook_data: Dict[str, Any]):
+    """Enqueue a stored webhook on the Celery queue of its lane"""
+    from core.tasks import handle_webhook_event
+
+    queue_name = lane_queue(lane_for_webhook(webhook_data))
+    return handle_webhook_event.apply_async(args=[webhook_id], queue=queue_name)
+
+
+class PartitionedDispatcher:
+    """In-process equivalent of the Celery lanes, used by batch tools.
+
+    One thread per lane. Work submitted with the same key runs in submission
+    order, different lanes run concurrently.
+
+        with PartitionedDispatcher(lanes=8) as dispatcher:
+            future = dispatcher.submit_webhook(data, process, data)
+    """
+
+    def __init__(self, lanes: int = None):
+        self.lanes = lanes or settings.HCP_WEBHOOK_LANES
+        self._job_lanes = {}
+        self._queues = [queue.Queue() for _ in range(self.lanes)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"hcp-lane-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self, work_queue: queue.Queue):
+        try:
+            while True:
+                item = work_queue.get()
+                if item is None:
+                    return
+                future, fn, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    logger.error(f"Error in dispatcher lane {threading.current_thread().name}: {e}")
+                    future.set_exception(e)
+        finally:
+            # Each lane thread holds its own DB connection
+            connections.close_all()
+
+    def _submit_to_lane(self, lane: int, fn: Callable, args, kwargs) -> Future:
+        future = Future()
+        self._queues[lane].put((future, fn, args, kwargs))
+        return future
+
+    def submit(self, key: Tuple[str, str], fn: Callable, *args, **kwargs) -> Future:
+        return self._submit_to_lane(lane_for(key, self.lanes), fn, args, kwargs)
+
+    def submit_webhook(self, webhook_data: Dict[str, Any], fn: Callable, *args, **kwargs) -> Future:
+        """Submit work for a webhook payload, appointment events follow the lane of their job"""
+        company_id = webhook_data.get('company_id') or ''
+        job_id = (webhook_data.get('job') or {}).get('id')
+        appointment_job_id = (webhook_data.get('appointment') or {}).get('job_id')
+
+        if appointment_job_id and not job_id:
+            lane = self._job_lanes.get((company_id, appointment_job_id))
+            if lane is None:
+                lane = lane_for(job_partition_key(company_id, appointment_job_id), self.lanes)
+                self._job_lanes[(company_id, appointment_job_id)] = lane
+        else:
+            lane = lane_for(partition_key(webhook_data), self.lanes)
+            if job_id:
+                self._job_lanes[(company_id, job_id)] = lane
+        return self._submit_to_lane(lane, fn, args, kwargs)
+
+    def shutdown(self, wait: bool = True):
+        for work_queue in self._queues:
+            work_queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
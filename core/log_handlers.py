@@ -0,0 +1,122 @@
+"""Logging handlers and filters that keep log I/O off the request path.
+
+QueueListenerHandler puts records on a bounded in-memory queue and a
+background QueueListener thread writes them to the real handlers (file,
+console). When the queue is full, records are dropped and counted so the
+request thread never blocks. Configure it in LOGGING with its targets given
+as cfg:// references. Targets must be named so they sort before the queue
+handler, because dictConfig builds handlers in name order:
+
+    'queue': {
+        'class': 'core.log_handlers.QueueListenerHandler',
+        'targets': ['cfg://handlers.console', 'cfg://handlers.file'],
+    }
+
+WebhookPayloadFilter handles records that carry a webhook payload
+(logger.info(..., extra={'payload': data})). It keeps a sample of them,
+masks personal data and appends the payload to the message.
+"""
+import copy
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueListener
+from typing import Any, Iterable, List
+
+
+class QueueListenerHandler(logging.Handler):
+    def __init__(self, targets: List[logging.Handler], maxsize: int = 10000, level=logging.NOTSET):
+        super().__init__(level)
+        # Indexing (not iterating) is what makes dictConfig resolve cfg:// references
+        self.targets = [targets[i] for i in range(len(targets))]
+        for target in self.targets:
+            if not isinstance(target, logging.Handler):
+                raise ValueError(f"QueueListenerHandler target {target!r} is not a configured handler, "
+                                 f"check that its name sorts before the queue handler's")
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._listener = None
+
+    def _start(self):
+        # Forked workers (celery prefork, gunicorn) don't inherit the listener thread, start one per process
+        self._queue = queue.Queue(self.maxsize)
+        self._listener = QueueListener(self._queue, *self.targets, respect_handler_level=True)
+        self._listener.start()
+        self._pid = os.getpid()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Format the message now, args and tracebacks may not survive the trip to another thread"""
+        message = self.format(record)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        record.stack_info = None
+        return record
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self._pid != os.getpid():
+                with self.lock:
+                    if self._pid != os.getpid():
+                        self._start()
+            self._queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        # Drain what is queued before the process exits
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+        super().close()
+
+
+# Payload keys whose values are masked, matched at any depth
+REDACTED_KEYS = frozenset({
+    'email', 'mobile_number', 'home_number', 'work_number', 'phone', 'phone_number',
+    'street', 'street_line_2', 'address', 'first_name', 'last_name', 'name', 'notes',
+})
+
+
+def redact(value: Any, keys: Iterable[str] = REDACTED_KEYS) -> Any:
+    """Copy of a JSON-like value with the values of keys replaced by '***'"""
+    keys = keys if isinstance(keys, frozenset) else frozenset(keys)
+    if isinstance(value, dict):
+        return {
+            key: '***' if key in keys and item not in (None, '') else redact(item, keys)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item, keys) for item in value]
+    return value
+
+
+class WebhookPayloadFilter(logging.Filter):
+    def __init__(self, sample_rate: float = 1.0, max_length: int = 2000, name: str = ''):
+        super().__init__(name)
+        self.sample_rate = sample_rate
+        self.max_length = max_length
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        payload = getattr(record, 'payload', None)
+        if payload is None:
+            return True
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        text = json.dumps(redact(payload), default=str)
+        if len(text) > self.max_length:
+            text = text[:self.max_length] + '...'
+        record.msg = f"{record.getMessage()}: {text}"
+        record.args = None
+        record.payload = None
+        return True
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.backfill import BackfillCheckpoint, HCPBackfill, iter_dump_records, iter_hcp_api_records
+from core.models import HCPToGHLMapping
+
+
+class Command(BaseCommand):
+    help = "Backfill existing HCP customers, estimates and jobs of one company into GHL"
+
+    def add_arguments(self, parser):
+        parser.add_argument('company_id', help='HCP company id (must have an HCPToGHLMapping)')
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--file', help='JSON or JSONL dump of HCP customers/estimates/jobs')
+        source.add_argument('--hcp-api-key', help='Page the records from the HCP API instead')
+        parser.add_argument('--checkpoint', help='Checkpoint file, an existing one is resumed')
+        parser.add_argument('--concurrency', type=int, default=8, help='Parallel GHL requests')
+        parser.add_argument('--batch-size', type=int, default=200, help='Records per batch / checkpoint')
+
+    def handle(self, *args, **options):
+        try:
+            mapping = HCPToGHLMapping.objects.select_related('ghl_credentials').get(hcp_company_id=options['company_id'])
+        except HCPToGHLMapping.DoesNotExist:
+            raise CommandError(f"No GHL mapping found for HCP company {options['company_id']}")
+
+        checkpoint = BackfillCheckpoint(options['checkpoint'])
+        if checkpoint.offset:
+            self.stdout.write(f"Resuming after {checkpoint.offset} records, retrying {len(checkpoint.failed)} failed")
+
+        if options['file']:
+            records = iter_dump_records(options['file'])
+        else:
+            records = iter_hcp_api_records(options['hcp_api_key'])
+
+        def progress(offset, rate, stats):
+            self.stdout.write(
+                f"{offset} records, {rate:.1f}/s, {stats['contacts_created']} contacts, "
+                f"{stats['opportunities_created']} opportunities, {stats['failed']} failed"
+            )
+
+        backfill = HCPBackfill(
+            mapping,
+            concurrency=options['concurrency'],
+            batch_size=options['batch_size'],
+            checkpoint=checkpoint,
+        )
+        stats = backfill.run(records, progress=progress)
+        self.stdout.write(self.style.SUCCESS(
+            "Backfill finished: " + ", ".join(f"{key}={value}" for key, value in stats.items())
+        ))
@@ -0,0 +1,49 @@
+import statistics
+import time
+import requests
+from django.core.management.base import BaseCommand
+from core.bench.ghl_stub import GHLStubServer
+from core.services import GoHighLevelService
+from core.utils import build_http_session
+
+
+class _OneShotSession:
+    """Mimics the old module-level requests.put/post calls: a new connection per request"""
+
+    def request(self, method, url, **kwargs):
+        return requests.request(method, url, **kwargs)
+
+
+class Command(BaseCommand):
+    help = "Compare per-call latency of GoHighLevelService with and without the pooled session against a local stub"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=500, help='Requests per run')
+        parser.add_argument('--latency-ms', type=float, default=0, help='Artificial server latency')
+        parser.add_argument('--handshake-ms', type=float, default=20, help='Simulated TCP+TLS setup cost per new connection')
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+        with GHLStubServer(latency=options['latency_ms'] / 1000, handshake=options['handshake_ms'] / 1000) as stub:
+            original_base_url = GoHighLevelService.BASE_URL
+            GoHighLevelService.BASE_URL = stub.url
+            try:
+                runs = [
+                    ('new connection per call', _OneShotSession()),
+                    ('pooled keep-alive session', build_http_session(pool_size=4)),
+                ]
+                for label, session in runs:
+                    service = GoHighLevelService('bench-token', 'job.updated', session=session)
+                    timings = []
+                    for i in range(calls):
+                        start = time.perf_counter()
+                        service.update_opportunity(f'opp{i}', {'total_amount': 1000})
+                        timings.append((time.perf_counter() - start) * 1000)
+                    timings.sort()
+                    self.stdout.write(
+                        f"{label:<28} mean {statistics.mean(timings):7.3f} ms  "
+                        f"p50 {timings[len(timings) // 2]:7.3f} ms  "
+                        f"p99 {timings[int(len(timings) * 0.99) - 1]:7.3f} ms"
+                    )
+            finally:
+                GoHighLevelService.BASE_URL = original_base_url
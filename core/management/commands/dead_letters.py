@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from core.deadletter import requeue_dead_letters, retry_dead_letters
+from core.models import GHLDeadLetter
+
+
+class Command(BaseCommand):
+    help = "List GHL dead letters, requeue them, or run a retry drain now"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status', choices=[choice for choice, _ in GHLDeadLetter.STATUS_CHOICES],
+                            help='Only list dead letters with this status')
+        parser.add_argument('--limit', type=int, default=50, help='Rows to list')
+        parser.add_argument('--requeue', nargs='+', metavar='ID',
+                            help="Dead letter ids to retry from scratch, or 'failed' for every failed one")
+        parser.add_argument('--drain', action='store_true', help='Retry due dead letters now, as the beat task does')
+        parser.add_argument('--batch-size', type=int, help='Dead letters per drain')
+
+    def handle(self, *args, **options):
+        if options['requeue']:
+            if options['requeue'] == ['failed']:
+                queryset = GHLDeadLetter.objects.filter(status=GHLDeadLetter.STATUS_FAILED)
+            else:
+                queryset = GHLDeadLetter.objects.filter(id__in=[int(i) for i in options['requeue']])
+            self.stdout.write(f"Requeued {requeue_dead_letters(queryset)} dead letters")
+
+        if options['drain']:
+            stats = retry_dead_letters(options['batch_size'])
+            self.stdout.write(f"Succeeded {stats['succeeded']}, failed {stats['failed']}, deferred {stats['deferred']}")
+
+        if options['requeue'] or options['drain']:
+            return
+
+        queryset = GHLDeadLetter.objects.order_by('-id')
+        if options['status']:
+            queryset = queryset.filter(status=options['status'])
+        for dead_letter in queryset[:options['limit']]:
+            self.stdout.write(
+                f"{dead_letter.id:>6} {dead_letter.status:<10} {dead_letter.method:<6} {dead_letter.url} "
+                f"{dead_letter.error_class} status={dead_letter.status_code} attempts={dead_letter.attempts} "
+                f"next={dead_letter.next_attempt_at:%Y-%m-%d %H:%M:%S}"
+            )
@@ -0,0 +1,104 @@
+from collections import Counter
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from core.bench.ghl_stub import GHLStubServer
+from core.bench.payloads import EVENT_TYPES, sample_webhook
+from core.cache import invalidate_company_mapping
+from core.models import GHLAuthCredentials, HCPToGHLMapping
+from core.services import GoHighLevelService, HousecallProWebhookService
+
+REPORT_COMPANY_ID = 'ghl-call-report'
+REPORT_LOCATION_ID = 'ghl-call-report'
+
+# Events sent first to put the customer, estimate and job in GHL for the "mapped" run
+PRIME_EVENTS = ['customer.created', 'estimate.created', 'job.created']
+
+
+def minimum_calls(event_type: str) -> tuple:
+    """Fewest GHL calls an event can take as (nothing mapped yet, everything mapped and customer unchanged)"""
+    # A new customer is looked up with GHL's duplicate search before its contact is created
+    search = 1 if settings.GHL_CONTACT_DEDUP_SEARCH else 0
+    if event_type == 'customer.deleted':
+        return 0, 1
+    if event_type.startswith('customer.'):
+        return 1 + search, 0
+    if event_type == 'estimate.copy_to_job':
+        return 1 + search, 1
+    if event_type.startswith('job.appointment.'):
+        return 0, 1
+    # contact + opportunity create, or a single opportunity PUT
+    return 2 + search, 1
+
+
+class Command(BaseCommand):
+    help = "Count the GHL API calls each HCP webhook event makes, against a local stub, and compare with the minimum"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', action='append', dest='events', help='Only report these events (repeatable)')
+        parser.add_argument('--fail-over', action='store_true', help='Exit with an error if any event exceeds its minimum')
+
+    def _run(self, stub, event_type, prime):
+        """Process one event in a rolled back transaction, return the GHL calls it made"""
+        try:
+            with transaction.atomic():
+                credentials = GHLAuthCredentials.objects.create(
+                    user_id=REPORT_COMPANY_ID, access_token='report-token', refresh_token='report-token',
+                    expires_in=86399, location_id=REPORT_LOCATION_ID,
+                )
+                HCPToGHLMapping.objects.create(
+                    hcp_company_id=REPORT_COMPANY_ID, ghl_location_id=REPORT_LOCATION_ID, ghl_credentials=credentials,
+                )
+                service = HousecallProWebhookService()
+                if prime:
+                    for prime_event in PRIME_EVENTS:
+                        service.process_webhook(sample_webhook(prime_event, REPORT_COMPANY_ID))
+                del stub.requests[:]
+                result = service.process_webhook(sample_webhook(event_type, REPORT_COMPANY_ID))
+                calls = list(stub.requests)
+                transaction.set_rollback(True)
+        finally:
+            invalidate_company_mapping(REPORT_COMPANY_ID)
+        return calls, result
+
+    def _describe(self, calls):
+        methods = Counter(call.method for call in calls)
+        return ' '.join(f"{method}x{count}" for method, count in sorted(methods.items())) or '-'
+
+    def handle(self, *args, **options):
+        events = options['events'] or EVENT_TYPES
+        unknown = set(events) - set(EVENT_TYPES)
+        if unknown:
+            raise CommandError(f"Unknown events: {', '.join(sorted(unknown))}")
+
+        over = []
+        with GHLStubServer() as stub:
+            original_base_url = GoHighLevelService.BASE_URL
+            GoHighLevelService.BASE_URL = stub.url
+            try:
+                self.stdout.write(f"{'event':<44} {'new':>5} {'min':>4}  {'mapped':>6} {'min':>4}  calls (new / mapped)")
+                for event_type in events:
+                    cold_calls, cold_result = self._run(stub, event_type, prime=False)
+                    warm_calls, warm_result = self._run(stub, event_type, prime=True)
+                    cold_min, warm_min = minimum_calls(event_type)
+                    flag = ''
+                    if len(cold_calls) > cold_min or len(warm_calls) > warm_min:
+                        flag = '  OVER'
+                        over.append(event_type)
+                    for result in (cold_result, warm_result):
+                        if result.get('error'):
+                            flag += f"  ({result['error']})"
+                    self.stdout.write(
+                        f"{event_type:<44} {len(cold_calls):>5} {cold_min:>4}  {len(warm_calls):>6} {warm_min:>4}  "
+                        f"{self._describe(cold_calls)} / {self._describe(warm_calls)}{flag}"
+                    )
+            finally:
+                GoHighLevelService.BASE_URL = original_base_url
+
+        if over:
+            message = f"{len(over)} event(s) above the minimum GHL calls: {', '.join(over)}"
+            if options['fail_over']:
+                raise CommandError(message)
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS("Every event is at its minimum number of GHL calls"))
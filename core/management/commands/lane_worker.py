@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.dispatch import lane_queues
+
+
+class Command(BaseCommand):
+    help = "Run a Celery worker for one share of the webhook lanes, one task at a time so every lane stays ordered"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index', type=int, default=0, help='Number of this worker, 0 to --workers - 1')
+        parser.add_argument('--workers', type=int, default=1, help='Lane workers in total, each lane gets exactly one')
+        parser.add_argument('--print', action='store_true', help='Only print the celery command')
+
+    def handle(self, *args, **options):
+        index, workers = options['index'], options['workers']
+        if not 0 <= index < workers:
+            raise CommandError('--index must be between 0 and --workers - 1')
+        queues = lane_queues(index, workers)
+        if not queues:
+            raise CommandError(f"Worker {index} has no lanes, HCP_WEBHOOK_LANES is {settings.HCP_WEBHOOK_LANES}")
+
+        argv = ['worker', '-c', '1', '--prefetch-multiplier', '1', '-Q', ','.join(queues), '-n', f'lanes{index}@%h']
+        if options['print']:
+            self.stdout.write(f"celery -A hcp2ghl_sync {' '.join(argv)}")
+            return
+
+        from hcp2ghl_sync.celery import app
+        app.worker_main(argv)
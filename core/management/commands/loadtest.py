@@ -0,0 +1,240 @@
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from core import services
+from core.bench.generator import event_mix
+from core.bench.ghl_stub import GHLStubServer
+from core.cache import invalidate_company_mapping
+from core.models import (
+    ContactMapping, GHLAuthCredentials, GHLContactIndex, GHLDeadLetter, GHLOutboxMessage, HCPToGHLMapping,
+    OpportunityMapping, Webhook,
+)
+from core.services import GoHighLevelService
+from core.utils import get_ghl_session
+
+# Metrics compared between runs, higher is better only for rps
+COMPARED = ['rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_event', 'ghl_calls_per_event']
+
+
+def percentile(sorted_values, pct: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(samples, seconds: float = None) -> dict:
+    timings = sorted(sample['ms'] for sample in samples)
+    count = len(samples)
+    summary = {
+        'webhooks': count,
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'errors': sum(1 for sample in samples if sample['error']),
+        'queries_per_event': round(sum(sample['queries'] for sample in samples) / count, 2) if count else 0,
+        'ghl_calls_per_event': round(sum(sample['ghl_calls'] for sample in samples) / count, 2) if count else 0,
+    }
+    if seconds is not None:
+        summary['seconds'] = round(seconds, 2)
+        summary['rps'] = round(count / seconds, 1) if seconds else 0.0
+    return summary
+
+
+class Command(BaseCommand):
+    help = ("Play a realistic HCP event mix through the webhook view against a local GHL stub and report "
+            "throughput, latency, DB queries and GHL calls per event. Creates and removes its own tenants, "
+            "run it against a development database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=50, help='Customer lifecycles to play')
+        parser.add_argument('--tenants', type=int, default=2, help='HCP companies (GHL locations) to spread them over')
+        parser.add_argument('--concurrency', type=int, default=4, help='Customers played in parallel')
+        parser.add_argument('--seed', type=int, default=1, help='Seed of the event mix and failure injection')
+        parser.add_argument('--latency-ms', type=float, default=20, help='Stub latency per GHL call')
+        parser.add_argument('--jitter-ms', type=float, default=10, help='Extra random stub latency per GHL call')
+        parser.add_argument('--rate-limit-rate', type=float, default=0, help='Share of GHL calls answered with 429')
+        parser.add_argument('--unauthorized-rate', type=float, default=0, help='Share of GHL calls answered with 401')
+        parser.add_argument('--error-rate', type=float, default=0, help='Share of GHL calls answered with 503')
+        parser.add_argument('--unthrottled', action='store_true',
+                            help='Lift the client-side GHL rate limit to measure the service alone')
+        parser.add_argument('--save', metavar='PATH', help='Write the results as JSON')
+        parser.add_argument('--compare', metavar='PATH', help='Compare with results saved by an earlier --save')
+        parser.add_argument('--keep', action='store_true', help='Keep the tenants, mappings and webhooks of the run')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read {options['compare']}: {e}")
+
+        run_id = timezone.now().strftime('%Y%m%d%H%M%S')
+        company_ids = [f'loadtest-{run_id}-{i}' for i in range(options['tenants'])]
+        lifecycles = event_mix(company_ids, options['customers'], seed=options['seed'])
+        self._local = threading.local()
+
+        overrides = {'HCP_WEBHOOK_ASYNC': False}
+        if options['unthrottled']:
+            overrides.update(GHL_RATE_LIMIT_BURST=10 ** 9, GHL_RATE_LIMIT_DAILY=10 ** 9)
+
+        stub = GHLStubServer(
+            latency=options['latency_ms'] / 1000, jitter=options['jitter_ms'] / 1000,
+            rate_limit_rate=options['rate_limit_rate'], unauthorized_rate=options['unauthorized_rate'],
+            error_rate=options['error_rate'], seed=options['seed'],
+        )
+        session = get_ghl_session()
+        original_base_url, original_token_url = GoHighLevelService.BASE_URL, services.GHL_TOKEN_URL
+        core_logger = logging.getLogger('core')
+        log_level = core_logger.level
+        if options['verbosity'] < 2:
+            # Per-webhook INFO logs would dominate the output and the timings
+            core_logger.setLevel(logging.WARNING)
+        self._create_tenants(company_ids)
+        try:
+            with stub, override_settings(**overrides):
+                GoHighLevelService.BASE_URL = stub.url
+                services.GHL_TOKEN_URL = stub.token_url
+                session.hooks['response'].append(self._count_ghl_call)
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                    samples = [sample for played in pool.map(self._play, lifecycles) for sample in played]
+                seconds = time.perf_counter() - started
+        finally:
+            if self._count_ghl_call in session.hooks['response']:
+                session.hooks['response'].remove(self._count_ghl_call)
+            GoHighLevelService.BASE_URL, services.GHL_TOKEN_URL = original_base_url, original_token_url
+            core_logger.setLevel(log_level)
+            if not options['keep']:
+                self._remove_tenants(company_ids)
+
+        by_event = defaultdict(list)
+        for sample in samples:
+            by_event[sample['event']].append(sample)
+        results = {
+            'options': {key: options[key] for key in (
+                'customers', 'tenants', 'concurrency', 'seed', 'latency_ms', 'jitter_ms',
+                'rate_limit_rate', 'unauthorized_rate', 'error_rate', 'unthrottled',
+            )},
+            'summary': summarize(samples, seconds),
+            'ghl_statuses': {str(status): count for status, count in sorted(stub.status_counts().items())},
+            'events': {event: summarize(event_samples) for event, event_samples in sorted(by_event.items())},
+        }
+        self._report(results)
+        if baseline:
+            self._compare(baseline, results)
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Saved results to {options['save']}")
+
+    def _create_tenants(self, company_ids):
+        for company_id in company_ids:
+            credentials = GHLAuthCredentials.objects.create(
+                user_id=company_id, access_token='loadtest-token', refresh_token='loadtest-token',
+                expires_in=86399, expires_at=GHLAuthCredentials.expiry_for(86399), location_id=company_id,
+            )
+            HCPToGHLMapping.objects.create(
+                hcp_company_id=company_id, ghl_location_id=company_id, ghl_credentials=credentials,
+            )
+
+    def _remove_tenants(self, company_ids):
+        Webhook.objects.filter(company_id__in=company_ids).delete()
+        GHLOutboxMessage.objects.filter(hcp_company_id__in=company_ids).delete()
+        GHLDeadLetter.objects.filter(location_id__in=company_ids).delete()
+        ContactMapping.objects.filter(hcp_company_id__in=company_ids).delete()
+        GHLContactIndex.objects.filter(ghl_location_id__in=company_ids).delete()
+        OpportunityMapping.objects.filter(hcp_company_id__in=company_ids).delete()
+        HCPToGHLMapping.objects.filter(hcp_company_id__in=company_ids).delete()
+        GHLAuthCredentials.objects.filter(location_id__in=company_ids).delete()
+        for company_id in company_ids:
+            invalidate_company_mapping(company_id)
+
+    def _count_ghl_call(self, response, *args, **kwargs):
+        # Response hooks run on the calling thread, so the count belongs to the webhook it is playing
+        self._local.ghl_calls = getattr(self._local, 'ghl_calls', 0) + 1
+
+    def _play(self, lifecycle):
+        """Post one customer's webhooks in order, returns a sample per webhook"""
+        client = Client()
+        url = reverse('hcp_webhook')
+        samples = []
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        try:
+            with connection.execute_wrapper(count_query):
+                for webhook in lifecycle:
+                    queries[0] = 0
+                    self._local.ghl_calls = 0
+                    started = time.perf_counter()
+                    response = client.post(url, data=json.dumps(webhook), content_type='application/json')
+                    ms = (time.perf_counter() - started) * 1000
+                    try:
+                        error = response.status_code >= 400 or bool(response.json().get('error'))
+                    except ValueError:
+                        error = True
+                    samples.append({
+                        'event': webhook['event'], 'ms': ms, 'queries': queries[0],
+                        'ghl_calls': self._local.ghl_calls, 'error': error,
+                    })
+        finally:
+            connection.close()
+        return samples
+
+    def _report(self, results):
+        summary = results['summary']
+        self.stdout.write(
+            f"{summary['webhooks']} webhooks in {summary['seconds']}s: {summary['rps']} req/s, "
+            f"p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms, p99 {summary['p99_ms']} ms, "
+            f"{summary['queries_per_event']} queries and {summary['ghl_calls_per_event']} GHL calls per event, "
+            f"{summary['errors']} errors"
+        )
+        self.stdout.write(f"GHL stub responses by status: {results['ghl_statuses']}")
+        self.stdout.write(
+            f"{'event':<44} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'ghl':>5} {'errors':>6}"
+        )
+        for event, stats in results['events'].items():
+            self.stdout.write(
+                f"{event:<44} {stats['webhooks']:>6} {stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8} "
+                f"{stats['queries_per_event']:>8} {stats['ghl_calls_per_event']:>5} {stats['errors']:>6}"
+            )
+
+    def _delta(self, metric, old, new) -> str:
+        if old in (None, 0):
+            return f"{metric} {old} -> {new}"
+        change = (new - old) / old * 100
+        better = change > 0 if metric == 'rps' else change < 0
+        text = f"{metric} {old} -> {new} ({change:+.1f}%)"
+        if abs(change) >= 5:
+            text = self.style.SUCCESS(text) if better else self.style.WARNING(text)
+        return text
+
+    def _compare(self, baseline, results):
+        if baseline.get('options') != results['options']:
+            self.stdout.write(self.style.WARNING("Baseline was run with different options, deltas may not be comparable"))
+        self.stdout.write("Compared with baseline:")
+        old, new = baseline['summary'], results['summary']
+        self.stdout.write("  overall: " + ', '.join(self._delta(m, old.get(m), new[m]) for m in COMPARED))
+        for event, stats in results['events'].items():
+            old = baseline['events'].get(event)
+            if not old:
+                continue
+            self.stdout.write(f"  {event}: " + ', '.join(
+                self._delta(m, old.get(m), stats[m]) for m in COMPARED if m in stats
+            ))
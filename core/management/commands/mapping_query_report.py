@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+from core.models import ContactMapping, GHLAuthCredentials, HCPToGHLMapping, OpportunityMapping
+
+
+class Command(BaseCommand):
+    help = "Show row counts and EXPLAIN plans for the mapping lookups on the webhook path"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--analyze', action='store_true', help='Run EXPLAIN ANALYZE (executes the queries)')
+
+    def _sample(self, model, field):
+        row = model.objects.exclude(**{f"{field}__isnull": True}).values(field, 'hcp_company_id').first()
+        if row:
+            return row[field], row['hcp_company_id']
+        return 'sample', 'sample'
+
+    def handle(self, *args, **options):
+        explain_options = {'analyze': True} if options['analyze'] else {}
+
+        self.stdout.write("Row counts")
+        for model in (GHLAuthCredentials, HCPToGHLMapping, ContactMapping, OpportunityMapping):
+            self.stdout.write(f"  {model.__name__:<20} {model.objects.count()}")
+
+        customer_id, customer_company = self._sample(ContactMapping, 'hcp_customer_id')
+        estimate_id, estimate_company = self._sample(OpportunityMapping, 'hcp_estimate_id')
+        job_id, job_company = self._sample(OpportunityMapping, 'hcp_job_id')
+        contact_location, contact_id = ContactMapping.objects.values_list(
+            'ghl_location_id', 'ghl_contact_id'
+        ).first() or ('sample', 'sample')
+        company_id = HCPToGHLMapping.objects.values_list('hcp_company_id', flat=True).first() or 'sample'
+        location_id = GHLAuthCredentials.objects.values_list('location_id', flat=True).first() or 'sample'
+
+        lookups = [
+            ("mapping by company (process_webhook)",
+             HCPToGHLMapping.objects.select_related('ghl_credentials').filter(hcp_company_id=company_id)),
+            ("contact by customer (_ensure_contact_exists)",
+             ContactMapping.objects.filter(hcp_customer_id=customer_id, hcp_company_id=customer_company)),
+            ("opportunity by estimate (_create_or_update_estimate_opportunity)",
+             OpportunityMapping.objects.filter(hcp_estimate_id=estimate_id, hcp_company_id=estimate_company)),
+            ("opportunity by job (_create_or_update_job_opportunity)",
+             OpportunityMapping.objects.filter(hcp_job_id=job_id, hcp_company_id=job_company)),
+            ("opportunity by job or its estimate (_create_or_update_job_opportunity)",
+             OpportunityMapping.objects.filter(
+                 Q(hcp_job_id=job_id) | Q(hcp_estimate_id=estimate_id), hcp_company_id=job_company
+             ).order_by('id')),
+            ("contact by GHL contact (contact_index.mapped_to_other_customer)",
+             ContactMapping.objects.filter(ghl_location_id=contact_location, ghl_contact_id=contact_id)
+             .exclude(hcp_company_id=customer_company, hcp_customer_id=customer_id)),
+            ("credentials by location (OAuth tokens view)",
+             GHLAuthCredentials.objects.filter(location_id=location_id)),
+        ]
+        for label, queryset in lookups:
+            self.stdout.write(f"\n{label}")
+            self.stdout.write(queryset.explain(**explain_options))
+
+        duplicates = (
+            OpportunityMapping.objects.filter(hcp_job_id__isnull=False)
+            .values('hcp_job_id', 'hcp_company_id')
+            .order_by()
+            .annotate(count=Count('id'))
+            .filter(count__gt=1)
+            .count()
+        )
+        self.stdout.write(f"\nJobs with more than one opportunity mapping: {duplicates}")
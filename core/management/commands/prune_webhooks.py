@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.retention import archive_old_webhooks, compress_old_webhooks
+
+
+class Command(BaseCommand):
+    help = "Compress old webhook payloads and move webhooks past retention to gzipped JSONL archives"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compress-after', type=int, default=settings.HCP_WEBHOOK_COMPRESS_AFTER_DAYS,
+                            help='Compress payloads of webhooks older than this many days')
+        parser.add_argument('--retention-days', type=int, default=settings.HCP_WEBHOOK_RETENTION_DAYS,
+                            help='Archive and delete webhooks older than this many days')
+        parser.add_argument('--archive-dir', default=settings.HCP_WEBHOOK_ARCHIVE_DIR, help='Directory for archive files')
+        parser.add_argument('--batch-size', type=int, default=settings.HCP_WEBHOOK_PRUNE_BATCH_SIZE,
+                            help='Rows per transaction')
+        parser.add_argument('--skip-compress', action='store_true', help='Only archive')
+        parser.add_argument('--skip-archive', action='store_true', help='Only compress')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows each step would touch')
+
+    def handle(self, *args, **options):
+        verb = 'Would' if options['dry_run'] else ''
+        if not options['skip_compress']:
+            count = compress_old_webhooks(options['compress_after'], options['batch_size'], options['dry_run'])
+            self.stdout.write(f"{verb + ' compress' if verb else 'Compressed'} {count} webhook payloads "
+                              f"older than {options['compress_after']} days")
+        if not options['skip_archive']:
+            count = archive_old_webhooks(
+                options['retention_days'], options['archive_dir'], options['batch_size'], options['dry_run']
+            )
+            self.stdout.write(f"{verb + ' archive' if verb else 'Archived'} {count} webhooks "
+                              f"older than {options['retention_days']} days to {options['archive_dir']}")
@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils import timezone
+from datetime import datetime, time
+from core.replay import WebhookReplay, iter_archived_items, iter_stored_webhooks
+
+
+def _parse_moment(value: str) -> datetime:
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f"Invalid date/time: {value}")
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(BaseCommand):
+    help = "Replay stored (or archived) HCP webhooks through the webhook handlers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', help='Only this HCP company id')
+        parser.add_argument('--event', action='append', dest='events', help='Only this event (repeatable)')
+        parser.add_argument('--since', help='Received at or after, date or ISO datetime')
+        parser.add_argument('--until', help='Received before, date or ISO datetime')
+        parser.add_argument('--status', action='append', dest='statuses',
+                            help='Only webhooks with this status, e.g. failed (repeatable, stored webhooks only)')
+        parser.add_argument('--archive', action='append', dest='archives',
+                            help='Replay from archive files/directories instead of the Webhook table (repeatable)')
+        parser.add_argument('--concurrency', type=int, default=4, help='Parallel lanes')
+        parser.add_argument('--rate', type=float, default=0, help='Max webhooks started per second, 0 for no cap')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched per cursor round trip')
+        parser.add_argument('--no-record', action='store_true', help="Don't write the new outcome to the Webhook rows")
+        parser.add_argument('--dry-run', action='store_true', help='Only check what would be replayed, no GHL calls')
+
+    def handle(self, *args, **options):
+        since = _parse_moment(options['since']) if options['since'] else None
+        until = _parse_moment(options['until']) if options['until'] else None
+
+        if options['archives']:
+            if options['statuses']:
+                raise CommandError("--status only applies to stored webhooks")
+            items = iter_archived_items(options['archives'], options['company'], options['events'], since, until)
+        else:
+            items = iter_stored_webhooks(
+                options['company'], options['events'], since, until, options['statuses'], options['chunk_size']
+            )
+
+        replay = WebhookReplay(
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            dry_run=options['dry_run'],
+            record=not options['no_record'] and not options['archives'],
+        )
+
+        def progress(done, rate):
+            self.stdout.write(f"{done} webhooks, {rate:.1f}/s")
+
+        stats = replay.run(items, progress=progress)
+
+        mode = 'Dry run' if options['dry_run'] else 'Replay'
+        self.stdout.write(self.style.SUCCESS(
+            f"{mode} finished: {stats['replayed']} webhooks in {stats['seconds']}s ({stats['per_second']}/s), "
+            f"{stats['skipped_without_payload']} without payload skipped"
+        ))
+        self.stdout.write("Outcomes: " + (", ".join(f"{key}={value}" for key, value in stats['outcomes'].items()) or '-'))
+        for event, count in stats['events'].items():
+            self.stdout.write(f"  {event:<44} {count}")
+        if stats['errors']:
+            self.stdout.write(self.style.WARNING("First errors:"))
+            for error in stats['errors']:
+                self.stdout.write(f"  {error}")
@@ -0,0 +1,42 @@
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from core.contact_index import sync_location_contacts
+from core.models import HCPToGHLMapping
+
+
+class Command(BaseCommand):
+    help = ("Build the local GHL contact index (normalized email/phone -> contact) from a paged export of each "
+            "location's GHL contacts, so new HCP customers are matched to existing contacts")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--location', nargs='+', metavar='LOCATION_ID', help='Only sync these GHL locations')
+        parser.add_argument('--page-size', type=int, default=100, help='Contacts per GHL page (at most 100)')
+        parser.add_argument('--prune', action='store_true',
+                            help='Drop index keys of contacts that are no longer in GHL')
+
+    def handle(self, *args, **options):
+        mappings = HCPToGHLMapping.objects.select_related('ghl_credentials').order_by('id')
+        if options['location']:
+            mappings = mappings.filter(ghl_location_id__in=options['location'])
+
+        seen = set()
+        failed = 0
+        for mapping in mappings:
+            # Several HCP companies can share a location, its contacts are synced once
+            if mapping.ghl_location_id in seen:
+                continue
+            seen.add(mapping.ghl_location_id)
+            try:
+                stats = sync_location_contacts(mapping, page_size=options['page_size'], prune=options['prune'])
+            except requests.exceptions.RequestException as e:
+                failed += 1
+                self.stderr.write(f"{mapping.ghl_location_id}: {e}")
+                continue
+            self.stdout.write(
+                f"{mapping.ghl_location_id}: {stats['contacts']} contacts, {stats['keys']} keys indexed, "
+                f"{stats['pruned']} pruned"
+            )
+        if not seen:
+            raise CommandError("No company mapping matches, nothing to sync")
+        if failed:
+            raise CommandError(f"{failed} of {len(seen)} locations could not be synced")
@@ -0,0 +1,150 @@
+"""Prometheus metrics for the HCP -> GHL sync.
+
+With several gunicorn/celery processes set PROMETHEUS_MULTIPROC_DIR to a
+shared, writable directory so the /metrics view aggregates all of them.
+The view is only served to METRICS_TOKEN holders and METRICS_ALLOWED_IPS.
+
+Latency histograms are fed through observe()/timed(), which also log every
+observation as one JSON line on the core.metrics logger when
+METRICS_JSON_LOGS is on, e.g.
+{"metric": "ghl_request_seconds", "seconds": 0.231, "method": "PUT", ...}
+"""
+import hmac
+import json
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+span_logger = logging.getLogger('core.metrics')
+
+# Finer than the default buckets, cached lookups and queries take well under 5ms
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+GHL_RATE_LIMIT_TOKENS = Gauge(
+    'ghl_rate_limit_tokens',
+    'Tokens left in the per-location GHL burst bucket after the last acquire',
+    ['location_id'],
+    multiprocess_mode='mostrecent',
+)
+GHL_RATE_LIMIT_REMAINING = Gauge(
+    'ghl_rate_limit_remaining',
+    'X-RateLimit-Remaining reported by GHL on the last response',
+    ['location_id'],
+    multiprocess_mode='mostrecent',
+)
+GHL_RATE_LIMIT_WAIT_SECONDS = Counter(
+    'ghl_rate_limit_wait_seconds',
+    'Time spent waiting for the client-side GHL rate limiter',
+    ['location_id'],
+)
+GHL_RATE_LIMITED = Counter(
+    'ghl_rate_limited',
+    'GHL responses with status 429',
+    ['location_id'],
+)
+GHL_OUTBOX_DELIVERIES = Counter(
+    'ghl_outbox_deliveries',
+    'Outbox messages relayed by operation and outcome: sent, failed, or deferred behind a pending contact',
+    ['operation', 'outcome'],
+)
+
+HCP_WEBHOOK_VIEW_SECONDS = Histogram(
+    'hcp_webhook_view_seconds',
+    'Time spent in each phase of the webhook view: parse, dedup, store, dispatch, process',
+    ['phase'],
+    buckets=FAST_BUCKETS + (5.0, 10.0),
+)
+HCP_WEBHOOK_HANDLER_SECONDS = Histogram(
+    'hcp_webhook_handler_seconds',
+    'Time to process a webhook, from mapping lookup to handler return',
+    ['event', 'company_id', 'outcome'],
+)
+HCP_MAPPING_LOOKUP_SECONDS = Histogram(
+    'hcp_mapping_lookup_seconds',
+    'HCP company -> GHL mapping lookups by the tier that answered: local, shared or db',
+    ['tier'],
+    buckets=FAST_BUCKETS,
+)
+DB_QUERY_SECONDS = Histogram(
+    'db_query_seconds',
+    'Database queries run while processing a webhook',
+    ['event', 'statement'],
+    buckets=FAST_BUCKETS,
+)
+GHL_REQUEST_SECONDS = Histogram(
+    'ghl_request_seconds',
+    'GHL HTTP calls by endpoint template and status code, status "error" when no response came back',
+    ['method', 'endpoint', 'status_code'],
+)
+
+# Path segments that are part of the route, anything else (ids) becomes {id}
+_ROUTE_SEGMENT = re.compile(r'^[a-z][a-z_-]*$')
+
+
+def endpoint_template(url: str) -> str:
+    """/contacts/abc123XYZ -> /contacts/{id}, keeps the label set of GHL_REQUEST_SECONDS small"""
+    segments = urlsplit(url).path.split('/')
+    return '/'.join(segment if not segment or _ROUTE_SEGMENT.match(segment) else '{id}' for segment in segments)
+
+
+def observe(histogram: Histogram, seconds: float, **labels):
+    histogram.labels(**labels).observe(seconds)
+    if settings.METRICS_JSON_LOGS:
+        span_logger.info(json.dumps({'metric': histogram.describe()[0].name, 'seconds': round(seconds, 6), **labels}))
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    """Observe how long the block takes, labels known only at the end can be set on the yielded dict"""
+    started = time.perf_counter()
+    try:
+        yield labels
+    finally:
+        observe(histogram, time.perf_counter() - started, **labels)
+
+
+def query_timer(event: str):
+    """connection.execute_wrapper that feeds DB_QUERY_SECONDS, labelled with the SQL verb"""
+    def wrapper(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'OTHER'
+            observe(DB_QUERY_SECONDS, time.perf_counter() - started, event=event, statement=statement)
+    return wrapper
+
+
+def _metrics_allowed(request) -> bool:
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if token and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        return True
+    return request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+
+def metrics_view(request):
+    """Prometheus exposition, for METRICS_TOKEN holders and METRICS_ALLOWED_IPS only"""
+    if not _metrics_allowed(request):
+        return HttpResponseForbidden()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
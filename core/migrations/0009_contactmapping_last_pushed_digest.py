@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 19:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_webhook_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contactmapping',
+            name='last_pushed_digest',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2 on 2026-10-17 19:58
+
+import logging
+from django.db import migrations, models
+
+logger = logging.getLogger(__name__)
+
+
+def remove_duplicate_job_mappings(apps, schema_editor):
+    """Keep the oldest mapping per job, it is the one .filter().first() has been returning.
+
+    Every deleted row is logged with its GHL opportunity, those opportunities
+    stay in GHL and may need to be merged or removed by hand.
+    """
+    OpportunityMapping = apps.get_model('core', 'OpportunityMapping')
+    duplicates = (
+        OpportunityMapping.objects.filter(hcp_job_id__isnull=False)
+        .values('hcp_job_id', 'hcp_company_id')
+        .order_by()
+        .annotate(count=models.Count('id'), keep_id=models.Min('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        extra = OpportunityMapping.objects.filter(
+            hcp_job_id=duplicate['hcp_job_id'],
+            hcp_company_id=duplicate['hcp_company_id'],
+        ).exclude(id=duplicate['keep_id'])
+        for mapping_id, ghl_opportunity_id, hcp_estimate_id in extra.values_list('id', 'ghl_opportunity_id', 'hcp_estimate_id'):
+            logger.warning(
+                f"Deleting duplicate OpportunityMapping {mapping_id} of job {duplicate['hcp_job_id']} "
+                f"(company {duplicate['hcp_company_id']}, estimate {hcp_estimate_id}): GHL opportunity "
+                f"{ghl_opportunity_id} is no longer mapped, kept mapping {duplicate['keep_id']}"
+            )
+        extra.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_contactmapping_last_pushed_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ghlauthcredentials',
+            name='location_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(remove_duplicate_job_mappings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='opportunitymapping',
+            constraint=models.UniqueConstraint(condition=models.Q(('hcp_job_id__isnull', False)), fields=('hcp_job_id', 'hcp_company_id'), name='unique_opportunity_job_per_company'),
+        ),
+    ]
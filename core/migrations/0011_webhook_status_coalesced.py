@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 20:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_mapping_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='webhook',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processed', 'Processed'), ('failed', 'Failed'), ('coalesced', 'Coalesced')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-17 20:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_ghloutboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='payload_compressed',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='webhook',
+            name='payload',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='webhook',
+            index=models.Index(fields=['received_at'], name='webhook_received_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='webhook',
+            index=models.Index(fields=['company_id', 'received_at'], name='webhook_company_received_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='webhook',
+            index=models.Index(fields=['event', 'received_at'], name='webhook_event_received_idx'),
+        ),
+    ]
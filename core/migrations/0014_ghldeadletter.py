@@ -0,0 +1,40 @@
+# Generated by Django 5.2 on 2026-10-17 20:17
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_webhook_retention'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GHLDeadLetter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=10)),
+                ('url', models.CharField(max_length=500)),
+                ('body', models.JSONField(blank=True, null=True)),
+                ('location_id', models.CharField(blank=True, default='', max_length=255)),
+                ('event_type', models.CharField(blank=True, default='', max_length=100)),
+                ('error_class', models.CharField(max_length=100)),
+                ('error_message', models.TextField(blank=True, default='')),
+                ('status_code', models.IntegerField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=1)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('succeeded', 'Succeeded'), ('failed', 'Failed'), ('superseded', 'Superseded')], default='pending', max_length=20)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_attempt_at', models.DateTimeField(auto_now_add=True)),
+                ('resolved_at', models.DateTimeField(blank=True, null=True)),
+                ('credentials', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.ghlauthcredentials')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='deadletter_due_idx'), models.Index(fields=['url', 'status'], name='deadletter_url_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_ghldeadletter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhook',
+            name='raw_payload',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
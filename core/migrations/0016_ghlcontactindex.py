@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-17 20:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_webhook_raw_payload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GHLContactIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ghl_location_id', models.CharField(max_length=255)),
+                ('key', models.CharField(max_length=320)),
+                ('ghl_contact_id', models.CharField(max_length=255)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ghl_location_id', 'ghl_contact_id'], name='contactindex_contact_idx')],
+                'unique_together': {('ghl_location_id', 'key')},
+            },
+        ),
+    ]
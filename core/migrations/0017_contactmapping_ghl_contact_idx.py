@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-17 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_ghlcontactindex'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contactmapping',
+            index=models.Index(fields=['ghl_location_id', 'ghl_contact_id'], name='contact_ghl_contact_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_contactmapping_ghl_contact_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='opportunitymapping',
+            name='hcp_customer_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
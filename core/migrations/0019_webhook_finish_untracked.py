@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-17 21:30
+
+from datetime import timedelta
+from django.db import migrations
+from django.db.models import F
+from django.utils import timezone
+
+
+def finish_untracked_webhooks(apps, schema_editor):
+    """Webhooks stored before 0008 added status tracking are still 'pending' without processed_at.
+
+    They were processed when they arrived, so give them a terminal status and
+    processed_at=received_at, otherwise retention would treat them as unfinished.
+    Anything received in the last day may really be in flight and is left alone.
+    """
+    Webhook = apps.get_model('core', 'Webhook')
+    Webhook.objects.filter(
+        status='pending', processed_at__isnull=True, result__isnull=True,
+        received_at__lt=timezone.now() - timedelta(days=1),
+    ).update(
+        status='processed',
+        processed_at=F('received_at'),
+        result={'message': 'Received before webhook processing was tracked'},
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_opportunitymapping_hcp_customer_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(finish_untracked_webhooks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-17 21:00
+
+from datetime import timedelta
+from django.db import migrations, models
+
+
+def set_expires_at(apps, schema_editor):
+    """Best guess for existing rows, the time they were last saved plus expires_in"""
+    GHLAuthCredentials = apps.get_model('core', 'GHLAuthCredentials')
+    for credentials_id, updated_at, expires_in in GHLAuthCredentials.objects.values_list('id', 'updated_at', 'expires_in'):
+        GHLAuthCredentials.objects.filter(id=credentials_id).update(
+            expires_at=updated_at + timedelta(seconds=expires_in or 0)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_webhook_finish_untracked'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghlauthcredentials',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(set_expires_at, migrations.RunPython.noop),
+    ]
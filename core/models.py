@@ -1,6 +1,7 @@
 # models.py
 from django.db import models
 from django.utils import timezone
+from datetime import datetime, timedelta
 import uuid
 
 class GHLAuthCredentials(models.Model):
@@ -8,25 +9,67 @@ class GHLAuthCredentials(models.Model):
     access_token = models.TextField()
     refresh_token = models.TextField()
     expires_in = models.IntegerField()
+    # Set whenever a token pair is stored, saves of other fields don't move it
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
     scope = models.CharField(max_length=500, null=True, blank=True)
     user_type = models.CharField(max_length=50, null=True, blank=True)
     company_id = models.CharField(max_length=255, null=True, blank=True)
-    location_id = models.CharField(max_length=255, null=True, blank=True)
+    location_id = models.CharField(max_length=255, null=True, blank=True, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.user_id} - {self.company_id}"
+
+    @staticmethod
+    def expiry_for(expires_in) -> datetime:
+        """expires_at of a token pair GHL issued just now with this expires_in"""
+        return timezone.now() + timedelta(seconds=int(expires_in or 0))
     
 
 class Webhook(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSED = 'processed'
+    STATUS_FAILED = 'failed'
+    STATUS_COALESCED = 'coalesced'  # Buffered, or folded into a later webhook of the same job
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSED, 'Processed'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_COALESCED, 'Coalesced'),
+    ]
+
     event = models.CharField(max_length=100)
     company_id = models.CharField(max_length=100)
-    payload = models.JSONField()  # Store the entire raw payload
+    payload = models.JSONField(null=True, blank=True)  # Store the entire raw payload, moved to payload_compressed once old
+    payload_compressed = models.BinaryField(null=True, blank=True, editable=False)  # zlib JSON, see core/retention.py
+    raw_payload = models.BinaryField(null=True, blank=True, editable=False)  # JSON body as received, see core/ingest.py
     received_at = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    result = models.JSONField(null=True, blank=True)  # Outcome returned by process_webhook
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['received_at'], name='webhook_received_idx'),
+            models.Index(fields=['company_id', 'received_at'], name='webhook_company_received_idx'),
+            models.Index(fields=['event', 'received_at'], name='webhook_event_received_idx'),
+        ]
 
     def __str__(self):
         return f"{self.event} - {self.company_id}"
+
+    def get_payload(self):
+        """The webhook body, whether it is stored as JSON, raw bytes or compressed"""
+        if self.payload is not None:
+            return self.payload
+        if self.raw_payload is not None:
+            from .ingest import loads
+            return loads(bytes(self.raw_payload))
+        if self.payload_compressed is not None:
+            from .retention import decompress_payload
+            return decompress_payload(self.payload_compressed)
+        return None
     
     
 
@@ -47,16 +90,24 @@ class ContactMapping(models.Model):
     ghl_contact_id = models.CharField(max_length=255)
     hcp_company_id = models.CharField(max_length=255)
     ghl_location_id = models.CharField(max_length=255)
+    # Digest of the last contact payload sent to GHL, unchanged customers are not re-sent
+    last_pushed_digest = models.CharField(max_length=64, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ['hcp_customer_id', 'hcp_company_id']
+        indexes = [
+            # Which customer a GHL contact belongs to, see core/contact_index.py
+            models.Index(fields=['ghl_location_id', 'ghl_contact_id'], name='contact_ghl_contact_idx'),
+        ]
 
 class OpportunityMapping(models.Model):
     """Maps Housecall Pro estimates/jobs to GoHighLevel opportunities"""
     hcp_estimate_id = models.CharField(max_length=255, null=True, blank=True)
     hcp_job_id = models.CharField(max_length=255, null=True, blank=True)
+    # Routes appointment events, which only carry a job_id, to the lane of the customer (core/dispatch.py)
+    hcp_customer_id = models.CharField(max_length=255, null=True, blank=True)
     ghl_opportunity_id = models.CharField(max_length=255)
     hcp_company_id = models.CharField(max_length=255)
     ghl_location_id = models.CharField(max_length=255)
@@ -64,4 +115,109 @@ class OpportunityMapping(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        unique_together = ['hcp_estimate_id', 'hcp_company_id']
\ No newline at end of file
+        unique_together = ['hcp_estimate_id', 'hcp_company_id']
+        constraints = [
+            # One opportunity per job, also the index behind job lookups
+            models.UniqueConstraint(
+                fields=['hcp_job_id', 'hcp_company_id'],
+                condition=models.Q(hcp_job_id__isnull=False),
+                name='unique_opportunity_job_per_company',
+            ),
+        ]
+
+class GHLOutboxMessage(models.Model):
+    """A GHL create recorded in the same transaction as its placeholder mapping, relayed by core/outbox.py"""
+    OPERATION_CREATE_CONTACT = 'create_contact'
+    OPERATION_CREATE_OPPORTUNITY = 'create_opportunity'
+    OPERATION_CHOICES = [
+        (OPERATION_CREATE_CONTACT, 'Create contact'),
+        (OPERATION_CREATE_OPPORTUNITY, 'Create opportunity'),
+    ]
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    operation = models.CharField(max_length=30, choices=OPERATION_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    hcp_company_id = models.CharField(max_length=255)
+    ghl_location_id = models.CharField(max_length=255)
+    # The placeholder mapping whose GHL id the relay fills in
+    contact_mapping = models.ForeignKey(ContactMapping, null=True, blank=True, on_delete=models.CASCADE, related_name='outbox_messages')
+    opportunity_mapping = models.ForeignKey(OpportunityMapping, null=True, blank=True, on_delete=models.CASCADE, related_name='outbox_messages')
+    payload = models.JSONField()  # event_type plus the HCP data the GHL payload is built from
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)  # Lease of the relay currently sending it
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.operation} ({self.status}) - {self.hcp_company_id}"
+
+
+class GHLDeadLetter(models.Model):
+    """A GHL update/delete that failed, kept with its raw request for retries, see core/deadletter.py"""
+    STATUS_PENDING = 'pending'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_SUPERSEDED = 'superseded'  # A later successful request overwrote everything it would set
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_SUPERSEDED, 'Superseded'),
+    ]
+
+    method = models.CharField(max_length=10)
+    url = models.CharField(max_length=500)
+    body = models.JSONField(null=True, blank=True)
+    location_id = models.CharField(max_length=255, blank=True, default='')
+    credentials = models.ForeignKey(GHLAuthCredentials, null=True, blank=True, on_delete=models.SET_NULL)
+    event_type = models.CharField(max_length=100, blank=True, default='')
+    error_class = models.CharField(max_length=100)
+    error_message = models.TextField(blank=True, default='')
+    status_code = models.IntegerField(null=True, blank=True)  # None for network errors
+    attempts = models.IntegerField(default=1)  # Including the original request
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_attempt_at = models.DateTimeField(auto_now_add=True)
+    resolved_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='deadletter_due_idx'),
+            models.Index(fields=['url', 'status'], name='deadletter_url_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.method} {self.url} ({self.status}, {self.attempts} attempts)"
+
+
+class GHLContactIndex(models.Model):
+    """Normalized email/phone of a GHL contact, looked up before creating contacts, see core/contact_index.py"""
+    ghl_location_id = models.CharField(max_length=255)
+    key = models.CharField(max_length=320)  # 'email:<lowercased address>' or 'phone:<E.164 number>'
+    ghl_contact_id = models.CharField(max_length=255)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['ghl_location_id', 'key']
+        indexes = [
+            models.Index(fields=['ghl_location_id', 'ghl_contact_id'], name='contactindex_contact_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.ghl_location_id} {self.key} -> {self.ghl_contact_id}"
@@ -0,0 +1,300 @@
+"""Transactional outbox for GHL contact and opportunity creates.
+
+Creating a GHL object and then its mapping row leaves an orphan in GHL if the
+process dies in between, and two workers racing on the same customer both
+create one. Instead the webhook handlers write a placeholder mapping (empty GHL
+id) and a GHLOutboxMessage in one transaction. The unique constraints on the
+mappings make get_or_create pick a single winner, so each HCP entity gets one
+message. The message is then relayed right away by the handler and, if that
+fails, by the relay_ghl_outbox beat task with backoff.
+
+An opportunity whose contact is still queued is queued behind it: its message
+names the HCP customer instead of a contact and waits, without using up its
+attempts, until the contact has been created.
+
+Relaying is safe to repeat. Contacts use GHL's upsert endpoint and are added
+to the contact index (core/contact_index.py) once created. A retried
+opportunity create first searches for the opportunity an earlier attempt may
+have created. The GHL id, and for contacts the pushed digest, are written
+together with the message status.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .cache import get_company_mapping
+from .contact_index import customer_keys, index_contact
+from .metrics import GHL_OUTBOX_DELIVERIES
+from .models import ContactMapping, GHLOutboxMessage, HCPToGHLMapping, OpportunityMapping
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the first retry, doubled per attempt
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 3600
+
+
+def _queue(operation: str, mapping: HCPToGHLMapping, payload: Dict[str, Any], created: bool, **target) -> GHLOutboxMessage:
+    """Refresh the pending message of a placeholder with the latest data, or add one"""
+    # A placeholder created in this transaction has no message yet
+    message = None if created else GHLOutboxMessage.objects.filter(
+        status=GHLOutboxMessage.STATUS_PENDING, **target
+    ).first()
+    if message:
+        message.payload = payload
+        message.save(update_fields=['payload'])
+        return message
+    return GHLOutboxMessage.objects.create(
+        operation=operation, hcp_company_id=mapping.hcp_company_id,
+        ghl_location_id=mapping.ghl_location_id, payload=payload, **target
+    )
+
+
+def queue_contact_create(mapping: HCPToGHLMapping, customer_data: Dict[str, Any], event_type: str,
+                         allow_duplicate: bool = False) -> ContactMapping:
+    """Return the customer's contact mapping, adding a placeholder and outbox message if it has no GHL contact yet.
+
+    allow_duplicate creates the contact even though GHL has one with the same
+    email/phone, used when that one is mapped to another customer.
+    """
+    with transaction.atomic():
+        contact_mapping, created = ContactMapping.objects.get_or_create(
+            hcp_customer_id=customer_data['id'],
+            hcp_company_id=mapping.hcp_company_id,
+            defaults={'ghl_contact_id': '', 'ghl_location_id': mapping.ghl_location_id},
+        )
+        if not contact_mapping.ghl_contact_id:
+            _queue(
+                GHLOutboxMessage.OPERATION_CREATE_CONTACT, mapping,
+                {'event_type': event_type, 'customer': customer_data, 'allow_duplicate': allow_duplicate}, created,
+                contact_mapping=contact_mapping,
+            )
+    return contact_mapping
+
+
+def adopt_contact(mapping: HCPToGHLMapping, customer_data: Dict[str, Any], ghl_contact_id: str) -> ContactMapping:
+    """Map the customer to a GHL contact that already exists, settling the pending create of its placeholder"""
+    with transaction.atomic():
+        contact_mapping, created = ContactMapping.objects.get_or_create(
+            hcp_customer_id=customer_data['id'],
+            hcp_company_id=mapping.hcp_company_id,
+            defaults={'ghl_contact_id': ghl_contact_id, 'ghl_location_id': mapping.ghl_location_id},
+        )
+        if not created and not contact_mapping.ghl_contact_id:
+            contact_mapping.ghl_contact_id = ghl_contact_id
+            contact_mapping.save(update_fields=['ghl_contact_id', 'updated_at'])
+            GHLOutboxMessage.objects.filter(
+                contact_mapping=contact_mapping, status=GHLOutboxMessage.STATUS_PENDING
+            ).update(status=GHLOutboxMessage.STATUS_SENT, sent_at=timezone.now(), last_error='Matched an existing GHL contact')
+    return contact_mapping
+
+
+def queue_opportunity_create(mapping: HCPToGHLMapping, lookup: Dict[str, Any], defaults: Dict[str, Any],
+                             contact_id: Optional[str], opportunity_data: Dict[str, Any], event_type: str,
+                             status: Optional[str] = None, customer_id: Optional[str] = None) -> OpportunityMapping:
+    """Opportunity counterpart of queue_contact_create, lookup is hcp_estimate_id or hcp_job_id.
+
+    Without a contact_id the create waits for the queued contact of customer_id.
+    """
+    with transaction.atomic():
+        opp_mapping, created = OpportunityMapping.objects.get_or_create(
+            hcp_company_id=mapping.hcp_company_id,
+            defaults={'ghl_opportunity_id': '', 'ghl_location_id': mapping.ghl_location_id, **defaults},
+            **lookup
+        )
+        if not opp_mapping.ghl_opportunity_id:
+            _queue(
+                GHLOutboxMessage.OPERATION_CREATE_OPPORTUNITY, mapping,
+                {'event_type': event_type, 'contact_id': contact_id, 'customer_id': customer_id,
+                 'opportunity': opportunity_data, 'status': status},
+                created, opportunity_mapping=opp_mapping,
+            )
+    return opp_mapping
+
+
+class ContactPending(Exception):
+    """The contact of an opportunity message is still queued"""
+
+
+def _contact_id(message: GHLOutboxMessage) -> str:
+    """GHL contact of an opportunity message, raises ContactPending while its create is queued"""
+    payload = message.payload
+    if payload.get('contact_id'):
+        return payload['contact_id']
+    contact_mapping = ContactMapping.objects.filter(
+        hcp_customer_id=payload.get('customer_id'), hcp_company_id=message.hcp_company_id
+    ).first()
+    if contact_mapping and contact_mapping.ghl_contact_id:
+        return contact_mapping.ghl_contact_id
+    if contact_mapping and GHLOutboxMessage.objects.filter(
+        contact_mapping=contact_mapping, status=GHLOutboxMessage.STATUS_PENDING
+    ).exists():
+        raise ContactPending()
+    raise ValueError(f"No contact queued for HCP customer {payload.get('customer_id')}")
+
+
+def _claim(due_only: bool = True, **filters) -> List[GHLOutboxMessage]:
+    """Lease the pending messages matching filters to this relay, skipping any another relay holds"""
+    now = timezone.now()
+    with transaction.atomic():
+        queryset = GHLOutboxMessage.objects.select_for_update(skip_locked=True).filter(
+            Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+            status=GHLOutboxMessage.STATUS_PENDING, **filters
+        )
+        if due_only:
+            queryset = queryset.filter(next_attempt_at__lte=now)
+        messages = list(queryset.select_related('contact_mapping', 'opportunity_mapping'))
+        GHLOutboxMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            locked_until=now + timedelta(seconds=settings.GHL_OUTBOX_LEASE_SECONDS), attempts=F('attempts') + 1
+        )
+    for message in messages:
+        message.attempts += 1
+    return messages
+
+
+def _send(message: GHLOutboxMessage) -> Optional[str]:
+    """Make the GHL call of a claimed message, returns the GHL id"""
+    from .services import GoHighLevelService, build_opportunity_create_payload
+
+    company_mapping = get_company_mapping(message.hcp_company_id)
+    credentials = company_mapping.ghl_credentials
+    payload = message.payload
+    service = GoHighLevelService(
+        credentials.access_token, payload.get('event_type'),
+        credentials=credentials, location_id=message.ghl_location_id,
+    )
+
+    if message.operation == GHLOutboxMessage.OPERATION_CREATE_CONTACT:
+        if payload.get('allow_duplicate'):
+            # An upsert would return the other customer's contact
+            return service.create_contact(message.ghl_location_id, payload['customer'])
+        return service.upsert_contact(message.ghl_location_id, payload['customer'])
+
+    contact_id = _contact_id(message)
+    if message.attempts > 1:
+        # An earlier attempt may have reached GHL before failing
+        name = build_opportunity_create_payload(
+            message.ghl_location_id, contact_id, payload['opportunity'], service.PIPELINE_ID, ''
+        )['name']
+        existing_id = service.search_opportunity(message.ghl_location_id, contact_id, name)
+        if existing_id:
+            logger.info(f"Outbox message {message.id} found opportunity {existing_id} from an earlier attempt")
+            if payload.get('status'):
+                service.update_opportunity(existing_id, payload['opportunity'], status=payload['status'])
+            return existing_id
+    return service.create_opportunity(
+        message.ghl_location_id, contact_id, payload['opportunity'], status=payload.get('status')
+    )
+
+
+def _deliver(message: GHLOutboxMessage) -> Tuple[Optional[str], str]:
+    """Send a claimed message and record the outcome with the mapping it fills.
+
+    Returns the GHL id and the outcome: 'sent', 'failed' or 'deferred'.
+    """
+    ghl_id, outcome = _deliver_once(message)
+    GHL_OUTBOX_DELIVERIES.labels(operation=message.operation, outcome=outcome).inc()
+    return ghl_id, outcome
+
+
+def _deliver_once(message: GHLOutboxMessage) -> Tuple[Optional[str], str]:
+    from .services import build_contact_payload, contact_payload_digest
+
+    try:
+        ghl_id = _send(message)
+        error = '' if ghl_id else 'GHL did not return an id'
+    except ContactPending:
+        # Not an attempt, checked again after the first retry delay
+        GHLOutboxMessage.objects.filter(id=message.id).update(
+            locked_until=None, attempts=F('attempts') - 1, last_error='Waiting for the contact to be created',
+            next_attempt_at=timezone.now() + timedelta(seconds=RETRY_BASE_DELAY),
+        )
+        return None, 'deferred'
+    except HCPToGHLMapping.DoesNotExist:
+        ghl_id, error = None, f"No GHL mapping found for HCP company {message.hcp_company_id}"
+    except Exception as e:
+        logger.exception(f"Error relaying outbox message {message.id}")
+        ghl_id, error = None, str(e)
+
+    now = timezone.now()
+    if ghl_id:
+        with transaction.atomic():
+            if message.contact_mapping_id:
+                digest = contact_payload_digest(build_contact_payload(message.payload['customer']))
+                ContactMapping.objects.filter(id=message.contact_mapping_id).update(
+                    ghl_contact_id=ghl_id, last_pushed_digest=digest, updated_at=now
+                )
+                index_contact(message.ghl_location_id, ghl_id, customer_keys(message.payload['customer']))
+            elif message.opportunity_mapping_id:
+                OpportunityMapping.objects.filter(id=message.opportunity_mapping_id).update(
+                    ghl_opportunity_id=ghl_id, updated_at=now
+                )
+            GHLOutboxMessage.objects.filter(id=message.id).update(
+                status=GHLOutboxMessage.STATUS_SENT, sent_at=now, locked_until=None, last_error=''
+            )
+        return ghl_id, 'sent'
+
+    if message.attempts >= settings.GHL_OUTBOX_MAX_ATTEMPTS:
+        status = GHLOutboxMessage.STATUS_FAILED
+        logger.error(f"Outbox message {message.id} failed after {message.attempts} attempts: {error}")
+    else:
+        status = GHLOutboxMessage.STATUS_PENDING
+        logger.warning(f"Outbox message {message.id} attempt {message.attempts} failed, retrying later: {error}")
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (message.attempts - 1)))
+    GHLOutboxMessage.objects.filter(id=message.id).update(
+        status=status, locked_until=None, last_error=error, next_attempt_at=now + timedelta(seconds=delay)
+    )
+    return None, 'failed'
+
+
+def relay_now(**target) -> Optional[str]:
+    """Relay the pending message of one placeholder mapping right away, ignoring its backoff.
+
+    Called by the handlers after queueing, e.g. relay_now(contact_mapping=contact_mapping).
+    Returns the GHL id, None if the send failed or another relay holds the message.
+    """
+    ghl_id = None
+    for message in _claim(due_only=False, **target):
+        ghl_id, _ = _deliver(message)
+    return ghl_id
+
+
+def _deliver_in_thread(message: GHLOutboxMessage) -> Tuple[Optional[str], str]:
+    try:
+        return _deliver(message)
+    finally:
+        # Worker threads open their own DB connection
+        connection.close()
+
+
+def relay_outbox(batch_size: int = None, max_batches: int = 10) -> Dict[str, int]:
+    """Drain due outbox messages in batches, GHL calls of a batch run in parallel.
+
+    Contacts are sent before opportunities so a batch never needs a contact
+    it is creating itself. Opportunities still waiting for their contact
+    count as 'deferred', not 'failed'.
+    """
+    batch_size = batch_size or settings.GHL_OUTBOX_BATCH_SIZE
+    stats = {'sent': 0, 'failed': 0, 'deferred': 0}
+    for _ in range(max_batches):
+        due_ids = list(GHLOutboxMessage.objects.filter(
+            status=GHLOutboxMessage.STATUS_PENDING, next_attempt_at__lte=timezone.now()
+        ).order_by('id').values_list('id', flat=True)[:batch_size])
+        messages = _claim(id__in=due_ids)
+        if not messages:
+            break
+
+        for operation in (GHLOutboxMessage.OPERATION_CREATE_CONTACT, GHLOutboxMessage.OPERATION_CREATE_OPPORTUNITY):
+            group = [message for message in messages if message.operation == operation]
+            if not group:
+                continue
+            with ThreadPoolExecutor(max_workers=settings.GHL_OUTBOX_RELAY_CONCURRENCY) as pool:
+                for _, outcome in pool.map(_deliver_in_thread, group):
+                    stats[outcome] += 1
+        if len(due_ids) < batch_size:
+            break
+    return stats
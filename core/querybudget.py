@@ -0,0 +1,150 @@
+"""ORM query budgets per HCP event, and a detector for repeated queries.
+
+QueryRecorder records every query run on a connection while it is active:
+
+    with QueryRecorder() as recorder:
+        HousecallProWebhookService().process_webhook(webhook)
+    recorder.count, recorder.seconds, recorder.repeated()
+
+Transaction control (BEGIN, SAVEPOINT, ...) is recorded but not counted, so
+counts are the same on PostgreSQL and SQLite.
+
+QUERY_BUDGETS is the most queries an event may take, whether or not its
+customer, estimate and job are mapped yet. MAPPED_QUERY_BUDGETS is the much
+smaller budget of the common case, where they all are. core/tests.py fails
+when an event goes over either budget. With HCP_QUERY_BUDGET_CHECK on, process_webhook also
+records every webhook and logs a warning when it goes over its budget or runs
+the same statement REPEATED_QUERY_THRESHOLD times or more (an N+1).
+"""
+import logging
+import time
+from collections import Counter
+from typing import List, Tuple
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+# The same SQL (parameters aside) this many times in one webhook is reported as an N+1
+REPEATED_QUERY_THRESHOLD = 3
+
+# A create through the outbox: get_or_create of the placeholder, insert of the
+# message, claim of the message, then store the GHL id and mark the message sent
+OUTBOX_CREATE_QUERIES = 7
+
+# Contact index lookup before a contact create, check that a match isn't another
+# customer's contact, index write once the contact is created
+CONTACT_INDEX_QUERIES = 3
+
+# Every budget includes 1 for the company mapping, when it isn't cached yet
+CUSTOMER_BUDGET = 1 + 1 + CONTACT_INDEX_QUERIES + OUTBOX_CREATE_QUERIES  # customer lookup + create
+OPPORTUNITY_BUDGET = CUSTOMER_BUDGET + 1 + OUTBOX_CREATE_QUERIES  # + opportunity lookup + create
+
+# Customer, estimate and job already mapped: customer lookup, then if the
+# contact changed the dead letter check after the GHL update, the pushed
+# digest and the index write
+MAPPED_CUSTOMER_BUDGET = 1 + 1 + 3
+MAPPED_OPPORTUNITY_BUDGET = MAPPED_CUSTOMER_BUDGET + 1 + 1  # + opportunity lookup, dead letter check after the update
+
+# Appointment events: company mapping, job opportunity lookup, dead letter check after the update
+DEFAULT_QUERY_BUDGET = 3
+QUERY_BUDGETS = {
+    'customer.created': CUSTOMER_BUDGET,
+    'customer.updated': CUSTOMER_BUDGET,
+    # customer lookup, dead letter check after the GHL delete, index cleanup,
+    # delete of the mapping and its outbox messages
+    'customer.deleted': 1 + 5,
+    'estimate.created': OPPORTUNITY_BUDGET,
+    'estimate.updated': OPPORTUNITY_BUDGET,
+    'estimate.scheduled': OPPORTUNITY_BUDGET,
+    'estimate.on_my_way': OPPORTUNITY_BUDGET,
+    'estimate.completed': OPPORTUNITY_BUDGET,
+    'estimate.sent': OPPORTUNITY_BUDGET,
+    'estimate.option.created': OPPORTUNITY_BUDGET,
+    'estimate.option.approval_status_changed': OPPORTUNITY_BUDGET,
+    # customer, then the estimate opportunity to close
+    'estimate.copy_to_job': CUSTOMER_BUDGET + 1,
+    # The job and estimate opportunities are looked up in one query
+    'job.created': OPPORTUNITY_BUDGET,
+    'job.updated': OPPORTUNITY_BUDGET,
+    'job.scheduled': OPPORTUNITY_BUDGET,
+    'job.on_my_way': OPPORTUNITY_BUDGET,
+    'job.started': OPPORTUNITY_BUDGET,
+    'job.completed': OPPORTUNITY_BUDGET,
+    'job.canceled': OPPORTUNITY_BUDGET,
+    'job.deleted': OPPORTUNITY_BUDGET,
+    'job.paid': OPPORTUNITY_BUDGET,
+}
+
+
+# customer.deleted and appointment events only run for mapped entities, their budgets apply as they are
+MAPPED_QUERY_BUDGETS = {
+    'customer.created': MAPPED_CUSTOMER_BUDGET,
+    'customer.updated': MAPPED_CUSTOMER_BUDGET,
+    **{
+        event_type: MAPPED_OPPORTUNITY_BUDGET for event_type in QUERY_BUDGETS
+        if event_type.startswith(('estimate.', 'job.'))
+    },
+}
+
+
+def query_budget(event_type: str, mapped: bool = False) -> int:
+    """Query budget of an event, mapped for the budget when its entities are already mapped"""
+    if mapped and event_type in MAPPED_QUERY_BUDGETS:
+        return MAPPED_QUERY_BUDGETS[event_type]
+    return QUERY_BUDGETS.get(event_type, DEFAULT_QUERY_BUDGET)
+
+
+class QueryRecorder:
+    """Records (sql, seconds) of every query run on one connection while active"""
+
+    def __init__(self, using: str = DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.queries: List[Tuple[str, float]] = []
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - started))
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._wrapper.__exit__(*exc)
+
+    @property
+    def statements(self) -> List[str]:
+        """SQL of the recorded queries, without transaction control"""
+        return [sql for sql, _ in self.queries if not sql.lstrip().upper().startswith(TRANSACTION_STATEMENTS)]
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def seconds(self) -> float:
+        return sum(seconds for _, seconds in self.queries)
+
+    def repeated(self, threshold: int = REPEATED_QUERY_THRESHOLD) -> List[Tuple[str, int]]:
+        """Statements run at least threshold times, most frequent first"""
+        return [(sql, count) for sql, count in Counter(self.statements).most_common() if count >= threshold]
+
+
+def check_query_budget(event_type: str, recorder: QueryRecorder, mapped: bool = False) -> List[str]:
+    """Problems of one recorded webhook, each also logged as a warning"""
+    problems = []
+    budget = query_budget(event_type, mapped)
+    if recorder.count > budget:
+        problems.append(f"{event_type} ran {recorder.count} queries, budget {budget}")
+    for sql, count in recorder.repeated():
+        problems.append(f"{event_type} ran the same query {count} times: {sql[:200]}")
+    for problem in problems:
+        logger.warning(f"Query budget: {problem} ({recorder.seconds * 1000:.1f} ms in queries)")
+    return problems
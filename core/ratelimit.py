@@ -0,0 +1,188 @@
+"""Client-side rate limiting for GoHighLevel API calls.
+
+Each GHL location gets a burst bucket (GHL_RATE_LIMIT_BURST requests per
+GHL_RATE_LIMIT_INTERVAL seconds) and a daily bucket (GHL_RATE_LIMIT_DAILY per
+day). Buckets live in Redis so every gunicorn and celery process draws from the
+same budget. If Redis is unreachable each process falls back to its own buckets.
+"""
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Optional
+import redis
+from django.conf import settings
+from .metrics import GHL_RATE_LIMIT_REMAINING, GHL_RATE_LIMIT_TOKENS, GHL_RATE_LIMIT_WAIT_SECONDS
+from .utils import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# KEYS: one bucket per window. ARGV: capacity and refill rate (tokens/ms) per bucket.
+# Takes a token from every bucket or from none, returns the wait in ms (0 when
+# granted) and the level of the first bucket.
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local levels = {}
+local wait = 0
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now_ms
+    tokens = math.min(capacity, tokens + math.max(0, now_ms - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens) / rate))
+    end
+end
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    if wait == 0 then
+        levels[i] = levels[i] - 1
+    end
+    redis.call('HSET', KEYS[i], 'tokens', levels[i], 'ts', now_ms)
+    redis.call('PEXPIRE', KEYS[i], math.ceil(capacity / rate) + 1000)
+end
+return {wait, tostring(levels[1])}
+"""
+
+
+class _LocalBuckets:
+    """Same algorithm as TOKEN_BUCKET_SCRIPT, per process"""
+
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def take(self, keys, windows):
+        now_ms = time.time() * 1000
+        with self._lock:
+            levels = []
+            wait = 0
+            for key, (capacity, rate) in zip(keys, windows):
+                tokens, ts = self._state.get(key, (capacity, now_ms))
+                tokens = min(capacity, tokens + max(0, now_ms - ts) * rate)
+                levels.append(tokens)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            if not wait:
+                levels = [tokens - 1 for tokens in levels]
+            for key, tokens in zip(keys, levels):
+                self._state[key] = (tokens, now_ms)
+        return wait, levels[0]
+
+
+class GHLRateLimiter:
+    def __init__(self):
+        self._local = _LocalBuckets()
+        self._script = None
+
+    def _windows(self):
+        return [
+            (settings.GHL_RATE_LIMIT_BURST, settings.GHL_RATE_LIMIT_BURST / (settings.GHL_RATE_LIMIT_INTERVAL * 1000)),
+            (settings.GHL_RATE_LIMIT_DAILY, settings.GHL_RATE_LIMIT_DAILY / (86400 * 1000)),
+        ]
+
+    def _take(self, location_id: str):
+        keys = [f"ghl:ratelimit:{location_id}:burst", f"ghl:ratelimit:{location_id}:daily"]
+        windows = self._windows()
+        try:
+            if self._script is None:
+                self._script = get_redis_client().register_script(TOKEN_BUCKET_SCRIPT)
+            args = [value for window in windows for value in window]
+            wait_ms, level = self._script(keys=keys, args=args)
+            return int(wait_ms) / 1000, float(level)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Redis unavailable for GHL rate limiting, using process-local buckets: {e}")
+            wait_ms, level = self._local.take(keys, windows)
+            return wait_ms / 1000, level
+
+    def acquire(self, location_id: str, max_wait: float = None) -> bool:
+        """Block until a request for location_id is allowed.
+
+        Returns False if that would take longer than max_wait, the caller then
+        sends anyway and relies on 429 handling.
+        """
+        max_wait = settings.GHL_RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait, level = self._take(location_id)
+            if not wait:
+                GHL_RATE_LIMIT_TOKENS.labels(location_id=location_id).set(level)
+                return True
+            if time.monotonic() + wait > deadline:
+                logger.warning(f"GHL rate limiter for location {location_id} would wait {wait:.1f}s, sending anyway")
+                return False
+            # Small jitter so waiting workers don't wake up in lockstep
+            wait += random.uniform(0, 0.05)
+            GHL_RATE_LIMIT_WAIT_SECONDS.labels(location_id=location_id).inc(wait)
+            time.sleep(wait)
+
+    async def acquire_async(self, location_id: str, max_wait: float = None) -> bool:
+        """acquire() for event loops, the Redis call runs in a thread and waits don't block"""
+        max_wait = settings.GHL_RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait, level = await asyncio.to_thread(self._take, location_id)
+            if not wait:
+                GHL_RATE_LIMIT_TOKENS.labels(location_id=location_id).set(level)
+                return True
+            if time.monotonic() + wait > deadline:
+                logger.warning(f"GHL rate limiter for location {location_id} would wait {wait:.1f}s, sending anyway")
+                return False
+            wait += random.uniform(0, 0.05)
+            GHL_RATE_LIMIT_WAIT_SECONDS.labels(location_id=location_id).inc(wait)
+            await asyncio.sleep(wait)
+
+
+rate_limiter = GHLRateLimiter()
+
+
+def observe_rate_limit_headers(location_id: str, response):
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    if remaining is not None:
+        try:
+            GHL_RATE_LIMIT_REMAINING.labels(location_id=location_id).set(float(remaining))
+        except ValueError:
+            pass
+
+
+def retry_after(response) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (seconds or HTTP date), None without a valid one"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(response, attempt: int) -> float:
+    """Seconds to wait before retrying a 429.
+
+    Honors Retry-After (seconds or HTTP date) and GHL's
+    X-RateLimit-Interval-Milliseconds, otherwise exponential backoff with full jitter.
+    """
+    seconds = retry_after(response)
+    if seconds is not None:
+        return seconds + random.uniform(0, 0.5)
+
+    if response.headers.get('X-RateLimit-Remaining') == '0' and response.headers.get('X-RateLimit-Interval-Milliseconds'):
+        try:
+            return float(response.headers['X-RateLimit-Interval-Milliseconds']) / 1000 + random.uniform(0, 0.5)
+        except ValueError:
+            pass
+
+    backoff = min(settings.GHL_BACKOFF_MAX, settings.GHL_BACKOFF_BASE * (2 ** attempt))
+    return random.uniform(0, backoff)
+
@@ -0,0 +1,190 @@
+"""Retention for the Webhook table.
+
+Two tiers after the live JSON payload:
+
+1. compress_old_webhooks moves the payload (or raw_payload) of finished
+   webhooks older than HCP_WEBHOOK_COMPRESS_AFTER_DAYS into payload_compressed
+   (zlib JSON, about a tenth of the size). Webhook.get_payload() reads any form.
+2. archive_old_webhooks writes webhooks older than HCP_WEBHOOK_RETENTION_DAYS
+   to gzipped JSONL files in HCP_WEBHOOK_ARCHIVE_DIR and deletes them.
+
+Webhooks that never finished (stuck pending, or buffered and never flushed)
+are kept HCP_WEBHOOK_STALE_GRACE_DAYS longer than finished ones, then
+compressed and archived the same way, so the table can't grow without bound.
+
+Both work in batches of HCP_WEBHOOK_PRUNE_BATCH_SIZE rows with one short
+transaction each, so no lock is held for long and autovacuum keeps up. An
+archive file is written and fsynced before its rows are deleted. A crash in
+between leaves the rows in the table, and the next run archives them again,
+so readers may see a webhook twice but never lose one.
+
+iter_archived_webhooks streams archive files back, one record at a time.
+"""
+import gzip
+import json
+import logging
+import os
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional, Union
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Webhook
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_PREFIX = 'webhooks-'
+ARCHIVE_SUFFIX = '.jsonl.gz'
+
+
+def compress_payload(payload: Any) -> bytes:
+    return zlib.compress(json.dumps(payload, separators=(',', ':'), cls=DjangoJSONEncoder).encode(), 6)
+
+
+def decompress_payload(data: Union[bytes, memoryview]) -> Any:
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def _retained(older_than_days: int) -> Q:
+    """Finished webhooks received more than older_than_days ago, unfinished ones past the stale grace period too"""
+    now = timezone.now()
+    stale_cutoff = now - timedelta(days=older_than_days + settings.HCP_WEBHOOK_STALE_GRACE_DAYS)
+    return (
+        Q(received_at__lt=now - timedelta(days=older_than_days), processed_at__isnull=False)
+        | Q(received_at__lt=stale_cutoff, processed_at__isnull=True)
+    )
+
+
+def compress_old_webhooks(older_than_days: int = None, batch_size: int = None, dry_run: bool = False) -> int:
+    """Compress the payloads of webhooks received more than older_than_days ago, returns the row count"""
+    older_than_days = settings.HCP_WEBHOOK_COMPRESS_AFTER_DAYS if older_than_days is None else older_than_days
+    batch_size = batch_size or settings.HCP_WEBHOOK_PRUNE_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    # Unfinished webhooks (pending, or buffered for coalescing) are left alone until they are stale
+    candidates = Webhook.objects.filter(Q(payload__isnull=False) | Q(raw_payload__isnull=False), _retained(older_than_days))
+    if dry_run:
+        return candidates.count()
+
+    compressed = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                candidates.filter(id__gt=last_id).order_by('id').select_for_update(skip_locked=True)
+                .only('id', 'payload', 'raw_payload')[:batch_size]
+            )
+            if not batch:
+                break
+            for webhook in batch:
+                if webhook.payload is not None:
+                    webhook.payload_compressed = compress_payload(webhook.payload)
+                else:
+                    # Already JSON bytes, no need to parse them
+                    webhook.payload_compressed = zlib.compress(bytes(webhook.raw_payload), 6)
+            Webhook.objects.bulk_update(batch, ['payload_compressed'])
+            # A queryset update stores SQL NULL, bulk_update would store JSON null
+            Webhook.objects.filter(id__in=[webhook.id for webhook in batch]).update(payload=None, raw_payload=None)
+        compressed += len(batch)
+        last_id = batch[-1].id
+    if compressed:
+        logger.info(f"Compressed payloads of {compressed} webhooks received before {cutoff:%Y-%m-%d}")
+    return compressed
+
+
+def _archive_record(webhook: Webhook) -> Dict[str, Any]:
+    return {
+        'id': webhook.id,
+        'event': webhook.event,
+        'company_id': webhook.company_id,
+        'received_at': webhook.received_at,
+        'status': webhook.status,
+        'result': webhook.result,
+        'processed_at': webhook.processed_at,
+        'payload': webhook.get_payload(),
+    }
+
+
+def _write_archive(path: Path, records: Iterable[Dict[str, Any]]):
+    """Write records to path atomically: a .tmp file that is fsynced and renamed"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(',', ':'), cls=DjangoJSONEncoder).encode() + b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+
+
+def archive_old_webhooks(older_than_days: int = None, archive_dir: str = None, batch_size: int = None,
+                         dry_run: bool = False) -> int:
+    """Move webhooks received more than older_than_days ago to archive files, returns the row count.
+
+    Every batch becomes its own file, named after the run and its id range.
+    """
+    older_than_days = settings.HCP_WEBHOOK_RETENTION_DAYS if older_than_days is None else older_than_days
+    archive_dir = Path(archive_dir or settings.HCP_WEBHOOK_ARCHIVE_DIR)
+    batch_size = batch_size or settings.HCP_WEBHOOK_PRUNE_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    candidates = Webhook.objects.filter(_retained(older_than_days))
+    if dry_run:
+        return candidates.count()
+
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    run = timezone.now().strftime('%Y%m%dT%H%M%S')
+    archived = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(candidates.filter(id__gt=last_id).order_by('id').select_for_update(skip_locked=True)[:batch_size])
+            if not batch:
+                break
+            path = archive_dir / f"{ARCHIVE_PREFIX}{run}-{batch[0].id:012d}-{batch[-1].id:012d}{ARCHIVE_SUFFIX}"
+            _write_archive(path, (_archive_record(webhook) for webhook in batch))
+            Webhook.objects.filter(id__in=[webhook.id for webhook in batch]).delete()
+        archived += len(batch)
+        last_id = batch[-1].id
+    if archived:
+        logger.info(f"Archived {archived} webhooks received before {cutoff:%Y-%m-%d} to {archive_dir}")
+    return archived
+
+
+def archive_files(paths: Iterable[Union[str, Path]]) -> Iterator[Path]:
+    """Archive files in paths, directories are expanded in name (= run, id) order"""
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(path.glob(f"{ARCHIVE_PREFIX}*{ARCHIVE_SUFFIX}"))
+        else:
+            yield path
+
+
+def iter_archived_webhooks(paths: Iterable[Union[str, Path]], event: Optional[str] = None,
+                           company_id: Optional[str] = None, since: Optional[datetime] = None,
+                           until: Optional[datetime] = None) -> Iterator[Dict[str, Any]]:
+    """Stream archived webhook records, optionally filtered, without loading whole files.
+
+    received_at and processed_at come back as datetimes, payload as stored.
+    """
+    for path in archive_files(paths):
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if event and record['event'] != event:
+                    continue
+                if company_id and record['company_id'] != company_id:
+                    continue
+                record['received_at'] = parse_datetime(record['received_at'])
+                if record.get('processed_at'):
+                    record['processed_at'] = parse_datetime(record['processed_at'])
+                if since and record['received_at'] < since:
+                    continue
+                if until and record['received_at'] >= until:
+                    continue
+                yield record
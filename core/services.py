@@ -1,12 +1,228 @@
 import requests
+import hashlib
 import json
 import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
 from typing import Dict, Any, Optional
+import redis
+from decouple import config
 from django.conf import settings
+from django.db import connection
+from django.db.models import Q
 from .models import GHLAuthCredentials, HCPToGHLMapping, ContactMapping, OpportunityMapping
+from .cache import get_company_mapping, invalidate_credentials
+from .contact_index import customer_keys, find_existing_contact, index_contact, unindex_contact
+from .metrics import (
+    GHL_RATE_LIMITED, GHL_REQUEST_SECONDS, HCP_WEBHOOK_HANDLER_SECONDS, endpoint_template, query_timer, timed,
+)
+from .deadletter import record_dead_letter, supersede_dead_letters
+from .outbox import adopt_contact, queue_contact_create, queue_opportunity_create, relay_now
+from .querybudget import QueryRecorder, check_query_budget
+from .ratelimit import observe_rate_limit_headers, rate_limiter, retry_delay
+from .utils import get_ghl_session, get_ghl_timeout, get_redis_client
 
 logger = logging.getLogger(__name__)
 
+GHL_TOKEN_URL = "https://services.leadconnectorhq.com/oauth/token"
+
+# HCP events that settle the job, and the GHL opportunity status they set
+CLOSING_EVENT_STATUS = {
+    'job.completed': 'won',
+    'job.paid': 'won',
+    'job.canceled': 'lost',
+    'job.deleted': 'lost',
+}
+
+
+def refresh_ghl_credentials(credentials: GHLAuthCredentials) -> bool:
+    """Exchange the refresh token of a credentials row for a new token pair and store it"""
+    try:
+        response = get_ghl_session().post(GHL_TOKEN_URL, data={
+            'grant_type': 'refresh_token',
+            'client_id': config("GHL_CLIENT_ID"),
+            'client_secret': config("GHL_CLIENT_SECRET"),
+            'refresh_token': credentials.refresh_token
+        }, timeout=get_ghl_timeout())
+        response.raise_for_status()
+        new_tokens = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error(f"Error refreshing GHL token for location {credentials.location_id}: {e}")
+        return False
+
+    if not new_tokens.get("access_token"):
+        logger.error(f"No access token in GHL refresh response for location {credentials.location_id}")
+        return False
+
+    credentials.access_token = new_tokens["access_token"]
+    credentials.refresh_token = new_tokens.get("refresh_token", credentials.refresh_token)
+    credentials.expires_in = new_tokens.get("expires_in", credentials.expires_in)
+    credentials.expires_at = GHLAuthCredentials.expiry_for(credentials.expires_in)
+    credentials.scope = new_tokens.get("scope", credentials.scope)
+    credentials.user_type = new_tokens.get("userType", credentials.user_type)
+    credentials.company_id = new_tokens.get("companyId", credentials.company_id)
+    credentials.save()
+    invalidate_credentials(credentials)
+    logger.info(f"Refreshed GHL token for location {credentials.location_id}")
+    return True
+
+
+def build_contact_payload(contact_data: Dict[str, Any]) -> Dict[str, Any]:
+    """GHL contact fields for an HCP customer, shared by create and update"""
+    # Prepare tags - always include housecallpro
+    tags = contact_data.get('tags', [])
+    if isinstance(tags, list):
+        tags = tags.copy()
+    else:
+        tags = []
+    
+    if 'housecallpro' not in tags:
+        tags.append('housecallpro')
+    
+    payload = {
+        "firstName": contact_data.get('first_name', ''),
+        "lastName": contact_data.get('last_name', ''),
+        "email": contact_data.get('email', ''),
+        "phone": contact_data.get('mobile_number', ''),
+        "source": contact_data.get('lead_source', 'HousecallPro'),
+        "tags": tags
+    }
+    
+    # Add custom fields for additional phone numbers
+    custom_fields = []
+    if contact_data.get('home_number'):
+        custom_fields.append({
+            "key": "home_phone",
+            "field_value": contact_data['home_number']
+        })
+    
+    if contact_data.get('work_number'):
+        custom_fields.append({
+            "key": "work_phone", 
+            "field_value": contact_data['work_number']
+        })
+    
+    if contact_data.get('company'):
+        custom_fields.append({
+            "key": "company",
+            "field_value": contact_data['company']
+        })
+    
+    if custom_fields:
+        payload['customFields'] = custom_fields
+    return payload
+
+
+def contact_payload_digest(payload: Dict[str, Any]) -> str:
+    """Stable hash of a contact payload, used to skip updates that change nothing"""
+    content = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _monetary_value(amount: Any) -> float:
+    """HCP amounts are in cents"""
+    try:
+        return float(amount) / 100
+    except (ValueError, TypeError):
+        return 0
+
+
+def build_opportunity_create_payload(location_id: str, contact_id: str, opportunity_data: Dict[str, Any],
+                                     pipeline_id: str, stage_id: str, status: Optional[str] = None) -> Dict[str, Any]:
+    """GHL opportunity fields for a new HCP estimate/job opportunity"""
+    # Determine opportunity name based on type
+    customer = opportunity_data.get('customer', {})
+    customer_name = f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip()
+    
+    if opportunity_data.get('estimate_number'):
+        name = f"{customer_name} - Estimate #{opportunity_data['estimate_number']}"
+    elif opportunity_data.get('invoice_number'):
+        name = f"{customer_name} - Job #{opportunity_data['invoice_number']}"
+    else:
+        name = f"{customer_name} - {opportunity_data.get('id', 'Unknown')}"
+    
+    # Get monetary value
+    monetary_value = 0
+    if opportunity_data.get('total_amount'):
+        monetary_value = _monetary_value(opportunity_data['total_amount'])
+    
+    payload = {
+        "pipelineId": pipeline_id,
+        "locationId": location_id,
+        "contactId": contact_id,
+        "name": name,
+        "source": opportunity_data.get('lead_source', 'HousecallPro'),
+        "status": status or "open",
+        "monetaryValue": monetary_value,
+    }
+    
+    if stage_id:
+        payload["pipelineStageId"] = stage_id
+    return payload
+
+
+def build_opportunity_update_payload(opportunity_data: Dict[str, Any], option_data: Optional[Dict[str, Any]],
+                                     stage_id: str, status: Optional[str] = None) -> Dict[str, Any]:
+    """Changed GHL opportunity fields for an HCP estimate/job update, empty if nothing changes"""
+    payload = {}
+    
+    if stage_id:
+        payload["pipelineStageId"] = stage_id
+    
+    # Won/lost goes out with the stage and value instead of a separate close call
+    if status:
+        payload["status"] = status
+    
+    # Update monetary value
+    if option_data and option_data.get("total_amount"):
+        payload["monetaryValue"] = _monetary_value(option_data["total_amount"])
+    elif opportunity_data.get('total_amount'):
+        payload["monetaryValue"] = _monetary_value(opportunity_data['total_amount'])
+    
+    # Update name if it's a job conversion
+    if opportunity_data.get('invoice_number'):
+        customer = opportunity_data.get('customer', {})
+        customer_name = f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip()
+        payload["name"] = f"{customer_name} - Job #{opportunity_data['invoice_number']}"
+    return payload
+
+
+_refresh_locks = defaultdict(threading.Lock)
+
+
+def refresh_ghl_credentials_once(credentials_id: int, stale_access_token: str) -> Optional[GHLAuthCredentials]:
+    """Refresh a token that stopped working, unless another worker already did.
+
+    GHL refresh tokens are single use, so concurrent refreshes would invalidate
+    each other. Callers are serialized per credentials row with a thread lock
+    and a Redis lock; whoever gets the lock second finds a new access token in
+    the DB and just uses it.
+    """
+    with _refresh_locks[credentials_id]:
+        try:
+            lock = get_redis_client().lock(f"ghl:token-refresh:{credentials_id}", timeout=60, blocking_timeout=60)
+            acquired = lock.acquire()
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Redis unavailable for token refresh lock, using process lock only: {e}")
+            lock, acquired = None, False
+
+        try:
+            credentials = GHLAuthCredentials.objects.get(id=credentials_id)
+            if credentials.access_token != stale_access_token:
+                return credentials
+            return credentials if refresh_ghl_credentials(credentials) else None
+        except GHLAuthCredentials.DoesNotExist:
+            return None
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except redis.exceptions.RedisError:
+                    pass
+
+
 class GoHighLevelService:
     BASE_URL = "https://services.leadconnectorhq.com"
     
@@ -43,7 +259,9 @@ class GoHighLevelService:
     }
     PIPELINE_ID = "kHLBjOkrltkMAOOIINvs" # This needs to be the actual pipeline ID in GHL
 
-    def __init__(self, access_token: str, event_type: str):
+    def __init__(self, access_token: str, event_type: str, session: Optional[requests.Session] = None,
+                 credentials: Optional[GHLAuthCredentials] = None, location_id: Optional[str] = None,
+                 dead_letters: bool = True):
         self.access_token = access_token
         self.headers = {
             'Accept': 'application/json',
@@ -52,6 +270,82 @@ class GoHighLevelService:
             'Version': '2021-07-28'
         }
         self.event_type = event_type
+        # Shared keep-alive session unless a caller injects its own
+        self.session = session or get_ghl_session()
+        self.timeout = get_ghl_timeout()
+        # Needed to refresh the token on a 401, without it 401s are returned as-is
+        self.credentials = credentials
+        # Rate limit bucket, calls without a location are not throttled client-side
+        self.location_id = location_id or (credentials.location_id if credentials else None)
+        # Record failed updates/deletes for retry, off when replaying dead letters themselves
+        self.dead_letters = dead_letters
+
+    def _set_access_token(self, access_token: str):
+        self.access_token = access_token
+        self.headers['Authorization'] = f'Bearer {access_token}'
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send through the rate limiter, retrying 429s with backoff.
+
+        A 429 whose wait is over GHL_BACKOFF_MAX is returned instead of slept
+        out, the caller dead-letters it or leaves it to the outbox.
+        """
+        max_retries = settings.GHL_RATE_LIMIT_MAX_RETRIES
+        for attempt in range(max_retries + 1):
+            if self.location_id:
+                rate_limiter.acquire(self.location_id)
+            with timed(GHL_REQUEST_SECONDS, method=method, endpoint=endpoint_template(url), status_code='error') as span:
+                response = self.session.request(method, url, headers=self.headers, timeout=self.timeout, **kwargs)
+                span['status_code'] = str(response.status_code)
+            if self.location_id:
+                observe_rate_limit_headers(self.location_id, response)
+            if response.status_code != 429 or attempt == max_retries:
+                return response
+
+            delay = retry_delay(response, attempt)
+            GHL_RATE_LIMITED.labels(location_id=self.location_id or '').inc()
+            if delay > settings.GHL_BACKOFF_MAX:
+                logger.warning(f"GHL rate limited {method} {url} for {delay:.1f}s, over GHL_BACKOFF_MAX, not waiting")
+                return response
+            logger.warning(f"GHL rate limited {method} {url}, retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+        return response
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request to GoHighLevel through the pooled session.
+
+        A 401 triggers one single-flight token refresh and the request is replayed
+        with the new token.
+        """
+        response = self._send(method, url, **kwargs)
+        if response.status_code != 401 or self.credentials is None:
+            return response
+
+        logger.info(f"GHL returned 401 for location {self.credentials.location_id}, refreshing token")
+        credentials = refresh_ghl_credentials_once(self.credentials.id, self.access_token)
+        if credentials is None:
+            return response
+
+        self.credentials = credentials
+        self._set_access_token(credentials.access_token)
+        return self._send(method, url, **kwargs)
+
+    def _write(self, method: str, url: str, payload: Optional[Dict[str, Any]] = None) -> bool:
+        """PUT/DELETE that dead-letters the request on failure, see core/deadletter.py"""
+        kwargs = {'json': payload} if payload is not None else {}
+        try:
+            response = self._request(method, url, **kwargs)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if self.dead_letters:
+                record_dead_letter(
+                    method, url, payload, e, location_id=self.location_id,
+                    credentials=self.credentials, event_type=self.event_type,
+                )
+            raise
+        if self.dead_letters:
+            supersede_dead_letters(method, url, payload)
+        return True
 
     def get_pipeline_stage_id(self, event_type: str) -> str:
         """Get GHL pipeline stage ID for HCP event type"""
@@ -61,51 +355,10 @@ class GoHighLevelService:
         """Create a contact in GoHighLevel with housecallpro tag"""
         url = f"{self.BASE_URL}/contacts/"
         
-        # Prepare tags - always include housecallpro
-        tags = contact_data.get('tags', [])
-        if isinstance(tags, list):
-            tags = tags.copy()
-        else:
-            tags = []
-        
-        if 'housecallpro' not in tags:
-            tags.append('housecallpro')
-        
-        payload = {
-            "locationId": location_id,
-            "firstName": contact_data.get('first_name', ''),
-            "lastName": contact_data.get('last_name', ''),
-            "email": contact_data.get('email', ''),
-            "phone": contact_data.get('mobile_number', ''),
-            "source": contact_data.get('lead_source', 'HousecallPro'),
-            "tags": tags
-        }
-        
-        # Add custom fields for additional phone numbers
-        custom_fields = []
-        if contact_data.get('home_number'):
-            custom_fields.append({
-                "key": "home_phone",
-                "field_value": contact_data['home_number']
-            })
-        
-        if contact_data.get('work_number'):
-            custom_fields.append({
-                "key": "work_phone", 
-                "field_value": contact_data['work_number']
-            })
-        
-        if contact_data.get('company'):
-            custom_fields.append({
-                "key": "company",
-                "field_value": contact_data['company']
-            })
-        
-        if custom_fields:
-            payload['customFields'] = custom_fields
+        payload = {"locationId": location_id, **build_contact_payload(contact_data)}
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self._request('POST', url, json=payload)
             response.raise_for_status()
             result = response.json()
             return result.get('contact', {}).get('id')
@@ -113,55 +366,63 @@ class GoHighLevelService:
             logger.error(f"Error creating contact in GHL: {e}")
             return None
 
+    def upsert_contact(self, location_id: str, contact_data: Dict[str, Any]) -> Optional[str]:
+        """Create a contact, or update the one GHL matches by email/phone, and return its ID.
+
+        Safe to repeat, used wherever a create may be retried.
+        """
+        url = f"{self.BASE_URL}/contacts/upsert"
+
+        payload = {"locationId": location_id, **build_contact_payload(contact_data)}
+
+        try:
+            response = self._request('POST', url, json=payload)
+            response.raise_for_status()
+            result = response.json()
+            return result.get('contact', {}).get('id')
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error upserting contact in GHL: {e}")
+            return None
+
+    def search_duplicate_contact(self, location_id: str, email: Optional[str] = None,
+                                 phone: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """The existing contact GHL's duplicate rules match to this email/phone, if any"""
+        url = f"{self.BASE_URL}/contacts/search/duplicate"
+
+        params = {"locationId": location_id}
+        if email:
+            params["email"] = email
+        if phone:
+            params["number"] = phone
+        try:
+            response = self._request('GET', url, params=params)
+            response.raise_for_status()
+            return response.json().get('contact') or None
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error searching duplicate contacts in GHL: {e}")
+            return None
+
+    def list_contacts(self, location_id: str, limit: int = 100, start_after_id: Optional[str] = None,
+                      start_after: Optional[int] = None) -> Dict[str, Any]:
+        """One page of a location's contacts ({'contacts': [...], 'meta': {...}}), raises on errors"""
+        url = f"{self.BASE_URL}/contacts/"
+
+        params = {"locationId": location_id, "limit": limit}
+        if start_after_id:
+            params["startAfterId"] = start_after_id
+            params["startAfter"] = start_after
+        response = self._request('GET', url, params=params)
+        response.raise_for_status()
+        return response.json()
+
     def update_contact(self, contact_id: str, contact_data: Dict[str, Any]) -> bool:
         """Update a contact in GoHighLevel"""
         url = f"{self.BASE_URL}/contacts/{contact_id}"
         
-        # Prepare tags - always include housecallpro
-        tags = contact_data.get('tags', [])
-        if isinstance(tags, list):
-            tags = tags.copy()
-        else:
-            tags = []
-        
-        if 'housecallpro' not in tags:
-            tags.append('housecallpro')
-        
-        payload = {
-            "firstName": contact_data.get('first_name', ''),
-            "lastName": contact_data.get('last_name', ''),
-            "email": contact_data.get('email', ''),
-            "phone": contact_data.get('mobile_number', ''),
-            "source": contact_data.get('lead_source', 'HousecallPro'),
-            "tags": tags
-        }
-        # Add custom fields for additional phone numbers
-        custom_fields = []
-        if contact_data.get('home_number'):
-            custom_fields.append({
-                "key": "home_phone",
-                "field_value": contact_data['home_number']
-            })
-        
-        if contact_data.get('work_number'):
-            custom_fields.append({
-                "key": "work_phone", 
-                "field_value": contact_data['work_number']
-            })
-        
-        if contact_data.get('company'):
-            custom_fields.append({
-                "key": "company",
-                "field_value": contact_data['company']
-            })
-        
-        if custom_fields:
-            payload['customFields'] = custom_fields
+        payload = build_contact_payload(contact_data)
 
         try:
-            response = requests.put(url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            return True
+            return self._write('PUT', url, payload)
         except requests.exceptions.RequestException as e:
             logger.error(f"Error updating contact in GHL: {e}")
             return False
@@ -171,53 +432,21 @@ class GoHighLevelService:
         url = f"{self.BASE_URL}/contacts/{contact_id}"
         
         try:
-            response = requests.delete(url, headers=self.headers)
-            response.raise_for_status()
-            return True
+            return self._write('DELETE', url)
         except requests.exceptions.RequestException as e:
             logger.error(f"Error deleting contact in GHL: {e}")
             return False
 
-    def create_opportunity(self, location_id: str, contact_id: str, opportunity_data: Dict[str, Any]) -> Optional[str]:
-        """Create an opportunity in GoHighLevel"""
+    def create_opportunity(self, location_id: str, contact_id: str, opportunity_data: Dict[str, Any],
+                           status: Optional[str] = None) -> Optional[str]:
+        """Create an opportunity in GoHighLevel, open unless status says otherwise"""
         url = f"{self.BASE_URL}/opportunities/"
         
         stage_id = self.get_pipeline_stage_id(self.event_type)
-        
-        # Determine opportunity name based on type
-        customer = opportunity_data.get('customer', {})
-        customer_name = f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip()
-        
-        if opportunity_data.get('estimate_number'):
-            name = f"{customer_name} - Estimate #{opportunity_data['estimate_number']}"
-        elif opportunity_data.get('invoice_number'):
-            name = f"{customer_name} - Job #{opportunity_data['invoice_number']}"
-        else:
-            name = f"{customer_name} - {opportunity_data.get('id', 'Unknown')}"
-        
-        # Get monetary value
-        monetary_value = 0
-        if opportunity_data.get('total_amount'):
-            try:
-                monetary_value = float(opportunity_data['total_amount']) / 100
-            except (ValueError, TypeError):
-                monetary_value = 0
-        
-        payload = {
-            "pipelineId": self.PIPELINE_ID,
-            "locationId": location_id,
-            "contactId": contact_id,
-            "name": name,
-            "source": opportunity_data.get('lead_source', 'HousecallPro'),
-            "status": "open",
-            "monetaryValue": monetary_value,
-        }
-        
-        if stage_id:
-            payload["pipelineStageId"] = stage_id
+        payload = build_opportunity_create_payload(location_id, contact_id, opportunity_data, self.PIPELINE_ID, stage_id, status)
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self._request('POST', url, json=payload)
             response.raise_for_status()
             result = response.json()
             return result.get('opportunity', {}).get('id')
@@ -225,42 +454,40 @@ class GoHighLevelService:
             logger.error(f"Error creating opportunity in GHL: {e}")
             return None
 
-    def update_opportunity(self, opportunity_id: str, opportunity_data: Dict[str, Any], option_data: Dict[str, Any] = None) -> bool:
-        """Update an opportunity in GoHighLevel"""
+    def search_opportunity(self, location_id: str, contact_id: str, name: str) -> Optional[str]:
+        """ID of the contact's opportunity in our pipeline with exactly this name, if any"""
+        url = f"{self.BASE_URL}/opportunities/search"
+
+        params = {
+            "location_id": location_id,
+            "contact_id": contact_id,
+            "pipeline_id": self.PIPELINE_ID,
+            "q": name,
+        }
+        try:
+            response = self._request('GET', url, params=params)
+            response.raise_for_status()
+            for opportunity in response.json().get('opportunities', []):
+                if opportunity.get('name') == name:
+                    return opportunity.get('id')
+            return None
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error searching opportunities in GHL: {e}")
+            return None
+
+    def update_opportunity(self, opportunity_id: str, opportunity_data: Dict[str, Any], option_data: Dict[str, Any] = None,
+                           status: Optional[str] = None) -> bool:
+        """Update an opportunity in GoHighLevel, optionally closing it as won/lost in the same request"""
         url = f"{self.BASE_URL}/opportunities/{opportunity_id}"
         
         stage_id = self.get_pipeline_stage_id(self.event_type)
-        
-        payload = {}
-        
-        if stage_id:
-            payload["pipelineStageId"] = stage_id
-        
-        # Update monetary value
-        if option_data and option_data.get("total_amount"):
-            try:
-                payload["monetaryValue"] = float(option_data["total_amount"]) / 100
-            except (ValueError, TypeError):
-                payload["monetaryValue"] = 0
-        elif opportunity_data.get('total_amount'):
-            try:
-                payload["monetaryValue"] = float(opportunity_data['total_amount']) / 100
-            except (ValueError, TypeError):
-                payload["monetaryValue"] = 0
-        
-        # Update name if it's a job conversion
-        if opportunity_data.get('invoice_number'):
-            customer = opportunity_data.get('customer', {})
-            customer_name = f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip()
-            payload["name"] = f"{customer_name} - Job #{opportunity_data['invoice_number']}"
+        payload = build_opportunity_update_payload(opportunity_data, option_data, stage_id, status)
         
         if not payload:
             return True  # Nothing to update
 
         try:
-            response = requests.put(url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            return True
+            return self._write('PUT', url, payload)
         except requests.exceptions.RequestException as e:
             logger.error(f"Error updating opportunity in GHL: {e}")
             return False
@@ -273,31 +500,58 @@ class GoHighLevelService:
             "status": "won" if won else "lost"
         }
         try:
-            response = requests.put(url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            return True
+            return self._write('PUT', url, payload)
         except requests.exceptions.RequestException as e:
             logger.error(f"Error closing opportunity in GHL: {e}")
             return False
 
+# Event types reported as their own label in the handler and query metrics
+METRIC_EVENT_TYPES = frozenset(GoHighLevelService.PIPELINE_STAGES) | {
+    'customer.created', 'customer.updated', 'customer.deleted',
+}
+
+
 class HousecallProWebhookService:
     def __init__(self):
         self.ghl_service = None
         self.event_type = None
 
-    def process_webhook(self, webhook_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Main method to process Housecall Pro webhooks"""
+    def process_webhook(self, webhook_data: Dict[str, Any], stage_event: Optional[str] = None) -> Dict[str, Any]:
+        """Main method to process Housecall Pro webhooks.
+
+        stage_event overrides the event whose pipeline stage is applied, used when
+        several coalesced events are applied with the payload of one of them.
+        """
         self.event_type = webhook_data.get('event')
         company_id = webhook_data.get('company_id')
         
         if not company_id:
             return {"error": "No company_id in webhook data"}
 
+        # Label values come from the request, keep unknown ones from growing the metric
+        event = self.event_type if self.event_type in METRIC_EVENT_TYPES else 'other'
+        self.ghl_service = None
+        recorder = QueryRecorder() if settings.HCP_QUERY_BUDGET_CHECK else None
+        with timed(HCP_WEBHOOK_HANDLER_SECONDS, event=event, company_id=company_id, outcome='exception') as span, \
+                connection.execute_wrapper(query_timer(event)), recorder or nullcontext():
+            result = self._process_webhook(webhook_data, company_id, stage_event)
+            span['outcome'] = 'error' if result.get('error') else 'ok'
+            if self.ghl_service is None:
+                span['company_id'] = 'unmapped'
+        if recorder:
+            check_query_budget(self.event_type, recorder)
+        return result
+
+    def _process_webhook(self, webhook_data: Dict[str, Any], company_id: str, stage_event: Optional[str]) -> Dict[str, Any]:
+        """Look up the company mapping and run the event's handler, timed by process_webhook"""
         # Get GHL mapping for this HCP company
         try:
-            mapping = HCPToGHLMapping.objects.get(hcp_company_id=company_id)
+            mapping = get_company_mapping(company_id)
             credentials = mapping.ghl_credentials
-            self.ghl_service = GoHighLevelService(credentials.access_token, self.event_type)
+            self.ghl_service = GoHighLevelService(
+                credentials.access_token, stage_event or self.event_type,
+                credentials=credentials, location_id=mapping.ghl_location_id
+            )
         except HCPToGHLMapping.DoesNotExist:
             return {"error": f"No GHL mapping found for HCP company {company_id}"}
 
@@ -358,25 +612,19 @@ class HousecallProWebhookService:
             hcp_company_id=mapping.hcp_company_id
         ).first()
         
-        if contact_mapping:
+        if contact_mapping and contact_mapping.ghl_contact_id:
             # If contact exists, ensure it's up-to-date
             logger.info(f"Contact for HCP customer {hcp_customer_id} already exists, attempting to update.")
-            success = self.ghl_service.update_contact(contact_mapping.ghl_contact_id, customer_data)
+            success = self._sync_contact(contact_mapping, customer_data)
             return {"message": "Contact already exists and updated" if success else "Contact already exists, but failed to update", "ghl_contact_id": contact_mapping.ghl_contact_id}
 
         # Create contact in GHL
-        ghl_contact_id = self.ghl_service.create_contact(mapping.ghl_location_id, customer_data)
+        ghl_contact_id = self._create_contact(customer_data, mapping)
         
         if ghl_contact_id:
-            ContactMapping.objects.create(
-                hcp_customer_id=hcp_customer_id,
-                ghl_contact_id=ghl_contact_id,
-                hcp_company_id=mapping.hcp_company_id,
-                ghl_location_id=mapping.ghl_location_id
-            )
             return {"message": "Contact created successfully", "ghl_contact_id": ghl_contact_id}
         else:
-            return {"error": "Failed to create contact in GHL"}
+            return {"error": "Failed to create contact in GHL, queued for retry"}
 
     def _handle_customer_updated(self, webhook_data: Dict[str, Any], mapping: HCPToGHLMapping) -> Dict[str, Any]:
         """Handle customer.updated webhook"""
@@ -388,11 +636,11 @@ class HousecallProWebhookService:
             hcp_company_id=mapping.hcp_company_id
         ).first()
         
-        if not contact_mapping:
+        if not contact_mapping or not contact_mapping.ghl_contact_id:
             logger.warning(f"Contact mapping for HCP customer {hcp_customer_id} not found on update, attempting to create.")
             return self._handle_customer_created(webhook_data, mapping)
         
-        success = self.ghl_service.update_contact(contact_mapping.ghl_contact_id, customer_data)
+        success = self._sync_contact(contact_mapping, customer_data)
         
         if success:
             return {"message": "Contact updated successfully"}
@@ -415,9 +663,15 @@ class HousecallProWebhookService:
         if not contact_mapping:
             return {"message": "Contact does not exist in GHL mapping, nothing to delete."}
 
+        if not contact_mapping.ghl_contact_id:
+            # Creation still queued, dropping the placeholder drops its outbox message
+            contact_mapping.delete()
+            return {"message": "Pending contact creation canceled."}
+
         success = self.ghl_service.delete_contact(contact_mapping.ghl_contact_id)
         
         if success:
+            unindex_contact(contact_mapping.ghl_location_id, contact_mapping.ghl_contact_id)
             contact_mapping.delete()
             return {"message": "Contact deleted successfully"}
         else:
@@ -461,7 +715,7 @@ class HousecallProWebhookService:
             hcp_company_id=mapping.hcp_company_id
         ).first()
 
-        if estimate_opp_mapping:
+        if estimate_opp_mapping and estimate_opp_mapping.ghl_opportunity_id:
             # Close the estimate opportunity as won
             success = self.ghl_service.close_opportunity(estimate_opp_mapping.ghl_opportunity_id, won=True)
             if success:
@@ -515,53 +769,32 @@ class HousecallProWebhookService:
         job_data = webhook_data.get('job', {})
         customer_data = job_data.get('customer', {})
         
-        result = self._create_or_update_job_opportunity(job_data, customer_data, mapping)
-        
-        # Also close the opportunity as won
-        if result.get('ghl_opportunity_id'):
-            self.ghl_service.close_opportunity(result['ghl_opportunity_id'], won=True)
-        
-        return result
+        # Stage, value and the 'won' status go out in a single request
+        return self._create_or_update_job_opportunity(job_data, customer_data, mapping, status='won')
 
     def _handle_job_canceled(self, webhook_data: Dict[str, Any], mapping: HCPToGHLMapping) -> Dict[str, Any]:
         """Handle job.canceled webhook"""
         job_data = webhook_data.get('job', {})
         customer_data = job_data.get('customer', {})
         
-        result = self._create_or_update_job_opportunity(job_data, customer_data, mapping)
-        
         # Close the opportunity as lost
-        if result.get('ghl_opportunity_id'):
-            self.ghl_service.close_opportunity(result['ghl_opportunity_id'], won=False)
-        
-        return result
+        return self._create_or_update_job_opportunity(job_data, customer_data, mapping, status='lost')
 
     def _handle_job_deleted(self, webhook_data: Dict[str, Any], mapping: HCPToGHLMapping) -> Dict[str, Any]:
         """Handle job.deleted webhook"""
         job_data = webhook_data.get('job', {})
         customer_data = job_data.get('customer', {})
         
-        result = self._create_or_update_job_opportunity(job_data, customer_data, mapping)
-        
         # Close the opportunity as lost
-        if result.get('ghl_opportunity_id'):
-            self.ghl_service.close_opportunity(result['ghl_opportunity_id'], won=False)
-        
-        return result
+        return self._create_or_update_job_opportunity(job_data, customer_data, mapping, status='lost')
 
     def _handle_job_paid(self, webhook_data: Dict[str, Any], mapping: HCPToGHLMapping) -> Dict[str, Any]:
         """Handle job.paid webhook"""
         job_data = webhook_data.get('job', {})
         customer_data = job_data.get('customer', {})
         
-        # When a job is paid, it signifies a successful completion. Update the opportunity.
-        result = self._create_or_update_job_opportunity(job_data, customer_data, mapping)
-        
-        # If it's paid, it should definitively be marked as won.
-        if result.get('ghl_opportunity_id'):
-            self.ghl_service.close_opportunity(result['ghl_opportunity_id'], won=True)
-            
-        return result
+        # When a job is paid, it signifies a successful completion, so it is definitively won.
+        return self._create_or_update_job_opportunity(job_data, customer_data, mapping, status='won')
 
     def _handle_job_appointment_event(self, webhook_data: Dict[str, Any], mapping: HCPToGHLMapping) -> Dict[str, Any]:
         """Handle job appointment events"""
@@ -577,7 +810,7 @@ class HousecallProWebhookService:
             hcp_company_id=mapping.hcp_company_id
         ).first()
         
-        if opp_mapping:
+        if opp_mapping and opp_mapping.ghl_opportunity_id:
             # Update the opportunity stage based on the appointment event
             # We need to construct a minimal job_data dictionary for update_opportunity
             # as it expects 'customer' and potentially 'invoice_number' for name updates.
@@ -602,30 +835,65 @@ class HousecallProWebhookService:
             hcp_company_id=mapping.hcp_company_id
         ).first()
         
-        if contact_mapping:
+        if contact_mapping and contact_mapping.ghl_contact_id:
             # Update existing contact as well to ensure data is fresh
-            self.ghl_service.update_contact(contact_mapping.ghl_contact_id, customer_data)
+            self._sync_contact(contact_mapping, customer_data)
             return contact_mapping.ghl_contact_id
         
         # Create new contact
-        ghl_contact_id = self.ghl_service.create_contact(mapping.ghl_location_id, customer_data)
-        
-        if ghl_contact_id:
-            ContactMapping.objects.create(
-                hcp_customer_id=hcp_customer_id,
-                ghl_contact_id=ghl_contact_id,
-                hcp_company_id=mapping.hcp_company_id,
-                ghl_location_id=mapping.ghl_location_id
-            )
-            return ghl_contact_id
-        
-        return None
+        return self._create_contact(customer_data, mapping)
+
+    def _create_contact(self, customer_data: Dict[str, Any], mapping: HCPToGHLMapping) -> Optional[str]:
+        """Create the GHL contact through the outbox and return its ID, None if it is still queued.
+
+        A contact that already has the customer's email or phone is mapped and updated instead.
+        """
+        existing_contact_id, skipped_match = find_existing_contact(self.ghl_service, mapping, customer_data)
+        if existing_contact_id:
+            logger.info(f"HCP customer {customer_data.get('id')} matches GHL contact {existing_contact_id}, not creating another")
+            self._sync_contact(adopt_contact(mapping, customer_data, existing_contact_id), customer_data)
+            return existing_contact_id
+
+        contact_mapping = queue_contact_create(
+            mapping, customer_data, self.ghl_service.event_type, allow_duplicate=skipped_match
+        )
+        return contact_mapping.ghl_contact_id or relay_now(contact_mapping=contact_mapping)
+
+    def _create_opportunity(self, mapping: HCPToGHLMapping, lookup: Dict[str, Any], defaults: Dict[str, Any],
+                            ghl_contact_id: str, opportunity_data: Dict[str, Any], status: Optional[str] = None) -> Optional[str]:
+        """Create the GHL opportunity through the outbox and return its ID, None if it is still queued.
+
+        Without ghl_contact_id the create is queued behind the customer's pending contact.
+        """
+        opp_mapping = queue_opportunity_create(
+            mapping, lookup, defaults, ghl_contact_id, opportunity_data, self.ghl_service.event_type, status,
+            customer_id=defaults.get('hcp_customer_id'),
+        )
+        if not ghl_contact_id:
+            # Relayed by relay_ghl_outbox once the contact's own message has gone through
+            return opp_mapping.ghl_opportunity_id or None
+        return opp_mapping.ghl_opportunity_id or relay_now(opportunity_mapping=opp_mapping)
+
+    def _sync_contact(self, contact_mapping: ContactMapping, customer_data: Dict[str, Any]) -> bool:
+        """Push customer data to the mapped GHL contact unless it matches what was last pushed"""
+        digest = contact_payload_digest(build_contact_payload(customer_data))
+        if contact_mapping.last_pushed_digest == digest:
+            logger.info(f"Contact {contact_mapping.ghl_contact_id} unchanged, skipping GHL update.")
+            return True
+
+        success = self.ghl_service.update_contact(contact_mapping.ghl_contact_id, customer_data)
+        if success:
+            contact_mapping.last_pushed_digest = digest
+            contact_mapping.save(update_fields=['last_pushed_digest', 'updated_at'])
+            index_contact(contact_mapping.ghl_location_id, contact_mapping.ghl_contact_id, customer_keys(customer_data))
+        return success
 
     def _create_or_update_estimate_opportunity(self, estimate_data: Dict[str, Any], customer_data: Dict[str, Any], mapping: HCPToGHLMapping) -> Dict[str, Any]:
         """Create or update opportunity for estimate events"""
         ghl_contact_id = self._ensure_contact_exists(customer_data, mapping)
         
-        if not ghl_contact_id:
+        # A contact that is still queued holds back only the opportunity create, see _create_opportunity
+        if not customer_data.get('id'):
             return {"error": "Failed to create/find contact in GHL for estimate opportunity."}
         
         hcp_estimate_id = estimate_data.get('id')
@@ -639,7 +907,7 @@ class HousecallProWebhookService:
             hcp_company_id=mapping.hcp_company_id
         ).first()
         
-        if opp_mapping:
+        if opp_mapping and opp_mapping.ghl_opportunity_id:
             # Update existing opportunity
             option_data = None
             if estimate_data.get('options') and isinstance(estimate_data['options'], list):
@@ -653,24 +921,23 @@ class HousecallProWebhookService:
             }
         else:
             # Create new opportunity
-            ghl_opp_id = self.ghl_service.create_opportunity(mapping.ghl_location_id, ghl_contact_id, estimate_data)
+            ghl_opp_id = self._create_opportunity(
+                mapping, {'hcp_estimate_id': hcp_estimate_id}, {'hcp_customer_id': customer_data.get('id')},
+                ghl_contact_id, estimate_data
+            )
             
             if ghl_opp_id:
-                OpportunityMapping.objects.create(
-                    hcp_estimate_id=hcp_estimate_id,
-                    ghl_opportunity_id=ghl_opp_id,
-                    hcp_company_id=mapping.hcp_company_id,
-                    ghl_location_id=mapping.ghl_location_id
-                )
                 return {"message": "Estimate opportunity created", "ghl_opportunity_id": ghl_opp_id}
             else:
-                return {"error": "Failed to create opportunity"}
+                return {"error": "Failed to create opportunity, queued for retry"}
 
-    def _create_or_update_job_opportunity(self, job_data: Dict[str, Any], customer_data: Dict[str, Any], mapping: HCPToGHLMapping) -> Dict[str, Any]:
-        """Create or update opportunity for job events"""
+    def _create_or_update_job_opportunity(self, job_data: Dict[str, Any], customer_data: Dict[str, Any], mapping: HCPToGHLMapping,
+                                          status: Optional[str] = None) -> Dict[str, Any]:
+        """Create or update opportunity for job events, status closes it as won/lost in the same request"""
         ghl_contact_id = self._ensure_contact_exists(customer_data, mapping)
         
-        if not ghl_contact_id:
+        # A contact that is still queued holds back only the opportunity create, see _create_opportunity
+        if not customer_data.get('id'):
             return {"error": "Failed to create/find contact in GHL for job opportunity."}
         
         hcp_job_id = job_data.get('id')
@@ -679,35 +946,39 @@ class HousecallProWebhookService:
         if not hcp_job_id:
             return {"error": "No job ID in webhook data for job opportunity creation/update."}
         
-        # First, try to find existing opportunity by job ID
-        opp_mapping = OpportunityMapping.objects.filter(
-            hcp_job_id=hcp_job_id,
-            hcp_company_id=mapping.hcp_company_id
-        ).first()
+        # Job opportunity and, for jobs copied from an estimate, the estimate opportunity in one query
+        job_or_estimate = Q(hcp_job_id=hcp_job_id)
+        if original_estimate_id:
+            job_or_estimate |= Q(hcp_estimate_id=original_estimate_id)
+        candidates = list(
+            OpportunityMapping.objects.filter(job_or_estimate, hcp_company_id=mapping.hcp_company_id).order_by('id')
+        )
+        opp_mapping = next((candidate for candidate in candidates if candidate.hcp_job_id == hcp_job_id), None)
         
-        if opp_mapping:
+        if opp_mapping and opp_mapping.ghl_opportunity_id:
             # Update existing opportunity
-            success = self.ghl_service.update_opportunity(opp_mapping.ghl_opportunity_id, job_data)
+            success = self.ghl_service.update_opportunity(opp_mapping.ghl_opportunity_id, job_data, status=status)
             return {
                 "message": "Job opportunity updated" if success else "Failed to update opportunity",
                 "ghl_opportunity_id": opp_mapping.ghl_opportunity_id
             }
         
         # If no job opportunity exists, check if there's an estimate opportunity to convert
-        if original_estimate_id:
-            estimate_opp_mapping = OpportunityMapping.objects.filter(
-                hcp_estimate_id=original_estimate_id,
-                hcp_company_id=mapping.hcp_company_id
-            ).first()
+        estimate_opp_mapping = None
+        if original_estimate_id and not opp_mapping:
+            estimate_opp_mapping = next(
+                (candidate for candidate in candidates if candidate.hcp_estimate_id == original_estimate_id), None
+            )
 
-            if estimate_opp_mapping:
+            if estimate_opp_mapping and estimate_opp_mapping.ghl_opportunity_id:
                 # Update the existing estimate opportunity to reflect it's now a job
                 # and update its HcpJobId.
-                success = self.ghl_service.update_opportunity(estimate_opp_mapping.ghl_opportunity_id, job_data)
+                success = self.ghl_service.update_opportunity(estimate_opp_mapping.ghl_opportunity_id, job_data, status=status)
                 if success:
                     # Update the mapping to link it to the job ID
                     estimate_opp_mapping.hcp_job_id = hcp_job_id
-                    estimate_opp_mapping.save()
+                    estimate_opp_mapping.hcp_customer_id = customer_data.get('id') or estimate_opp_mapping.hcp_customer_id
+                    estimate_opp_mapping.save(update_fields=['hcp_job_id', 'hcp_customer_id', 'updated_at'])
                     return {
                         "message": "Converted estimate opportunity to job opportunity and updated",
                         "ghl_opportunity_id": estimate_opp_mapping.ghl_opportunity_id
@@ -716,17 +987,17 @@ class HousecallProWebhookService:
                     logger.error(f"Failed to update existing estimate opportunity {estimate_opp_mapping.ghl_opportunity_id} to job.")
         
         # If neither existing job opportunity nor convertible estimate opportunity found, create a new one
-        ghl_opp_id = self.ghl_service.create_opportunity(mapping.ghl_location_id, ghl_contact_id, job_data)
+        # Store original estimate ID if available, unless the estimate keeps its own mapping
+        defaults = {
+            'hcp_estimate_id': None if estimate_opp_mapping else original_estimate_id,
+            'hcp_customer_id': customer_data.get('id'),
+        }
+        ghl_opp_id = self._create_opportunity(
+            mapping, {'hcp_job_id': hcp_job_id}, defaults, ghl_contact_id, job_data, status=status
+        )
         
         if ghl_opp_id:
-            OpportunityMapping.objects.create(
-                hcp_job_id=hcp_job_id,
-                ghl_opportunity_id=ghl_opp_id,
-                hcp_company_id=mapping.hcp_company_id,
-                ghl_location_id=mapping.ghl_location_id,
-                hcp_estimate_id=original_estimate_id # Store original estimate ID if available
-            )
             return {"message": "Job opportunity created", "ghl_opportunity_id": ghl_opp_id}
         else:
-            return {"error": "Failed to create job opportunity"}
+            return {"error": "Failed to create job opportunity, queued for retry"}
 
@@ -1,101 +1,143 @@
-# your_app_name/tasks.py
-import requests
+# core/tasks.py
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Dict
 from celery import shared_task
-from core.models import GHLAuthCredentials
-from decouple import config
+from core.coalesce import buffer_webhook, discard_buffer, flush_buffer
+from core.deadletter import retry_dead_letters
+from core.dispatch import lane_for_webhook, lane_queue
+from core.models import GHLAuthCredentials, Webhook
+from core.outbox import relay_outbox
+from core.retention import archive_old_webhooks, compress_old_webhooks
+from core.services import HousecallProWebhookService, refresh_ghl_credentials_once
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
 import logging
-# from core.services import (
-#     # handle_job_created,
-#     # handle_job_updated, 
-#     # handle_customer_create, 
-#     # handle_customer_update, 
-#     # handle_customer_delete,
-#     # create_ghl_opportunity,
-#     # handle_customer_created,
-#     # handle_estimate_approved,
-#     # handle_estimate_created,
-#     # handle_job_started,
-#     # handle_job_completed,
-#     # handle_estimate_sent,
-    
-# )
 
 logger = logging.getLogger(__name__)
 
+def _refresh_in_thread(credentials):
+    try:
+        # Same lock as the 401 path so the two never spend one refresh token twice
+        return refresh_ghl_credentials_once(credentials.id, credentials.access_token) is not None
+    finally:
+        # Worker threads open their own DB connection
+        connection.close()
+
+
+@shared_task
+def refresh_expiring_tokens():
+    """Refresh every GHL token that expires within GHL_TOKEN_REFRESH_MARGIN seconds"""
+    due = list(GHLAuthCredentials.objects.filter(
+        Q(expires_at__isnull=True) | Q(expires_at__lte=timezone.now() + timedelta(seconds=settings.GHL_TOKEN_REFRESH_MARGIN))
+    ))
+    if not due:
+        return {"refreshed": 0, "failed": 0}
+
+    with ThreadPoolExecutor(max_workers=settings.GHL_TOKEN_REFRESH_CONCURRENCY) as pool:
+        results = list(pool.map(_refresh_in_thread, due))
+
+    refreshed = sum(1 for ok in results if ok)
+    logger.info(f"Refreshed {refreshed} of {len(due)} expiring GHL tokens")
+    return {"refreshed": refreshed, "failed": len(due) - refreshed}
+
+
 @shared_task
 def make_api_call():
-    credentials = GHLAuthCredentials.objects.first()
-    
-    print("credentials tokenL", credentials)
-    refresh_token = credentials.refresh_token
-
-    
-    response = requests.post('https://services.leadconnectorhq.com/oauth/token', data={
-        'grant_type': 'refresh_token',
-        'client_id': config("GHL_CLIENT_ID"),
-        'client_secret': config("GHL_CLIENT_SECRET"),
-        'refresh_token': refresh_token
-    })
-    
-    new_tokens = response.json()
-
-    print("new tokens: ", new_tokens)
-
-    obj, created = GHLAuthCredentials.objects.update_or_create(
-            location_id= new_tokens.get("locationId"),
-            defaults={
-                "access_token": new_tokens.get("access_token"),
-                "refresh_token": new_tokens.get("refresh_token"),
-                "expires_in": new_tokens.get("expires_in"),
-                "scope": new_tokens.get("scope"),
-                "user_type": new_tokens.get("userType"),
-                "company_id": new_tokens.get("companyId"),
-                "user_id":new_tokens.get("userId"),
-
-            }
-        )
-
-
-
-# @shared_task(
-#     bind=True,
-#     max_retries=3,
-#     default_retry_delay=60,
-#     autoretry_for=(Exception,),
-#     retry_backoff=True,
-# )
-# def handle_webhook_event(self, data):
-#     try:
-#         # Get access token
-#         ghl_credentials = GHLAuthCredentials.objects.first()
-#         if not ghl_credentials:
-#             logger.error("No GHL credentials found")
-#             return
-        
-#         access_token = ghl_credentials.access_token
-#         location_id = ghl_credentials.location_id
-        
-#         event_type = data.get('event')
-#         logger.info(f"Processing event: {event_type}")
-        
-#         # Route to appropriate handler based on event type
-#         if event_type == 'customer.created':
-#             handle_customer_created(data, access_token, location_id)
-#         elif event_type in ['estimate.created', 'estimate.option.created']:
-#             handle_estimate_created(data, access_token, location_id)
-#         elif event_type == 'estimate.sent':
-#             handle_estimate_sent(data, access_token, location_id)
-#         elif event_type == 'estimate.option.approval_status_changed':
-#             handle_estimate_approved(data, access_token, location_id)
-#         elif event_type == 'job.created':
-#             handle_job_created(data, access_token, location_id)
-#         elif event_type == 'job.started':
-#             handle_job_started(data, access_token, location_id)
-#         elif event_type == 'job.completed':
-#             handle_job_completed(data, access_token, location_id)
-#         else:
-#             logger.info(f"Unhandled event type: {event_type}")
-            
-#     except Exception as e:
-#         logger.error(f"Error processing webhook event: {str(e)}")
-#         raise
\ No newline at end of file
+    """Kept for beat entries that still reference the old task name"""
+    return refresh_expiring_tokens()
+
+
+
+def _process_in_lane(webhook: Webhook) -> Dict[str, Any]:
+    """Process a webhook, retrying in place so the events behind it in the lane can't overtake it"""
+    for attempt in range(settings.HCP_WEBHOOK_RETRIES + 1):
+        try:
+            return HousecallProWebhookService().process_webhook(webhook.get_payload())
+        except Exception as e:
+            if attempt == settings.HCP_WEBHOOK_RETRIES:
+                webhook.status = Webhook.STATUS_FAILED
+                webhook.result = {"error": str(e), "retries": attempt}
+                webhook.processed_at = timezone.now()
+                webhook.save(update_fields=['status', 'result', 'processed_at'])
+                raise
+            delay = settings.HCP_WEBHOOK_RETRY_DELAY * 2 ** attempt
+            logger.warning(f"Webhook {webhook.id} raised {e!r}, retrying in {delay}s")
+            time.sleep(delay)
+
+
+@shared_task
+def handle_webhook_event(webhook_id):
+    """Process a stored Housecall Pro webhook and record the outcome on its row"""
+    try:
+        webhook = Webhook.objects.get(id=webhook_id)
+    except Webhook.DoesNotExist:
+        logger.error(f"Webhook {webhook_id} not found, nothing to process")
+        return
+
+    logger.info(f"Processing webhook {webhook_id}: {webhook.event} for company {webhook.company_id}")
+
+    buffer = buffer_webhook(webhook)
+    if buffer is not None:
+        if buffer['new']:
+            # Same lane as the job, so the flush runs after everything buffered before it
+            flush_coalesced_job.apply_async(
+                args=[webhook.company_id, buffer['job_id'], buffer['token']],
+                countdown=settings.HCP_COALESCE_WINDOW_SECONDS,
+                queue=lane_queue(lane_for_webhook(webhook.get_payload())),
+            )
+        return webhook.result
+    discard_buffer(webhook)
+
+    result = _process_in_lane(webhook)
+    webhook.status = Webhook.STATUS_FAILED if result.get('error') else Webhook.STATUS_PROCESSED
+    webhook.result = result
+    webhook.processed_at = timezone.now()
+    webhook.save(update_fields=['status', 'result', 'processed_at'])
+    return result
+
+
+@shared_task(
+    bind=True,
+    max_retries=3,
+    default_retry_delay=60,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+)
+def flush_coalesced_job(self, company_id, job_id, token):
+    """Apply the job and appointment webhooks buffered for a job during the coalescing window"""
+    result = flush_buffer(company_id, job_id, token)
+    if result is None:
+        logger.info(f"Coalescing buffer of job {job_id} already flushed or superseded")
+    return result
+
+
+@shared_task
+def relay_ghl_outbox():
+    """Send the GHL creates whose inline attempt failed, see core/outbox.py"""
+    stats = relay_outbox()
+    if stats['sent'] or stats['failed'] or stats['deferred']:
+        logger.info(f"GHL outbox relay sent {stats['sent']}, {stats['failed']} failed, "
+                    f"{stats['deferred']} deferred behind pending contacts")
+    return stats
+
+
+@shared_task
+def retry_ghl_dead_letters():
+    """Retry due GHL updates/deletes that failed, see core/deadletter.py"""
+    stats = retry_dead_letters()
+    if stats['succeeded'] or stats['failed']:
+        logger.info(f"GHL dead letters: {stats['succeeded']} succeeded, {stats['failed']} failed, "
+                    f"{stats['deferred']} deferred")
+    return stats
+
+
+@shared_task
+def prune_webhooks():
+    """Compress old webhook payloads and archive webhooks past retention, see core/retention.py"""
+    compressed = compress_old_webhooks()
+    archived = archive_old_webhooks()
+    return {"compressed": compressed, "archived": archived}
@@ -1,3 +1,907 @@
-from django.test import TestCase
+import gzip
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+import httpx
+import redis
+import requests
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from core.async_services import AsyncGoHighLevelService
+from core.backfill import BackfillCheckpoint, HCPBackfill, iter_dump_records
+from core.bench.payloads import EVENT_TYPES, sample_customer, sample_estimate, sample_job, sample_webhook
+from core.batch import parse_batch
+from core.coalesce import flush_buffer
+from core.cache import _mapping_cache, get_company_mapping, warm_company_mappings
+from core.contact_index import contact_keys, find_indexed_contact, index_contact
+from core.deadletter import (
+    _claim as claim_dead_letters, requeue_dead_letters, retry_dead_letter, supersede_dead_letters,
+)
+from core.dispatch import PartitionedDispatcher, lane_for, lane_for_webhook, lane_queue, route_lane_task
+from core.ingest import BodyTooLarge, iter_body_lines
+from core.metrics import GHL_OUTBOX_DELIVERIES, metrics_view
+from core.models import (
+    ContactMapping, GHLAuthCredentials, GHLContactIndex, GHLDeadLetter, GHLOutboxMessage, HCPToGHLMapping,
+    OpportunityMapping, Webhook,
+)
+from core.outbox import _deliver, relay_now, relay_outbox
+from core.querybudget import QueryRecorder, check_query_budget, query_budget
+from core.retention import archive_files, archive_old_webhooks, compress_old_webhooks, iter_archived_webhooks
+from core.services import CLOSING_EVENT_STATUS, GoHighLevelService, HousecallProWebhookService, refresh_ghl_credentials
+from core.tasks import handle_webhook_event, refresh_expiring_tokens
 
-# Create your tests here.
+COMPANY_ID = 'query-budget'
+
+
+class FakeGHLSession:
+    """Answers every GHL call with 200 and a new id, GHL's duplicate search with self.duplicate"""
+
+    def __init__(self):
+        self.calls = 0
+        self.requests = []
+        self.payloads = []
+        self.duplicate = None
+        # (method, path) -> (status code, headers) of requests that fail
+        self.failing = {}
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        path = url.split('.com', 1)[-1]
+        self.requests.append((method, path))
+        self.payloads.append(kwargs.get('json'))
+        if (method, path) in self.failing:
+            status_code, headers = self.failing[method, path]
+            response = mock.Mock(status_code=status_code, headers=headers)
+            response.raise_for_status.side_effect = requests.HTTPError(f'{status_code} Error', response=response)
+            return response
+        response = mock.Mock(status_code=200, headers={})
+        response.raise_for_status.return_value = None
+        entity = 'contact' if '/contacts' in url else 'opportunity'
+        response.json.return_value = {entity: {'id': f'ghl{self.calls}'}, 'opportunities': []}
+        if '/contacts/search/duplicate' in url:
+            response.json.return_value = {'contact': self.duplicate}
+        return response
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    GHL_RATE_LIMIT_BURST=10 ** 6,
+)
+class GHLTestCase(TestCase):
+    """A mapped HCP company whose GHL calls go to a FakeGHLSession"""
+
+    def setUp(self):
+        credentials = GHLAuthCredentials.objects.create(
+            user_id=COMPANY_ID, access_token='token', refresh_token='token', expires_in=86399, location_id=COMPANY_ID,
+        )
+        HCPToGHLMapping.objects.create(hcp_company_id=COMPANY_ID, ghl_location_id=COMPANY_ID, ghl_credentials=credentials)
+        _mapping_cache.clear()
+        cache.clear()
+        self.session = FakeGHLSession()
+        patcher = mock.patch('core.services.get_ghl_session', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Redis isn't needed, the rate limiter falls back to process-local buckets
+        patcher = mock.patch('core.ratelimit.GHLRateLimiter.acquire', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class WebhookQueryBudgetTests(GHLTestCase):
+
+    def process(self, event_type, suffix):
+        webhook = sample_webhook(
+            event_type, COMPANY_ID, customer_id=f'cus-{suffix}', estimate_id=f'est-{suffix}', job_id=f'job-{suffix}',
+            from_estimate=True,
+        )
+        # Every webhook pays for the company mapping lookup, as the first one after a cache expiry does
+        _mapping_cache.clear()
+        with QueryRecorder() as recorder:
+            result = HousecallProWebhookService().process_webhook(webhook)
+        self.assertNotIn('error', result, f"{event_type}: {result}")
+        return recorder
+
+    def assertWithinBudget(self, event_type, recorder, mapped=False):
+        self.assertEqual(check_query_budget(event_type, recorder, mapped), [], '\n'.join(recorder.statements))
+
+    def test_events_for_new_entities_stay_within_budget(self):
+        for index, event_type in enumerate(EVENT_TYPES):
+            with self.subTest(event_type=event_type):
+                self.assertWithinBudget(event_type, self.process(event_type, f'new{index}'))
+
+    def test_events_for_mapped_entities_stay_within_budget(self):
+        for index, event_type in enumerate(EVENT_TYPES):
+            with self.subTest(event_type=event_type):
+                for prime in ('customer.created', 'estimate.created', 'job.created'):
+                    self.process(prime, f'mapped{index}')
+                self.assertWithinBudget(event_type, self.process(event_type, f'mapped{index}'), mapped=True)
+
+    def test_mapped_events_with_changed_customer_stay_within_budget(self):
+        for index, event_type in enumerate(('customer.updated', 'estimate.updated', 'job.updated')):
+            with self.subTest(event_type=event_type):
+                for prime in ('customer.created', 'estimate.created', 'job.created'):
+                    self.process(prime, f'changed{index}')
+                # Every event pushes the contact again when its customer changed
+                with mock.patch('core.services.contact_payload_digest', return_value='changed'):
+                    recorder = self.process(event_type, f'changed{index}')
+                self.assertWithinBudget(event_type, recorder, mapped=True)
+
+    def test_job_created_looks_up_job_and_estimate_opportunities_in_one_query(self):
+        self.process('customer.created', 'conv')
+        self.process('estimate.created', 'conv')
+        recorder = self.process('job.created', 'conv')
+        lookups = [
+            sql for sql in recorder.statements
+            if sql.startswith('SELECT') and '"core_opportunitymapping"' in sql.split('FROM', 1)[1][:40]
+        ]
+        self.assertEqual(len(lookups), 1, lookups)
+        converted = OpportunityMapping.objects.get(hcp_estimate_id='est-conv', hcp_company_id=COMPANY_ID)
+        self.assertEqual(converted.hcp_job_id, 'job-conv')
+
+    def test_repeated_queries_are_reported(self):
+        with QueryRecorder() as recorder:
+            for _ in range(3):
+                list(OpportunityMapping.objects.filter(hcp_company_id=COMPANY_ID))
+        self.assertEqual(len(recorder.repeated()), 1)
+        self.assertEqual(len(check_query_budget('customer.updated', recorder)), 1)
+
+    def test_unknown_events_use_the_default_budget(self):
+        self.assertEqual(query_budget('job.appointment.scheduled'), query_budget('something.new'))
+        self.assertEqual(query_budget('job.appointment.scheduled', mapped=True), query_budget('something.new'))
+
+    def test_mapped_budgets_are_tighter(self):
+        for event_type in EVENT_TYPES:
+            with self.subTest(event_type=event_type):
+                self.assertLessEqual(query_budget(event_type, mapped=True), query_budget(event_type))
+        self.assertLess(query_budget('job.updated', mapped=True), query_budget('job.updated'))
+
+
+class ContactMatchTests(GHLTestCase):
+    def create_customer(self, customer_id, **fields):
+        customer = dict(sample_customer(customer_id), **fields)
+        self.session.requests.clear()
+        result = HousecallProWebhookService().process_webhook(
+            {'event': 'customer.created', 'company_id': COMPANY_ID, 'customer': customer}
+        )
+        self.assertNotIn('error', result)
+        return ContactMapping.objects.get(hcp_customer_id=customer_id, hcp_company_id=COMPANY_ID).ghl_contact_id
+
+    def test_customer_without_a_match_gets_a_new_contact(self):
+        contact_id = self.create_customer('new')
+        self.assertEqual(self.session.requests, [('GET', '/contacts/search/duplicate'), ('POST', '/contacts/upsert')])
+        self.assertEqual(
+            set(GHLContactIndex.objects.filter(ghl_location_id=COMPANY_ID).values_list('key', 'ghl_contact_id')),
+            {('email:new@example.com', contact_id), (f"phone:+1{sample_customer('new')['mobile_number']}", contact_id)},
+        )
+
+    def test_customer_matching_the_local_index_adopts_the_contact(self):
+        index_contact(COMPANY_ID, 'existing', contact_keys(email='Lead@Example.com'))
+        contact_id = self.create_customer('lead', email=' lead@example.com')
+        self.assertEqual(contact_id, 'existing')
+        # No search and no create, only the HCP data pushed to the contact
+        self.assertEqual(self.session.requests, [('PUT', '/contacts/existing')])
+
+    def test_customer_matching_ghl_duplicate_search_adopts_the_contact(self):
+        self.session.duplicate = {'id': 'found', 'email': 'other@example.com', 'phone': '+15550001111'}
+        contact_id = self.create_customer('dup', mobile_number='(555) 000-1111')
+        self.assertEqual(contact_id, 'found')
+        self.assertEqual(self.session.requests, [('GET', '/contacts/search/duplicate'), ('PUT', '/contacts/found')])
+        self.assertEqual(find_indexed_contact(COMPANY_ID, ['phone:+15550001111']), 'found')
+
+    def test_contact_of_another_customer_is_not_adopted(self):
+        first = self.create_customer('first', mobile_number='5550002222')
+        second = self.create_customer('second', mobile_number='555-000-2222')
+        self.assertNotEqual(second, first)
+        # Created, an upsert would return the first customer's contact
+        self.assertEqual(self.session.requests, [('POST', '/contacts/')])
+
+
+class BodyReadingTests(SimpleTestCase):
+    def request(self, body):
+        return RequestFactory().post('/webhooks/batch', data=body, content_type='application/json')
+
+    def test_array_spanning_lines_is_read_whole(self):
+        body = b'[\n{"event": "customer.created"},\n{"event": "job.created"}\n]'
+        self.assertEqual(list(iter_body_lines(self.request(body), max_line_bytes=20, max_bytes=len(body))), [body])
+        items = parse_batch(self.request(body))
+        self.assertEqual([payload['event'] for payload, _, _ in items], ['customer.created', 'job.created'])
+
+    def test_array_on_one_line_at_the_limit_is_read(self):
+        body = b'[{"event": "customer.created"}]\n'
+        self.assertEqual(list(iter_body_lines(self.request(body), max_bytes=len(body))), [body])
+
+    def test_ndjson_is_read_line_by_line(self):
+        body = b'{"event": "customer.created"}\n\n{"event": "job.created"}\nnot json\n'
+        items = parse_batch(self.request(body))
+        self.assertEqual([raw for _, raw, _ in items], [b'{"event": "customer.created"}', b'{"event": "job.created"}', None])
+        self.assertTrue(items[2][2].startswith('Invalid JSON'))
+
+    def test_bodies_over_the_limits_are_refused(self):
+        array = b'[\n{"event": "customer.created"}\n]'
+        for body, limits in (
+            (array, {'max_bytes': len(array) - 1}),
+            (b'{"event": "customer.created"}\n', {'max_line_bytes': 10}),
+            (b'{"event": "a"}\n{"event": "b"}\n', {'max_bytes': 20}),
+        ):
+            with self.subTest(body=body, **limits), self.assertRaises(BodyTooLarge):
+                list(iter_body_lines(self.request(body), **limits))
+
+
+@override_settings(METRICS_TOKEN='secret', METRICS_ALLOWED_IPS=['10.0.0.5'])
+class MetricsViewTests(SimpleTestCase):
+    def get(self, **meta):
+        return metrics_view(RequestFactory().get('/metrics', REMOTE_ADDR=meta.pop('ip', '203.0.113.9'), **meta))
+
+    def test_metrics_need_the_token_or_an_allowed_ip(self):
+        self.assertEqual(self.get().status_code, 403)
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        self.assertEqual(self.get(ip='10.0.0.5').status_code, 200)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_empty_token_is_never_accepted(self):
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+@override_settings(HCP_WEBHOOK_ASYNC=False)
+class WebhookDedupTests(GHLTestCase):
+    def post(self, path='/core/webhook/', body=None):
+        body = body or sample_webhook('customer.created', COMPANY_ID, customer_id='cus-dedup')
+        return self.client.post(path, data=json.dumps(body), content_type='application/json')
+
+    def test_redelivery_is_a_duplicate(self):
+        self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(self.post().json(), {"message": "Duplicate webhook ignored"})
+        self.assertEqual(Webhook.objects.count(), 1)
+
+    def test_retry_of_a_delivery_that_failed_to_store_is_processed(self):
+        with mock.patch('core.views.Webhook.objects.create', side_effect=RuntimeError('database down')):
+            self.assertEqual(self.post().status_code, 500)
+        self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(Webhook.objects.get().status, Webhook.STATUS_PROCESSED)
+
+    def test_retry_of_a_delivery_that_failed_to_process_is_processed(self):
+        with mock.patch.object(HousecallProWebhookService, 'process_webhook', return_value={'error': 'GHL down'}):
+            self.post()
+        self.post()
+        self.assertEqual(list(Webhook.objects.values_list('status', flat=True).order_by('id')),
+                         [Webhook.STATUS_FAILED, Webhook.STATUS_PROCESSED])
+
+    def test_retry_of_a_batch_that_failed_to_store_is_processed(self):
+        with mock.patch('core.batch.Webhook.objects.bulk_create', side_effect=RuntimeError('database down')):
+            self.assertEqual(self.post('/core/webhook/batch/', [self.sample()]).status_code, 500)
+        response = self.post('/core/webhook/batch/', [self.sample()])
+        self.assertEqual(response.json()['counts'], {'processed': 1})
+
+    def sample(self):
+        return sample_webhook('customer.created', COMPANY_ID, customer_id='cus-batch')
+
+
+@override_settings(HCP_WEBHOOK_LANES=64)
+class LaneOrderingTests(GHLTestCase):
+    def appointment(self, job_id):
+        return {'event': 'job.appointment.scheduled', 'company_id': COMPANY_ID, 'appointment': {'id': 'apt', 'job_id': job_id}}
+
+    def test_appointment_follows_the_customer_of_its_job(self):
+        job = sample_webhook('job.created', COMPANY_ID, customer_id='cus-lane', job_id='job-lane')
+        customer_lane = lane_for((COMPANY_ID, 'customer:cus-lane'))
+        self.assertEqual(lane_for_webhook(job), customer_lane)
+        self.assertEqual(lane_for_webhook(self.appointment('job-lane')), customer_lane)
+
+    def test_appointment_of_a_forgotten_job_is_routed_by_its_mapping(self):
+        HousecallProWebhookService().process_webhook(
+            sample_webhook('job.created', COMPANY_ID, customer_id='cus-lane', job_id='job-lane')
+        )
+        cache.clear()
+        self.assertEqual(lane_for_webhook(self.appointment('job-lane')), lane_for((COMPANY_ID, 'customer:cus-lane')))
+        with PartitionedDispatcher(lanes=64) as dispatcher:
+            future = dispatcher.submit_webhook(self.appointment('job-lane'), threading.current_thread)
+        lane = lane_for((COMPANY_ID, 'customer:cus-lane'), 64)
+        self.assertEqual(future.result().name, f'hcp-lane-{lane}')
+
+    def test_lane_tasks_sent_without_a_queue_are_routed_to_their_lane(self):
+        job = sample_webhook('job.created', COMPANY_ID, customer_id='cus-lane', job_id='job-lane')
+        webhook = Webhook.objects.create(event='job.created', company_id=COMPANY_ID, payload=job)
+        lane = lane_queue(lane_for((COMPANY_ID, 'customer:cus-lane')))
+        self.assertEqual(route_lane_task('core.tasks.handle_webhook_event', [webhook.id], {}, {}), {'queue': lane})
+        self.assertEqual(
+            route_lane_task('core.tasks.flush_coalesced_job', [COMPANY_ID, 'job-lane', 'token'], {}, {}), {'queue': lane},
+        )
+        self.assertIsNone(route_lane_task('core.tasks.handle_webhook_event', [webhook.id], {}, {'queue': 'other'}))
+        self.assertIsNone(route_lane_task('core.tasks.relay_outbox_task', [], {}, {}))
+
+    @override_settings(HCP_WEBHOOK_RETRY_DELAY=0)
+    def test_failing_webhook_is_retried_in_its_lane(self):
+        webhook = Webhook.objects.create(event='customer.created', company_id=COMPANY_ID,
+                                         payload=sample_webhook('customer.created', COMPANY_ID))
+        outcomes = [RuntimeError('database down'), {'message': 'Contact created'}]
+        with mock.patch.object(HousecallProWebhookService, 'process_webhook', side_effect=outcomes), \
+                mock.patch('core.tasks.time.sleep') as sleep:
+            self.assertEqual(handle_webhook_event(webhook.id), {'message': 'Contact created'})
+        sleep.assert_called_once_with(0)
+        webhook.refresh_from_db()
+        self.assertEqual(webhook.status, Webhook.STATUS_PROCESSED)
+
+
+@override_settings(HCP_COALESCE_WINDOW_SECONDS=5)
+class CoalescingTests(GHLTestCase):
+    burst = ('job.scheduled', 'job.appointment.scheduled', 'job.appointment.appointment_pros_assigned',
+             'job.on_my_way', 'job.started')
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('core.tasks.flush_coalesced_job.apply_async')
+        self.schedule_flush = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.receive('job.created')
+        self.opportunity_id = OpportunityMapping.objects.get(hcp_job_id='job-co').ghl_opportunity_id
+        self.session.requests.clear()
+        self.session.payloads.clear()
+
+    def receive(self, event_type):
+        payload = sample_webhook(event_type, COMPANY_ID, customer_id='cus-co', job_id='job-co')
+        webhook = Webhook.objects.create(event=event_type, company_id=COMPANY_ID, payload=payload)
+        handle_webhook_event(webhook.id)
+        return webhook
+
+    def receive_burst(self):
+        webhooks = [self.receive(event_type) for event_type in self.burst]
+        self.schedule_flush.assert_called_once()
+        company_id, job_id, token = self.schedule_flush.call_args.kwargs['args']
+        return webhooks, token
+
+    def test_burst_of_job_events_is_flushed_as_one_update(self):
+        webhooks, token = self.receive_burst()
+        self.assertEqual(self.session.requests, [])
+        self.assertNotIn('error', flush_buffer(COMPANY_ID, 'job-co', token))
+        self.assertEqual(self.session.requests, [('PUT', f'/opportunities/{self.opportunity_id}')])
+        self.assertEqual(self.session.payloads[0]['pipelineStageId'], GoHighLevelService.PIPELINE_STAGES['job.started'])
+        statuses = [Webhook.objects.get(id=webhook.id).status for webhook in webhooks]
+        self.assertEqual(statuses, [Webhook.STATUS_COALESCED] * 4 + [Webhook.STATUS_PROCESSED])
+        # Flushed once, a second run of the task finds nothing
+        self.assertIsNone(flush_buffer(COMPANY_ID, 'job-co', token))
+
+    def test_stale_token_does_not_flush(self):
+        _, token = self.receive_burst()
+        self.assertIsNone(flush_buffer(COMPANY_ID, 'job-co', 'stale'))
+        self.assertEqual(self.session.requests, [])
+        self.assertIsNotNone(flush_buffer(COMPANY_ID, 'job-co', token))
+
+    def test_settling_event_discards_the_buffer(self):
+        webhooks, token = self.receive_burst()
+        completed = self.receive('job.completed')
+        self.assertIsNone(flush_buffer(COMPANY_ID, 'job-co', token))
+        # Only the completion reached GHL
+        self.assertEqual(self.session.requests, [('PUT', f'/opportunities/{self.opportunity_id}')])
+        self.assertEqual(self.session.payloads[0]['status'], 'won')
+        for webhook in webhooks:
+            webhook.refresh_from_db()
+            self.assertEqual((webhook.status, webhook.result), (Webhook.STATUS_COALESCED, {'coalesced_into': completed.id}))
+
+
+class ContactDigestTests(GHLTestCase):
+    def update(self, **fields):
+        self.session.requests.clear()
+        customer = dict(sample_customer('cus-digest'), **fields)
+        result = HousecallProWebhookService().process_webhook(
+            {'event': 'customer.updated', 'company_id': COMPANY_ID, 'customer': customer}
+        )
+        self.assertNotIn('error', result)
+        return self.session.requests
+
+    def test_unchanged_customer_update_makes_no_ghl_call(self):
+        HousecallProWebhookService().process_webhook(sample_webhook('customer.created', COMPANY_ID, customer_id='cus-digest'))
+        contact_id = ContactMapping.objects.get(hcp_customer_id='cus-digest').ghl_contact_id
+        self.assertEqual(self.update(), [])
+        self.assertEqual(self.update(first_name='Janet'), [('PUT', f'/contacts/{contact_id}')])
+        # The changed data is the new baseline
+        self.assertEqual(self.update(first_name='Janet'), [])
+
+
+class ClosingEventTests(GHLTestCase):
+    def test_closing_events_send_one_put_with_the_status(self):
+        for index, (event_type, status) in enumerate(CLOSING_EVENT_STATUS.items()):
+            with self.subTest(event_type=event_type):
+                ids = {'customer_id': f'cus-close{index}', 'job_id': f'job-close{index}'}
+                HousecallProWebhookService().process_webhook(sample_webhook('job.created', COMPANY_ID, **ids))
+                opportunity_id = OpportunityMapping.objects.get(hcp_job_id=ids['job_id']).ghl_opportunity_id
+                self.session.requests.clear()
+                self.session.payloads.clear()
+
+                result = HousecallProWebhookService().process_webhook(sample_webhook(event_type, COMPANY_ID, **ids))
+                self.assertNotIn('error', result)
+                self.assertEqual(self.session.requests, [('PUT', f'/opportunities/{opportunity_id}')])
+                self.assertEqual(self.session.payloads[0]['status'], status)
+
+
+class BackfillTests(GHLTestCase):
+    def backfill(self, records, checkpoint):
+        mapping = HCPToGHLMapping.objects.select_related('ghl_credentials').get(hcp_company_id=COMPANY_ID)
+        return HCPBackfill(mapping, concurrency=2, batch_size=2, checkpoint=checkpoint, session=self.session).run(records)
+
+    def test_second_job_of_a_mapped_estimate_gets_its_own_mapping(self):
+        records = [
+            {'customer': sample_customer('cus-bf')},
+            {'estimate': sample_estimate('est-bf', 'cus-bf')},
+            {'job': sample_job('job-bf1', 'cus-bf', estimate_id='est-bf')},
+            {'job': sample_job('job-bf2', 'cus-bf', estimate_id='est-bf')},
+        ]
+        self.backfill(records, BackfillCheckpoint(None))
+        converted = OpportunityMapping.objects.get(hcp_job_id='job-bf1')
+        self.assertEqual(converted.hcp_estimate_id, 'est-bf')
+        second = OpportunityMapping.objects.get(hcp_job_id='job-bf2')
+        self.assertIsNone(second.hcp_estimate_id)
+        self.assertNotEqual(second.ghl_opportunity_id, converted.ghl_opportunity_id)
+
+    def test_job_before_its_estimate_keeps_the_estimate_link(self):
+        records = [
+            {'customer': sample_customer('cus-bf')},
+            {'job': sample_job('job-bf1', 'cus-bf', estimate_id='est-bf')},
+            {'estimate': sample_estimate('est-bf', 'cus-bf')},
+        ]
+        stats = self.backfill(records, BackfillCheckpoint(None))
+        [mapping] = OpportunityMapping.objects.filter(hcp_company_id=COMPANY_ID)
+        self.assertEqual((mapping.hcp_job_id, mapping.hcp_estimate_id), ('job-bf1', 'est-bf'))
+        # The estimate is already represented by its job's opportunity, no orphan is created in GHL
+        self.assertEqual(stats['opportunities_created'], 1)
+        self.assertEqual(self.session.requests.count(('POST', '/opportunities/')), 1)
+
+    def test_array_dumps_are_read_item_by_item(self):
+        items = [
+            {'customers': [sample_customer('cus-bf1'), sample_customer('cus-bf2')]},
+            {'event': 'job.created', 'job': sample_job('job-bf1', 'cus-bf1')},
+            {'estimate': dict(sample_estimate('est-bf1', 'cus-bf1'), note='[ünïcode, "quoted"]')},
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.json', encoding='utf-8') as dump:
+            dump.write(' [\n' + ',\n'.join(json.dumps(item, ensure_ascii=False) for item in items) + '\n]\n')
+            dump.flush()
+            # Chunks far smaller than an item, every item spans several reads
+            with mock.patch('core.backfill.DUMP_CHUNK_SIZE', 16):
+                records = list(iter_dump_records(dump.name))
+        self.assertEqual([next(iter(record.values()))['id'] for record in records], ['cus-bf1', 'cus-bf2', 'job-bf1', 'est-bf1'])
+        self.assertEqual(records[-1]['estimate']['note'], '[ünïcode, "quoted"]')
+
+    def test_contacts_are_matched_like_webhook_customers(self):
+        ContactMapping.objects.create(
+            hcp_customer_id='cus-other', ghl_contact_id='taken', hcp_company_id=COMPANY_ID, ghl_location_id=COMPANY_ID,
+        )
+        index_contact(COMPANY_ID, 'taken', contact_keys(email='cus-bf-taken@example.com'))
+        index_contact(COMPANY_ID, 'free', contact_keys(email='cus-bf-free@example.com'))
+        records = [{'customer': sample_customer('cus-bf-taken')}, {'customer': sample_customer('cus-bf-free')}]
+        with override_settings(GHL_CONTACT_DEDUP_SEARCH=False):
+            self.backfill(records, BackfillCheckpoint(None))
+        contacts = dict(ContactMapping.objects.filter(hcp_customer_id__startswith='cus-bf').values_list(
+            'hcp_customer_id', 'ghl_contact_id'
+        ))
+        self.assertEqual(contacts['cus-bf-free'], 'free')
+        self.assertNotEqual(contacts['cus-bf-taken'], 'taken')
+        # The other customer's contact isn't upserted into, the free one is only updated
+        self.assertEqual(sorted(self.session.requests), [('POST', '/contacts/'), ('PUT', '/contacts/free')])
+
+    def test_failed_records_are_retried_on_resume(self):
+        records = [{'customer': sample_customer(f'cus-bf{n}')} for n in range(4)]
+        checkpoint = BackfillCheckpoint(None)
+        def create_contact(service, customer, existing_contact_id, skipped_match):
+            return None if customer['id'] in ('cus-bf0', 'cus-bf3') else f"ghl-{customer['id']}"
+
+        with mock.patch.object(HCPBackfill, '_create_contact', side_effect=create_contact):
+            stats = self.backfill(records, checkpoint)
+        self.assertEqual((checkpoint.offset, checkpoint.failed, stats['failed']), (4, [0, 3], 2))
+
+        stats = self.backfill(records, checkpoint)
+        self.assertEqual((checkpoint.failed, stats['failed']), ([], 0))
+        self.assertEqual(ContactMapping.objects.filter(hcp_company_id=COMPANY_ID).count(), 4)
+
+
+class PendingContactTests(GHLTestCase):
+    def test_opportunity_is_queued_behind_a_failed_contact_create(self):
+        self.session.failing[('POST', '/contacts/upsert')] = (500, {})
+        result = HousecallProWebhookService().process_webhook(
+            sample_webhook('job.created', COMPANY_ID, customer_id='cus-pend', job_id='job-pend')
+        )
+        self.assertIn('error', result)
+        contact_mapping = ContactMapping.objects.get(hcp_customer_id='cus-pend')
+        opp_mapping = OpportunityMapping.objects.get(hcp_job_id='job-pend')
+        opportunity = GHLOutboxMessage.objects.get(opportunity_mapping=opp_mapping)
+        self.assertEqual((opportunity.payload['contact_id'], opportunity.payload['customer_id']), (None, 'cus-pend'))
+
+        # The contact is still queued, the opportunity waits without using up an attempt
+        self.assertIsNone(relay_now(opportunity_mapping=opp_mapping))
+        opportunity.refresh_from_db()
+        self.assertEqual((opportunity.status, opportunity.attempts), (GHLOutboxMessage.STATUS_PENDING, 0))
+
+        self.session.failing.clear()
+        contact_id = relay_now(contact_mapping=contact_mapping)
+        self.assertTrue(contact_id)
+        self.session.requests.clear()
+        self.assertTrue(relay_now(opportunity_mapping=opp_mapping))
+        self.assertEqual(self.session.requests, [('POST', '/opportunities/')])
+
+    def test_relay_counts_an_opportunity_waiting_for_its_contact_as_deferred(self):
+        self.session.failing[('POST', '/contacts/upsert')] = (500, {})
+        HousecallProWebhookService().process_webhook(
+            sample_webhook('job.created', COMPANY_ID, customer_id='cus-defer', job_id='job-defer')
+        )
+        GHLOutboxMessage.objects.update(next_attempt_at=timezone.now())
+        deferred = GHL_OUTBOX_DELIVERIES.labels(
+            operation=GHLOutboxMessage.OPERATION_CREATE_OPPORTUNITY, outcome='deferred'
+        )
+        before = deferred._value.get()
+
+        # Deliver on this thread, the sqlite test database is not shared with pool threads
+        pool = mock.MagicMock()
+        pool.return_value.__enter__.return_value.map = map
+        with mock.patch('core.outbox.ThreadPoolExecutor', pool), \
+                mock.patch('core.outbox._deliver_in_thread', _deliver):
+            stats = relay_outbox()
+        self.assertEqual(stats, {'sent': 0, 'failed': 1, 'deferred': 1})
+        self.assertEqual(deferred._value.get(), before + 1)
+
+
+class DeadLetterTests(GHLTestCase):
+    url = 'https://services.leadconnectorhq.com/contacts/dead'
+
+    def claimed(self, body):
+        GHLDeadLetter.objects.create(
+            method='PUT', url=self.url, body=body, location_id=COMPANY_ID, error_class='HTTPError',
+            next_attempt_at=timezone.now(),
+        )
+        [dead_letter] = claim_dead_letters(10)
+        return dead_letter
+
+    def test_claimed_dead_letter_superseded_by_a_newer_write_is_not_sent(self):
+        dead_letter = self.claimed({'firstName': 'Old'})
+        supersede_dead_letters('PUT', self.url, {'firstName': 'New'})
+        self.assertTrue(retry_dead_letter(dead_letter))
+        self.assertEqual(self.session.requests, [])
+        dead_letter.refresh_from_db()
+        self.assertEqual(dead_letter.status, GHLDeadLetter.STATUS_SUPERSEDED)
+
+    def test_claimed_dead_letter_sends_only_what_newer_writes_left(self):
+        dead_letter = self.claimed({'firstName': 'Old', 'phone': '+15550003333'})
+        supersede_dead_letters('PUT', self.url, {'firstName': 'New'})
+        self.assertTrue(retry_dead_letter(dead_letter))
+        self.assertEqual(self.session.payloads, [{'phone': '+15550003333'}])
+        dead_letter.refresh_from_db()
+        self.assertEqual(dead_letter.status, GHLDeadLetter.STATUS_SUCCEEDED)
+
+    def test_requeue_skips_superseded_and_replays_only_what_failed_rows_have_left(self):
+        superseded = self.claimed({'firstName': 'Old'})
+        failed = GHLDeadLetter.objects.create(
+            method='PUT', url=self.url, body={'firstName': 'Old', 'phone': '+15550003333'}, location_id=COMPANY_ID,
+            error_class='HTTPError', status=GHLDeadLetter.STATUS_FAILED, next_attempt_at=timezone.now(),
+        )
+        supersede_dead_letters('PUT', self.url, {'firstName': 'New'})
+        self.assertEqual(requeue_dead_letters(GHLDeadLetter.objects.all()), 1)
+        superseded.refresh_from_db()
+        failed.refresh_from_db()
+        self.assertEqual(superseded.status, GHLDeadLetter.STATUS_SUPERSEDED)
+        self.assertEqual((failed.status, failed.body), (GHLDeadLetter.STATUS_PENDING, {'phone': '+15550003333'}))
+
+
+# Lane threads can't share the test database, only test_events_keep_their_order_within_each_lane uses them
+@override_settings(HCP_WEBHOOK_ASYNC=False, HCP_WEBHOOK_BATCH_CONCURRENCY=1)
+class BatchWebhookTests(GHLTestCase):
+    path = '/core/webhook/batch/'
+
+    def post(self, body, content_type='application/json'):
+        return self.client.post(self.path, data=body, content_type=content_type)
+
+    def event(self, event_type, suffix):
+        return sample_webhook(event_type, COMPANY_ID, customer_id=f'cus-{suffix}', job_id=f'job-{suffix}')
+
+    def test_array_and_ndjson_bodies_give_the_same_results(self):
+        events = [self.event('customer.created', 'a'), self.event('customer.created', 'b')]
+        array = self.post(json.dumps(events)).json()
+        cache.clear()
+        ndjson = self.post('\n'.join(json.dumps(event) for event in events), 'application/x-ndjson').json()
+        self.assertEqual([item['status'] for item in array['results']], ['processed', 'processed'])
+        self.assertEqual(
+            [(item['index'], item['status']) for item in ndjson['results']],
+            [(item['index'], item['status']) for item in array['results']],
+        )
+        # NDJSON lines are stored as received, array items as parsed payloads
+        self.assertEqual(Webhook.objects.exclude(raw_payload=None).count(), 2)
+        self.assertEqual(Webhook.objects.filter(raw_payload=None).count(), 2)
+
+    def test_per_item_invalid_duplicate_and_ignored_results(self):
+        event = self.event('customer.created', 'items')
+        body = '\n'.join([json.dumps(event), 'not json', '[1]', json.dumps({'foo': 'bar'}), json.dumps(event)])
+        response = self.post(body, 'application/x-ndjson').json()
+        self.assertEqual(
+            [item['status'] for item in response['results']],
+            ['processed', 'invalid', 'invalid', 'ignored', 'duplicate'],
+        )
+        self.assertEqual(response['counts'], {'processed': 1, 'invalid': 2, 'ignored': 1, 'duplicate': 1})
+        self.assertEqual(Webhook.objects.count(), 1)
+
+    @override_settings(HCP_WEBHOOK_ASYNC=True)
+    def test_dispatch_failure_after_commit_keeps_the_batch_accepted(self):
+        events = [self.event('customer.created', n) for n in range(2)]
+        with mock.patch('core.batch.dispatch_webhook', side_effect=[redis.ConnectionError('broker down'), None]) as dispatch, \
+                self.assertLogs('core.batch', 'ERROR') as logs, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.post(json.dumps(events))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([item['status'] for item in response.json()['results']], ['accepted', 'accepted'])
+        self.assertEqual(dispatch.call_count, 2)
+        # The undispatched row stays pending for a replay, its delivery is still claimed
+        first = Webhook.objects.order_by('id').first()
+        self.assertEqual(first.status, Webhook.STATUS_PENDING)
+        self.assertIn(f'left pending, not dispatched: [{first.id}]', logs.output[-1])
+        self.assertEqual(self.post(json.dumps(events[:1])).json()['results'][0]['status'], 'duplicate')
+
+    def test_items_are_stored_and_updated_in_bulk(self):
+        events = [self.event('customer.created', n) for n in range(3)]
+        outcomes = [{'message': 'ok'}, {'error': 'GHL down'}, {'message': 'ok'}]
+        with mock.patch.object(HousecallProWebhookService, 'process_webhook', side_effect=outcomes), \
+                mock.patch('core.batch.Webhook.objects.bulk_create', wraps=Webhook.objects.bulk_create) as bulk_create, \
+                mock.patch('core.batch.Webhook.objects.bulk_update', wraps=Webhook.objects.bulk_update) as bulk_update:
+            response = self.post(json.dumps(events)).json()
+        self.assertEqual((bulk_create.call_count, bulk_update.call_count), (1, 1))
+        self.assertEqual([item['status'] for item in response['results']], ['processed', 'failed', 'processed'])
+        stored = {webhook.id: webhook for webhook in Webhook.objects.all()}
+        for item, outcome in zip(response['results'], outcomes):
+            webhook = stored[item['webhook_id']]
+            self.assertEqual((webhook.result, webhook.processed_at is not None), (outcome, True))
+
+    @override_settings(HCP_WEBHOOK_BATCH_CONCURRENCY=4)
+    def test_events_keep_their_order_within_each_lane(self):
+        events = [self.event(event_type, suffix) for suffix in ('x', 'y', 'z')
+                  for event_type in ('job.created', 'job.scheduled', 'job.started', 'job.completed')]
+        seen = []
+
+        def process(webhook, webhook_data):
+            seen.append((threading.current_thread().name, webhook_data['job']['id'], webhook_data['event']))
+            return {'message': 'ok'}
+
+        with mock.patch('core.batch._process_stored', side_effect=process):
+            self.post(json.dumps(events))
+        for suffix in ('x', 'y', 'z'):
+            with self.subTest(job=suffix):
+                of_job = [(lane, event) for lane, job_id, event in seen if job_id == f'job-{suffix}']
+                self.assertEqual(len({lane for lane, _ in of_job}), 1)
+                self.assertEqual([event for _, event in of_job],
+                                 ['job.created', 'job.scheduled', 'job.started', 'job.completed'])
+
+    @override_settings(HCP_WEBHOOK_ASYNC=True)
+    def test_async_batches_are_dispatched_in_order_after_commit(self):
+        events = [self.event('job.created', 'async'), self.event('job.scheduled', 'async')]
+        with mock.patch('core.batch.dispatch_webhook') as dispatch, self.captureOnCommitCallbacks(execute=True):
+            response = self.post(json.dumps(events))
+            dispatch.assert_not_called()
+        self.assertEqual(response.status_code, 202)
+        ids = [item['webhook_id'] for item in response.json()['results']]
+        self.assertEqual([call.args[0] for call in dispatch.call_args_list], ids)
+        self.assertEqual([call.args[1]['event'] for call in dispatch.call_args_list], ['job.created', 'job.scheduled'])
+
+    def test_batches_over_the_limits_are_refused(self):
+        events = [self.event('customer.created', n) for n in range(3)]
+        with self.subTest('items'), self.settings(HCP_WEBHOOK_BATCH_MAX_ITEMS=2):
+            self.assertEqual(self.post(json.dumps(events)).status_code, 413)
+            self.assertEqual(self.post('\n'.join(map(json.dumps, events)), 'application/x-ndjson').status_code, 413)
+        with self.subTest('bytes'), self.settings(HCP_WEBHOOK_BATCH_MAX_BODY_BYTES=100):
+            self.assertEqual(self.post(json.dumps(events)).status_code, 413)
+        with self.subTest('line'), self.settings(HCP_WEBHOOK_MAX_BODY_BYTES=100):
+            self.assertEqual(self.post('\n'.join(map(json.dumps, events)), 'application/x-ndjson').status_code, 413)
+        self.assertEqual(Webhook.objects.count(), 0)
+
+
+class RetryAfterTests(GHLTestCase):
+    def test_long_retry_after_is_dead_lettered_instead_of_slept_out(self):
+        self.session.failing[('PUT', '/contacts/limited')] = (429, {'Retry-After': '3600'})
+        service = GoHighLevelService('token', 'customer.updated', location_id=COMPANY_ID)
+        with mock.patch('core.services.time.sleep') as sleep, self.assertRaises(requests.HTTPError):
+            service._write('PUT', f'{service.BASE_URL}/contacts/limited', {'firstName': 'Jane'})
+        sleep.assert_not_called()
+        self.assertEqual(self.session.requests, [('PUT', '/contacts/limited')])
+        dead_letter = GHLDeadLetter.objects.get()
+        self.assertEqual((dead_letter.status, dead_letter.status_code), (GHLDeadLetter.STATUS_PENDING, 429))
+        self.assertGreaterEqual(dead_letter.next_attempt_at, timezone.now() + timedelta(seconds=3590))
+
+    @override_settings(GHL_RATE_LIMIT_MAX_RETRIES=1)
+    def test_short_retry_after_is_waited_out(self):
+        self.session.failing[('PUT', '/contacts/limited')] = (429, {'Retry-After': '2'})
+        service = GoHighLevelService('token', 'customer.updated', location_id=COMPANY_ID)
+        with mock.patch('core.services.time.sleep') as sleep:
+            service._request('PUT', f'{service.BASE_URL}/contacts/limited')
+        self.assertEqual(len(self.session.requests), 2)
+        self.assertTrue(2 <= sleep.call_args.args[0] <= 2.5)
+
+
+class AsyncClientTests(GHLTestCase):
+    """AsyncGoHighLevelService against an httpx MockTransport"""
+
+    def setUp(self):
+        super().setUp()
+        self.requests = []
+        patcher = mock.patch('core.ratelimit.GHLRateLimiter.acquire_async', new=mock.AsyncMock(return_value=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, request):
+        self.requests.append((request.method, request.url.path))
+        if request.url.path == '/opportunities/broken':
+            return httpx.Response(500)
+        if request.url.path == '/opportunities/search':
+            return httpx.Response(200, json={'opportunities': [{'id': 'opp1', 'name': 'Estimate est-1'}]})
+        if request.url.path == '/contacts/search/duplicate':
+            return httpx.Response(200, json={'contact': {'id': 'dup1'}})
+        return httpx.Response(200, json={'contact': {'id': 'ghl1'}, 'contacts': [], 'meta': {}})
+
+    def service(self, client):
+        return AsyncGoHighLevelService('token', 'job.updated', client=client, location_id=COMPANY_ID)
+
+    async def test_read_methods_match_the_sync_client(self):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(self.handle)) as client:
+            service = self.service(client)
+            self.assertEqual(await service.upsert_contact(COMPANY_ID, sample_customer('cus-1')), 'ghl1')
+            self.assertEqual(await service.search_duplicate_contact(COMPANY_ID, email='a@example.com'), {'id': 'dup1'})
+            self.assertEqual(await service.search_opportunity(COMPANY_ID, 'ghl1', 'Estimate est-1'), 'opp1')
+            self.assertEqual(await service.list_contacts(COMPANY_ID), {'contact': {'id': 'ghl1'}, 'contacts': [], 'meta': {}})
+        self.assertEqual([path for method, path in self.requests], [
+            '/contacts/upsert', '/contacts/search/duplicate', '/opportunities/search', '/contacts/',
+        ])
+
+    async def test_failed_update_is_dead_lettered(self):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(self.handle)) as client:
+            self.assertFalse(await self.service(client).close_opportunity('broken', won=True))
+        dead_letter = await GHLDeadLetter.objects.aget()
+        self.assertEqual((dead_letter.method, dead_letter.status_code, dead_letter.body), ('PUT', 500, {'status': 'won'}))
+
+
+class TokenExpiryTests(GHLTestCase):
+    def credentials(self, user_id, expires_at):
+        return GHLAuthCredentials.objects.create(
+            user_id=user_id, access_token=user_id, refresh_token=user_id, expires_in=86399, expires_at=expires_at,
+        )
+
+    @override_settings(GHL_TOKEN_REFRESH_MARGIN=3600)
+    def test_scheduler_refreshes_rows_by_their_stored_expiry(self):
+        GHLAuthCredentials.objects.update(expires_at=timezone.now() + timedelta(days=1))
+        soon = self.credentials('soon', timezone.now() + timedelta(minutes=30))
+        unknown = self.credentials('unknown', None)
+        later = self.credentials('later', timezone.now() + timedelta(hours=2))
+        # A save of another field doesn't postpone the expiry
+        later.scope = 'contacts.write'
+        later.save()
+        with mock.patch('core.tasks._refresh_in_thread', side_effect=lambda credentials: credentials.id) as refresh:
+            self.assertEqual(refresh_expiring_tokens(), {'refreshed': 2, 'failed': 0})
+        self.assertEqual({call.args[0].id for call in refresh.call_args_list}, {soon.id, unknown.id})
+
+    def test_refresh_stores_the_new_expiry(self):
+        credentials = self.credentials('expiring', timezone.now())
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'access_token': 'new', 'refresh_token': 'new-refresh', 'expires_in': 7200}
+        session = mock.Mock()
+        session.post.return_value = response
+        with mock.patch('core.services.get_ghl_session', return_value=session), \
+                mock.patch('core.services.config', return_value='client'):
+            self.assertTrue(refresh_ghl_credentials(credentials))
+        credentials.refresh_from_db()
+        self.assertEqual(credentials.access_token, 'new')
+        self.assertAlmostEqual(
+            credentials.expires_at, timezone.now() + timedelta(seconds=7200), delta=timedelta(seconds=60),
+        )
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TokenRefreshTests(TransactionTestCase):
+    """Workers hitting 401 together, each thread has its own database connection"""
+    workers = 4
+
+    def setUp(self):
+        self.credentials = GHLAuthCredentials.objects.create(
+            user_id=COMPANY_ID, access_token='stale', refresh_token='refresh', expires_in=86399, location_id=COMPANY_ID,
+        )
+        self.all_rejected = threading.Barrier(self.workers)
+        self.tokens = []
+        self.refreshes = 0
+        patchers = [
+            mock.patch('core.ratelimit.GHLRateLimiter.acquire', return_value=True),
+            mock.patch('core.services.get_redis_client', side_effect=redis.exceptions.ConnectionError('Redis is down')),
+            mock.patch('core.services.refresh_ghl_credentials', side_effect=self.refresh),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def refresh(self, credentials):
+        self.refreshes += 1
+        credentials.access_token = 'fresh'
+        credentials.save()
+        return True
+
+    def request(self, method, url, headers, **kwargs):
+        token = headers['Authorization'].split()[-1]
+        self.tokens.append(token)
+        if token == 'stale':
+            # Every worker gets its 401 before any of them refreshes
+            self.all_rejected.wait(timeout=5)
+            return mock.Mock(status_code=401, headers={})
+        return mock.Mock(status_code=200, headers={})
+
+    def test_concurrent_401s_refresh_once_and_every_request_is_replayed(self):
+        session = mock.Mock(request=self.request)
+
+        def call():
+            try:
+                service = GoHighLevelService(
+                    'stale', 'job.updated', session=session, credentials=GHLAuthCredentials.objects.get(),
+                )
+                return service._request('GET', f'{service.BASE_URL}/contacts/x').status_code, service.access_token
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = [future.result() for future in [pool.submit(call) for _ in range(self.workers)]]
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(results, [(200, 'fresh')] * self.workers)
+        self.assertEqual(sorted(self.tokens), ['fresh'] * self.workers + ['stale'] * self.workers)
+
+
+class MappingCacheTests(GHLTestCase):
+    def test_lookups_fall_back_to_the_database_when_the_cache_is_down(self):
+        down = ConnectionError('Redis is down')
+        with mock.patch('core.cache.cache.get', side_effect=down), mock.patch('core.cache.cache.set', side_effect=down):
+            self.assertEqual(get_company_mapping(COMPANY_ID).ghl_location_id, COMPANY_ID)
+        _mapping_cache.clear()
+        with mock.patch('core.cache.cache.get_many', side_effect=down), \
+                mock.patch('core.cache.cache.set_many', side_effect=down):
+            self.assertEqual(warm_company_mappings([COMPANY_ID]), 1)
+
+
+class RetentionTests(TestCase):
+    def webhook(self, days_ago, processed):
+        webhook = Webhook.objects.create(event='job.updated', company_id=COMPANY_ID, payload={'id': days_ago})
+        received_at = timezone.now() - timedelta(days=days_ago)
+        Webhook.objects.filter(id=webhook.id).update(
+            received_at=received_at, processed_at=received_at if processed else None,
+            status=Webhook.STATUS_PROCESSED if processed else Webhook.STATUS_PENDING,
+        )
+        return webhook
+
+    def test_compressed_payloads_read_back_unchanged(self):
+        payload = sample_webhook('job.updated', COMPANY_ID)
+        stored = self.webhook(10, processed=True)
+        Webhook.objects.filter(id=stored.id).update(payload=payload)
+        raw = self.webhook(10, processed=True)
+        Webhook.objects.filter(id=raw.id).update(payload=None, raw_payload=json.dumps(payload).encode())
+        self.assertEqual(compress_old_webhooks(7), 2)
+        for webhook in Webhook.objects.filter(id__in=[stored.id, raw.id]):
+            self.assertEqual((webhook.payload, webhook.raw_payload), (None, None))
+            self.assertIsNotNone(webhook.payload_compressed)
+            self.assertEqual(webhook.get_payload(), payload)
+
+    def test_archived_webhooks_read_back_from_gzipped_jsonl(self):
+        old = [self.webhook(100, processed=True) for _ in range(3)]
+        kept = self.webhook(10, processed=True)
+        compress_old_webhooks(7)
+        with tempfile.TemporaryDirectory() as archive_dir:
+            self.assertEqual(archive_old_webhooks(90, archive_dir, batch_size=2), 3)
+            files = list(archive_files([archive_dir]))
+            self.assertEqual(len(files), 2)
+            with gzip.open(files[0], 'rt') as f:
+                self.assertEqual([json.loads(line)['id'] for line in f], [old[0].id, old[1].id])
+            records = list(iter_archived_webhooks([archive_dir]))
+        self.assertEqual([record['id'] for record in records], [webhook.id for webhook in old])
+        self.assertEqual([record['payload'] for record in records], [{'id': 100}] * 3)
+        self.assertEqual(records[0]['status'], Webhook.STATUS_PROCESSED)
+        self.assertLess(records[0]['received_at'], timezone.now() - timedelta(days=99))
+        self.assertEqual(list(Webhook.objects.values_list('id', flat=True)), [kept.id])
+
+    @override_settings(HCP_WEBHOOK_STALE_GRACE_DAYS=30)
+    def test_unfinished_webhooks_are_retained_after_the_grace_period(self):
+        finished = self.webhook(10, processed=True)
+        pending = self.webhook(10, processed=False)
+        stale = self.webhook(50, processed=False)
+        self.assertEqual(compress_old_webhooks(7), 2)
+        self.assertEqual(
+            set(Webhook.objects.filter(payload__isnull=True).values_list('id', flat=True)), {finished.id, stale.id},
+        )
+        self.assertEqual(Webhook.objects.get(id=pending.id).payload, {'id': 10})
@@ -2,7 +2,7 @@ from django.urls import path
 from core.views import auth_connect,tokens,callback
 
 from django.urls import path
-from .views import HousecallProWebhookView
+from .views import HousecallProWebhookBatchView, HousecallProWebhookView
 
 urlpatterns = [
     path("auth/connect/", auth_connect, name="oauth_connect"),
@@ -10,4 +10,5 @@ urlpatterns = [
     path("auth/callback/", callback, name="oauth_callback"),
     # path("webhook/", webhook),
     path('webhook/', HousecallProWebhookView.as_view(), name='hcp_webhook'),
+    path('webhook/batch/', HousecallProWebhookBatchView.as_view(), name='hcp_webhook_batch'),
 ]
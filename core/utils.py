@@ -0,0 +1,52 @@
+import os
+import threading
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+_session_lock = threading.Lock()
+_session = None
+_session_pid = None
+_redis_client = None
+
+
+def build_http_session(pool_size: int = None) -> requests.Session:
+    """Build a keep-alive session whose connection pool holds pool_size connections per host"""
+    pool_size = pool_size or settings.GHL_HTTP_POOL_SIZE
+    session = requests.Session()
+    # No automatic retries here, failures are surfaced to the caller
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def get_ghl_session() -> requests.Session:
+    """Return the per-process session shared by all GoHighLevel calls.
+
+    The session is rebuilt after a fork so gunicorn/celery children never
+    share sockets with their parent.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = build_http_session()
+                _session_pid = pid
+    return _session
+
+
+def get_ghl_timeout() -> tuple:
+    """(connect, read) timeout applied to every GoHighLevel request"""
+    return (settings.GHL_HTTP_CONNECT_TIMEOUT, settings.GHL_HTTP_READ_TIMEOUT)
+
+
+def get_redis_client() -> redis.Redis:
+    """Shared Redis client for cross-process locks and counters"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(f"{settings.REDIS_URL}/1", socket_timeout=5, socket_connect_timeout=5)
+    return _redis_client
@@ -1,15 +1,23 @@
 from decouple import config
 import requests
 from django.http import JsonResponse
-import json
 from django.shortcuts import redirect
 from core.models import GHLAuthCredentials
+from core.cache import invalidate_credentials
 from django.views.decorators.csrf import csrf_exempt
 import logging
 from django.views import View
 from django.utils.decorators import method_decorator
 from core.models import Webhook
 from core.services import HousecallProWebhookService
+from core.dedup import forget_webhook, is_duplicate_webhook
+from core.dispatch import dispatch_webhook
+from core.batch import BatchTooLarge, ingest_batch, parse_batch
+from core.ingest import BodyTooLarge, envelope, loads, read_body
+from core.metrics import HCP_WEBHOOK_VIEW_SECONDS, timed
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 import traceback
 
 
@@ -72,6 +80,7 @@ def tokens(request):
                 "access_token": response_data.get("access_token"),
                 "refresh_token": response_data.get("refresh_token"),
                 "expires_in": response_data.get("expires_in"),
+                "expires_at": GHLAuthCredentials.expiry_for(response_data.get("expires_in")),
                 "scope": response_data.get("scope"),
                 "user_type": response_data.get("userType"),
                 "company_id": response_data.get("companyId"),
@@ -79,6 +88,7 @@ def tokens(request):
 
             }
         )
+        invalidate_credentials(obj)
         return JsonResponse({
             "message": "Authentication successful",
             "access_token": response_data.get('access_token'),
@@ -116,38 +126,98 @@ logger = logging.getLogger(__name__)
 class HousecallProWebhookView(View):
     
     def post(self, request):
+        claimed = None
         try:
-            # Parse webhook data
-            webhook_data = json.loads(request.body)
+            # Read (size-capped) and parse the body, the bytes are stored as received
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='parse'):
+                body = read_body(request)
+                webhook_data = loads(body)
+            if not isinstance(webhook_data, dict):
+                return JsonResponse({"error": "Webhook body must be a JSON object"}, status=400)
             if "foo" in webhook_data:
                 return JsonResponse({"message": "Success"}, status=200)
 
-            print("Webhook Data: ", webhook_data)
-
             event = webhook_data.get("event")
             company_id = webhook_data.get("company_id")
+            # Sampled and redacted by WebhookPayloadFilter, see core/log_handlers.py
+            logger.info(f"Webhook payload: {event} for company {company_id}", extra={'payload': webhook_data})
+
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='dedup'):
+                duplicate = is_duplicate_webhook(webhook_data)
+            if duplicate:
+                logger.info(f"Duplicate webhook ignored: {event} for company {company_id}")
+                return JsonResponse({"message": "Duplicate webhook ignored"}, status=200)
+            # Released if the delivery isn't stored or processed, so HCP's retry isn't dropped as a duplicate
+            claimed = webhook_data
 
             # Save to DB
-            Webhook.objects.create(
-                event=event,
-                company_id=company_id,
-                payload=webhook_data
-            )
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='store'):
+                webhook = Webhook.objects.create(
+                    event=event,
+                    company_id=company_id,
+                    raw_payload=body
+                )
             
             # Log the received webhook
             logger.info(f"Received webhook: {webhook_data.get('event')} for company {webhook_data.get('company_id')}")
             
+            if settings.HCP_WEBHOOK_ASYNC:
+                # Acknowledge right away, the worker re-reads the row and records the outcome
+                # Routed to the ordered lane of its customer/job, only the routing fields are kept until then
+                routing = envelope(webhook_data)
+                with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='dispatch'):
+                    transaction.on_commit(lambda: dispatch_webhook(webhook.id, routing))
+                return JsonResponse({"message": "Webhook accepted", "webhook_id": webhook.id}, status=202)
+
             # Process the webhook
-            service = HousecallProWebhookService()
-            result = service.process_webhook(webhook_data)
-            print("result : ", result)
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='process'):
+                service = HousecallProWebhookService()
+                result = service.process_webhook(webhook_data)
+            logger.debug(f"Webhook {webhook.id} result: {result}")
+            if result.get('error'):
+                forget_webhook(claimed)
+
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='store'):
+                webhook.status = Webhook.STATUS_FAILED if result.get('error') else Webhook.STATUS_PROCESSED
+                webhook.result = result
+                webhook.processed_at = timezone.now()
+                webhook.save(update_fields=['status', 'result', 'processed_at'])
             
             return JsonResponse(result, status=200)
             
-        except json.JSONDecodeError:
+        except BodyTooLarge as e:
+            logger.error(f"Webhook request refused: {e}")
+            return JsonResponse({"error": str(e)}, status=413)
+        except ValueError:
+            # json.JSONDecodeError, orjson.JSONDecodeError or a body that isn't UTF-8
             logger.error("Invalid JSON in webhook request")
             return JsonResponse({"error": "Invalid JSON"}, status=400)
         except Exception as e:
             logger.error("Exception in process_webhook:\n" + traceback.format_exc())
+            if claimed is not None:
+                forget_webhook(claimed)
            
             return JsonResponse({"error": "Internal server error"}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class HousecallProWebhookBatchView(View):
+    """Many HCP events in one POST, as a JSON array or NDJSON, see core/batch.py"""
+
+    def post(self, request):
+        try:
+            with timed(HCP_WEBHOOK_VIEW_SECONDS, phase='parse'):
+                items = parse_batch(request)
+        except (BatchTooLarge, BodyTooLarge) as e:
+            logger.error(f"Webhook batch request refused: {e}")
+            return JsonResponse({"error": str(e)}, status=413)
+        except ValueError:
+            logger.error("Invalid JSON in webhook batch request")
+            return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+        try:
+            response = ingest_batch(items)
+        except Exception:
+            logger.error("Exception in webhook batch:\n" + traceback.format_exc())
+            return JsonResponse({"error": "Internal server error"}, status=500)
+        return JsonResponse(response, status=202 if settings.HCP_WEBHOOK_ASYNC else 200)
@@ -11,7 +11,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
+from kombu import Queue
 from datetime import timedelta
 import os
 
@@ -141,25 +142,178 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')  # You can name this folder
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
-CELERY_BROKER_URL = 'redis://localhost:6379/0'
-CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
+REDIS_URL = config("REDIS_URL", default="redis://localhost:6379")
+
+# Shared cache, also used to keep cross-process state like job lanes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f'{REDIS_URL}/1',
+    }
+}
+
+CELERY_BROKER_URL = f'{REDIS_URL}/0'
+CELERY_RESULT_BACKEND = f'{REDIS_URL}/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+# Lanes must hand out one task at a time to stay ordered
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+
+# When enabled the webhook view only stores the payload and returns 202,
+# the handle_webhook_event task does the GoHighLevel sync.
+HCP_WEBHOOK_ASYNC = config("HCP_WEBHOOK_ASYNC", default=True, cast=bool)
+
+# Identical deliveries within this many seconds are dropped, 0 disables dedup
+HCP_WEBHOOK_DEDUP_WINDOW = config("HCP_WEBHOOK_DEDUP_WINDOW", default=600, cast=int)
+
+# Ordered processing lanes, see core/dispatch.py. Changing the lane count
+# re-partitions keys, drain the queues first.
+HCP_WEBHOOK_LANES = config("HCP_WEBHOOK_LANES", default=8, cast=int)
+HCP_WEBHOOK_QUEUE_PREFIX = config("HCP_WEBHOOK_QUEUE_PREFIX", default="hcp_webhooks")
+# The default queue plus one queue per lane, lane tasks queued without a queue
+# are routed to their lane. Start lane workers with manage.py lane_worker
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+CELERY_TASK_QUEUES = [Queue(CELERY_TASK_DEFAULT_QUEUE)] + [
+    Queue(f"{HCP_WEBHOOK_QUEUE_PREFIX}.{lane}") for lane in range(HCP_WEBHOOK_LANES)
+]
+CELERY_TASK_ROUTES = ['core.dispatch.route_lane_task']
+# A failing webhook is retried in its lane, holding the events behind it, this
+# many times with a delay doubling from HCP_WEBHOOK_RETRY_DELAY seconds
+HCP_WEBHOOK_RETRIES = config("HCP_WEBHOOK_RETRIES", default=3, cast=int)
+HCP_WEBHOOK_RETRY_DELAY = config("HCP_WEBHOOK_RETRY_DELAY", default=2, cast=float)
+
+# Largest webhook body, and NDJSON line, accepted in bytes. Larger ones get 413, see core/ingest.py
+HCP_WEBHOOK_MAX_BODY_BYTES = config("HCP_WEBHOOK_MAX_BODY_BYTES", default=2 * 1024 * 1024, cast=int)
+
+# Batch webhook endpoint (core/webhook/batch/, see core/batch.py): most events
+# and bytes per request, and parallel lanes used when HCP_WEBHOOK_ASYNC is off
+HCP_WEBHOOK_BATCH_MAX_ITEMS = config("HCP_WEBHOOK_BATCH_MAX_ITEMS", default=1000, cast=int)
+HCP_WEBHOOK_BATCH_MAX_BODY_BYTES = config("HCP_WEBHOOK_BATCH_MAX_BODY_BYTES", default=32 * 1024 * 1024, cast=int)
+HCP_WEBHOOK_BATCH_CONCURRENCY = config("HCP_WEBHOOK_BATCH_CONCURRENCY", default=4, cast=int)
+
+# Job progress and appointment events of one job arriving within this many
+# seconds are applied as one update, see core/coalesce.py. 0 disables.
+HCP_COALESCE_WINDOW_SECONDS = config("HCP_COALESCE_WINDOW_SECONDS", default=5, cast=int)
+
+# Webhook retention, see core/retention.py: payloads of finished webhooks are
+# compressed after HCP_WEBHOOK_COMPRESS_AFTER_DAYS, rows older than
+# HCP_WEBHOOK_RETENTION_DAYS are moved to gzipped JSONL files in
+# HCP_WEBHOOK_ARCHIVE_DIR and deleted, HCP_WEBHOOK_PRUNE_BATCH_SIZE rows per transaction.
+# Webhooks that never finished get HCP_WEBHOOK_STALE_GRACE_DAYS more on both cutoffs
+HCP_WEBHOOK_COMPRESS_AFTER_DAYS = config("HCP_WEBHOOK_COMPRESS_AFTER_DAYS", default=7, cast=int)
+HCP_WEBHOOK_RETENTION_DAYS = config("HCP_WEBHOOK_RETENTION_DAYS", default=90, cast=int)
+HCP_WEBHOOK_ARCHIVE_DIR = config("HCP_WEBHOOK_ARCHIVE_DIR", default=str(BASE_DIR / 'webhook_archive'))
+HCP_WEBHOOK_STALE_GRACE_DAYS = config("HCP_WEBHOOK_STALE_GRACE_DAYS", default=30, cast=int)
+HCP_WEBHOOK_PRUNE_BATCH_SIZE = config("HCP_WEBHOOK_PRUNE_BATCH_SIZE", default=1000, cast=int)
+
+# Tokens expiring within this many seconds are refreshed, by at most
+# GHL_TOKEN_REFRESH_CONCURRENCY parallel OAuth calls
+GHL_TOKEN_REFRESH_MARGIN = config("GHL_TOKEN_REFRESH_MARGIN", default=3600, cast=int)
+GHL_TOKEN_REFRESH_CONCURRENCY = config("GHL_TOKEN_REFRESH_CONCURRENCY", default=5, cast=int)
+
+# Seconds HCP company -> GHL mapping lookups stay cached in-process and in Redis
+HCP_MAPPING_CACHE_TTL = config("HCP_MAPPING_CACHE_TTL", default=30, cast=int)
+HCP_MAPPING_SHARED_CACHE_TTL = config("HCP_MAPPING_SHARED_CACHE_TTL", default=300, cast=int)
+
+# Before creating a GHL contact, look for one with the same email/phone in the
+# local index and, on a miss, with GHL's duplicate search. Phone numbers without
+# a country code get GHL_PHONE_DEFAULT_COUNTRY_CODE, see core/contact_index.py
+GHL_CONTACT_DEDUP_SEARCH = config("GHL_CONTACT_DEDUP_SEARCH", default=True, cast=bool)
+GHL_PHONE_DEFAULT_COUNTRY_CODE = config("GHL_PHONE_DEFAULT_COUNTRY_CODE", default="1")
+
+# Client-side GHL rate limits per location: burst bucket of GHL_RATE_LIMIT_BURST
+# requests per GHL_RATE_LIMIT_INTERVAL seconds plus a daily bucket. 429s are
+# retried up to GHL_RATE_LIMIT_MAX_RETRIES times with jittered backoff. A 429
+# asking to wait longer than GHL_BACKOFF_MAX seconds fails right away and is
+# dead-lettered (core/deadletter.py) or retried by the outbox.
+GHL_RATE_LIMIT_BURST = config("GHL_RATE_LIMIT_BURST", default=100, cast=int)
+GHL_RATE_LIMIT_INTERVAL = config("GHL_RATE_LIMIT_INTERVAL", default=10, cast=float)
+GHL_RATE_LIMIT_DAILY = config("GHL_RATE_LIMIT_DAILY", default=200000, cast=int)
+GHL_RATE_LIMIT_MAX_WAIT = config("GHL_RATE_LIMIT_MAX_WAIT", default=30, cast=float)
+GHL_RATE_LIMIT_MAX_RETRIES = config("GHL_RATE_LIMIT_MAX_RETRIES", default=5, cast=int)
+GHL_BACKOFF_BASE = config("GHL_BACKOFF_BASE", default=1, cast=float)
+GHL_BACKOFF_MAX = config("GHL_BACKOFF_MAX", default=60, cast=float)
+
+# Connection pool and timeouts (seconds) for the GoHighLevel API session
+GHL_HTTP_POOL_SIZE = config("GHL_HTTP_POOL_SIZE", default=20, cast=int)
+GHL_HTTP_CONNECT_TIMEOUT = config("GHL_HTTP_CONNECT_TIMEOUT", default=5, cast=float)
+GHL_HTTP_READ_TIMEOUT = config("GHL_HTTP_READ_TIMEOUT", default=30, cast=float)
+
+# GHL creates go through the outbox (core/outbox.py): relay batch size and
+# parallel GHL calls, attempts before a message is marked failed, and how long
+# a relay holds a message before another one may retry it
+GHL_OUTBOX_BATCH_SIZE = config("GHL_OUTBOX_BATCH_SIZE", default=100, cast=int)
+GHL_OUTBOX_RELAY_CONCURRENCY = config("GHL_OUTBOX_RELAY_CONCURRENCY", default=5, cast=int)
+GHL_OUTBOX_MAX_ATTEMPTS = config("GHL_OUTBOX_MAX_ATTEMPTS", default=8, cast=int)
+GHL_OUTBOX_LEASE_SECONDS = config("GHL_OUTBOX_LEASE_SECONDS", default=120, cast=int)
+
+# Failed GHL updates/deletes are dead-lettered and retried by beat
+# (core/deadletter.py): GHL_DEAD_LETTER_BATCH_SIZE per drain, backoff from
+# GHL_DEAD_LETTER_RETRY_BASE seconds doubling up to GHL_DEAD_LETTER_RETRY_MAX,
+# marked failed after GHL_DEAD_LETTER_MAX_ATTEMPTS
+GHL_DEAD_LETTER_BATCH_SIZE = config("GHL_DEAD_LETTER_BATCH_SIZE", default=50, cast=int)
+GHL_DEAD_LETTER_RETRY_BASE = config("GHL_DEAD_LETTER_RETRY_BASE", default=60, cast=int)
+GHL_DEAD_LETTER_RETRY_MAX = config("GHL_DEAD_LETTER_RETRY_MAX", default=6 * 3600, cast=int)
+GHL_DEAD_LETTER_MAX_ATTEMPTS = config("GHL_DEAD_LETTER_MAX_ATTEMPTS", default=10, cast=int)
+
+# AsyncGoHighLevelService: connections per event loop and in-flight requests per location
+GHL_ASYNC_MAX_CONNECTIONS = config("GHL_ASYNC_MAX_CONNECTIONS", default=200, cast=int)
+GHL_ASYNC_PER_LOCATION_CONCURRENCY = config("GHL_ASYNC_PER_LOCATION_CONCURRENCY", default=20, cast=int)
+
+# /metrics answers requests carrying "Authorization: Bearer METRICS_TOKEN" or
+# coming from one of METRICS_ALLOWED_IPS, everything else gets 403
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+METRICS_ALLOWED_IPS = config("METRICS_ALLOWED_IPS", default="127.0.0.1,::1", cast=Csv())
+
+# Also log every latency observation (view phases, DB queries, GHL calls,
+# handlers) as a JSON line on the core.metrics logger, see core/metrics.py
+METRICS_JSON_LOGS = config("METRICS_JSON_LOGS", default=False, cast=bool)
+
+# Record the ORM queries of every webhook and log a warning when an event goes
+# over its query budget or repeats a query, see core/querybudget.py
+HCP_QUERY_BUDGET_CHECK = config("HCP_QUERY_BUDGET_CHECK", default=False, cast=bool)
 
 
 CELERY_BEAT_SCHEDULE = {
-    'make-api-call-every-minute': {
-        'task': 'core.tasks.make_api_call',
+    'refresh-expiring-tokens-every-minute': {
+        'task': 'core.tasks.refresh_expiring_tokens',
+        'schedule': timedelta(minutes=1),
+    },
+    'relay-ghl-outbox-every-30-seconds': {
+        'task': 'core.tasks.relay_ghl_outbox',
+        'schedule': timedelta(seconds=30),
+    },
+    'retry-ghl-dead-letters-every-minute': {
+        'task': 'core.tasks.retry_ghl_dead_letters',
         'schedule': timedelta(minutes=1),
     },
+    'prune-webhooks-daily': {
+        'task': 'core.tasks.prune_webhooks',
+        'schedule': timedelta(days=1),
+    },
 }
 
 
+# Log records are handed to a background thread (core/log_handlers.py) so file
+# and console writes stay off the request path, up to HCP_LOG_QUEUE_SIZE
+# records are buffered and the rest dropped. Webhook payloads are logged for a
+# HCP_LOG_PAYLOAD_SAMPLE_RATE fraction of requests, with personal data masked.
+HCP_LOG_LEVEL = config("HCP_LOG_LEVEL", default="INFO")
+HCP_LOG_QUEUE_SIZE = config("HCP_LOG_QUEUE_SIZE", default=10000, cast=int)
+HCP_LOG_PAYLOAD_SAMPLE_RATE = config("HCP_LOG_PAYLOAD_SAMPLE_RATE", default=0.01, cast=float)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'webhook_payload': {
+            '()': 'core.log_handlers.WebhookPayloadFilter',
+            'sample_rate': HCP_LOG_PAYLOAD_SAMPLE_RATE,
+        },
+    },
     'handlers': {
         'file': {
             'level': 'INFO',
@@ -170,12 +324,29 @@ LOGGING = {
             'level': 'INFO',
             'class': 'logging.StreamHandler',
         },
+        # Queue handlers must sort after the handlers they write to
+        'queue': {
+            'class': 'core.log_handlers.QueueListenerHandler',
+            'targets': ['cfg://handlers.file', 'cfg://handlers.console'],
+            'maxsize': HCP_LOG_QUEUE_SIZE,
+            'filters': ['webhook_payload'],
+        },
+        'queue_metrics': {
+            'class': 'core.log_handlers.QueueListenerHandler',
+            'targets': ['cfg://handlers.console'],
+            'maxsize': HCP_LOG_QUEUE_SIZE,
+        },
     },
     'loggers': {
-        'your_app_name': {  # Replace with your actual app name
-            'handlers': ['file', 'console'],
+        'core': {
+            'handlers': ['queue'],
+            'level': HCP_LOG_LEVEL,
+            'propagate': False,
+        },
+        'core.metrics': {
+            'handlers': ['queue_metrics'],
             'level': 'INFO',
-            'propagate': True,
+            'propagate': False,
         },
     },
-}
\ No newline at end of file
+}